@@ -3,7 +3,7 @@ import os
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 
 # Configure logging
 logging.basicConfig(
@@ -14,12 +14,39 @@ logging.basicConfig(
 # Initialize Flask app
 app = Flask(__name__)
 
+# Connection pooling of the manager, in front of the database pooler:
+# - null: open a new connection for each session (default).
+# - queue: keep up to DB_POOL_SIZE (+ DB_POOL_MAX_OVERFLOW) connections open across requests, saving the
+#   connection setup on each request.
+DB_POOL_MODE = os.getenv('DB_POOL_MODE', 'null')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', '5'))
+# Seconds to wait for a connection when the pool is exhausted.
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Seconds after which a pooled connection is replaced, before the pooler or the network drops it.
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '300'))
+
 # Per Supabase doc, since the host is not IPV6, we use the transaction pooler mode.
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'poolclass': NullPool  # Important for transaction pooler mode
-}
+if DB_POOL_MODE == 'queue':
+    # Safe behind the transaction pooler: the sessions don't rely on connection state across transactions
+    # (connections are rolled back when returned to the pool), and psycopg2 doesn't use server-side
+    # prepared statements. Dead connections are detected before use by pre_ping.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_POOL_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True,
+    }
+elif DB_POOL_MODE == 'null':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': NullPool  # Important for transaction pooler mode
+    }
+else:
+    raise ValueError(f"Invalid DB_POOL_MODE: {DB_POOL_MODE}")
 
 # Initialize database
 db = SQLAlchemy(app)
@@ -0,0 +1,254 @@
+import os
+import threading
+import time
+import logging
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm.attributes import flag_modified
+
+from api import app, db
+from api.models import Agent, Image, Run
+from api.runs import get_start_payload, record_run_start
+from api.container.fleet import NoCapacityError
+from api.container.manage import (get_or_start_container, wait_for_container_supervisor, container_registry, warm_pool,
+                                  remove_unhealthy_container)
+from api.container.resources import get_resource_profile
+from api.container.supervisor_client import get_supervisor_client, SupervisorUnavailableError
+
+# Admission control of the run starts.
+#
+# A run whose container can't be placed because the docker hosts are at capacity is not started on an
+# overcommitted host: it stays PENDING, marked as waiting in its configuration, and is started once capacity
+# is freed, when a container is gone, or at the latest within ADMISSION_RETRY_INTERVAL seconds. The waiting
+# runs are retried in order, a run starts as soon as it fits, stopping idle warm containers if needed.
+# The waiting runs are stored in the database, so that they are started by any manager process, also after
+# a restart: a process claims a run before trying to start it with SELECT ... FOR UPDATE SKIP LOCKED, so
+# that concurrent processes never try the same one.
+
+# Maximum number of runs waiting for capacity. Run starts beyond it fail.
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))
+# Maximum number of seconds a run waits for capacity, after which it fails.
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "600"))
+# Maximum interval in seconds between two attempts to start the waiting runs.
+ADMISSION_RETRY_INTERVAL = float(os.getenv("ADMISSION_RETRY_INTERVAL", "5"))
+# Number of seconds after which a run claimed by a process is claimed again, if that process died while
+# starting it. Longer than a container start.
+ADMISSION_CLAIM_TIMEOUT = 300
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionQueueFullError(RuntimeError):
+    """
+    Too many runs are already waiting for capacity.
+    """
+    pass
+
+
+def launch_run(run, image_name, payload, profile):
+    """
+    Start the run in a container of the image, starting the container with the resource profile if needed,
+    and record the outcome. Returns the response of the supervisor, with the QUEUED status and position of the
+    run if it waits for a slot in the container.
+    Raises NoCapacityError, leaving the run PENDING, if the container can't be placed. The other failures are
+    recorded on the run, as ERROR, and raised.
+    """
+    # Bring up the container, if not already running
+    try:
+        container_id, supervisor_port, supervisor_host = get_or_start_container(image_name, profile)
+    except NoCapacityError:
+        raise
+    except Exception as e:
+        record_run_start(run, error=str(e))
+        raise
+    logger.info(f"Container {container_id} with supervisor at {supervisor_host}:{supervisor_port} running for run {run.id}")
+
+    # Wait for the supervisor API to come up within the container.
+    try:
+        wait_for_container_supervisor(container_id, supervisor_port, supervisor_host)
+    except RuntimeError as e:
+        remove_unhealthy_container(container_id)
+        record_run_start(run, error=str(e))
+        raise
+
+    # Make the API request to the supervisor for starting the agent run.
+    try:
+        response = get_supervisor_client(supervisor_port, supervisor_host).post(
+            f'/api/run/{run.id}/start', json=payload)
+    except SupervisorUnavailableError as e:
+        record_run_start(run, error=str(e))
+        raise
+    if response.status_code != 200:
+        record_run_start(run, error=response.text)
+        raise Exception(f"Failed to start agent run: {response.text}")
+
+    # Update run status to RUNNING
+    record_run_start(run, container_id=container_id)
+    logger.info(f"Agent run {run.id} started successfully")
+    return response.json()
+
+
+class AdmissionQueue:
+    """
+    Runs waiting for capacity, started by a background thread of each process once capacity is freed.
+    """
+
+    def __init__(self, max_size=ADMISSION_QUEUE_SIZE, timeout=ADMISSION_TIMEOUT, retry_interval=ADMISSION_RETRY_INTERVAL):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @staticmethod
+    def _waiting_runs():
+        # The runs waiting for capacity have the time they started waiting in their configuration.
+        return db.session.query(Run).filter(
+            Run.status == 'PENDING', Run.config['admission']['enqueuedAt'].as_float().isnot(None))
+
+    def start(self):
+        """
+        Start the admission thread of this process, unless already started.
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._admit_loop, name="run_admission", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, run_id):
+        """
+        Queue the start of the PENDING run until capacity is available. Returns its position in the queue.
+        """
+        waiting = self._waiting_runs().count()
+        if waiting >= self.max_size:
+            db.session.rollback()
+            raise AdmissionQueueFullError(f"{waiting} runs are already waiting for capacity")
+        run = db.session.get(Run, run_id)
+        run.config['admission'] = {'enqueuedAt': time.time(), 'claimedAt': None}
+        flag_modified(run, 'config')
+        db.session.commit()
+        self.start()
+        position = self.position(run_id)
+        logger.info(f"No capacity to start run {run_id}, waiting at position {position}")
+        return position
+
+    def position(self, run_id):
+        """
+        Returns the 1-based position of the run in the queue, or None if it is not waiting.
+        """
+        run = self._waiting_runs().filter(Run.id == run_id).first()
+        if run is None:
+            return None
+        return self._waiting_runs().filter(Run.id <= run.id).count()
+
+    def notify(self, *args):
+        """
+        Capacity may have been freed: retry the waiting runs now.
+        """
+        with self._condition:
+            self._condition.notify()
+
+    def stats(self):
+        oldest = self._waiting_runs().with_entities(
+            func.min(Run.config['admission']['enqueuedAt'].as_float())).scalar()
+        waiting = self._waiting_runs().count()
+        db.session.rollback()
+        return {
+            'waiting': waiting,
+            'maxSize': self.max_size,
+            'oldestWait': time.time() - oldest if oldest is not None else 0,
+        }
+
+    def _admit_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait(timeout=self.retry_interval)
+            try:
+                with app.app_context():
+                    self._admit_waiting()
+            except Exception as e:
+                logger.error(f"Error while starting the waiting runs: {str(e)}")
+
+    def _admit_waiting(self):
+        """
+        Try to start the waiting runs, in order.
+        """
+        last_id = 0
+        while True:
+            run = self._claim_next(last_id)
+            if run is None:
+                return
+            last_id = run.id
+            try:
+                admitted = self._admit(run)
+            except Exception as e:
+                logger.error(f"Failed to start waiting run {run.id}: {str(e)}")
+                admitted = True
+            if not admitted:
+                # Released for the next attempt, by any process.
+                run.config['admission']['claimedAt'] = None
+                flag_modified(run, 'config')
+                db.session.commit()
+
+    def _claim_next(self, last_id):
+        """
+        Claim the next waiting run after last_id that no other process is trying to start.
+        Returns the run, or None if there is no such run.
+        """
+        claimed_before = time.time() - ADMISSION_CLAIM_TIMEOUT
+        claimed_at = Run.config['admission']['claimedAt'].as_float()
+        # Rows locked by the concurrent claims are skipped rather than waited for.
+        run = (self._waiting_runs()
+               .filter(Run.id > last_id, or_(claimed_at.is_(None), claimed_at < claimed_before))
+               .order_by(Run.id)
+               .with_for_update(skip_locked=True)
+               .populate_existing()
+               .limit(1)
+               .first())
+        if run is None:
+            db.session.rollback()
+            return None
+        run.config['admission']['claimedAt'] = time.time()
+        flag_modified(run, 'config')
+        db.session.commit()
+        return run
+
+    def _admit(self, run):
+        """
+        Try to start the claimed run. Returns False if it must keep waiting.
+        """
+        if time.time() - run.config['admission']['enqueuedAt'] > self.timeout:
+            logger.warning(f"Run {run.id} waited {self.timeout}s for capacity, giving up")
+            record_run_start(run, error="No capacity available to start the run")
+            return True
+
+        agent = db.session.get(Agent, run.agent_id)
+        image = db.session.get(Image, run.image_id)
+        payload = get_start_payload(agent, run, run.config.get('inputs'))
+        profile = get_resource_profile(agent.config)
+        try:
+            try:
+                launch_run(run, image.name, payload, profile)
+            except NoCapacityError:
+                db.session.rollback()
+                # The idle warm containers hold capacity that a run waits for.
+                if not warm_pool.evict_one():
+                    return False
+                launch_run(run, image.name, payload, profile)
+        except NoCapacityError:
+            db.session.rollback()
+            return False
+        except Exception as e:
+            db.session.rollback()
+            run = db.session.get(Run, run.id)
+            # Do not leave the run PENDING forever.
+            if run.status == 'PENDING':
+                record_run_start(run, error=str(e))
+            raise
+        return True
+
+
+admission_queue = AdmissionQueue()
+# Containers gone free capacity on their host.
+container_registry.on_container_gone(admission_queue.notify)
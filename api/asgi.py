@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from sqlalchemy.orm import defer
+
+from api import app, db
+from api.models import Image, Run
+from api.admission import AdmissionQueueFullError, admission_queue
+from api.container.fleet import NoCapacityError
+from api.container.manage import get_or_start_container, readiness_tracker, remove_unhealthy_container
+from api.container.readiness import READINESS_TIMEOUT, SupervisorNotReadyError
+from api.container.resources import get_resource_profile
+from api.image.worker import drain_builds
+from api.container.supervisor_client import get_supervisor_client, SupervisorUnavailableError
+from api.runs import (FINAL_STATUSES, RunNotFoundError, complete_run, create_run, get_start_payload,
+                      get_run_container, record_run_start, final_output_events, RunContainerNotFoundError)
+
+# Async (ASGI) serving mode of the manager API.
+#
+# The endpoints that spend most of their time waiting, the run start (container start and supervisor
+# readiness) and the live output stream, are served by async views: waiting doesn't hold a thread, so
+# thousands of them fit in a single process. The supervisor is called with httpx, the readiness is awaited
+# on the futures of the readiness tracker, and the short database queries run in the threadpool.
+# All the other endpoints are served by the Flask app, in the threadpool.
+# Run with: uvicorn asgi:app
+
+logger = logging.getLogger(__name__)
+
+
+def error_response(message, status_code):
+    """
+    Same error response as api.utils.create_error_response.
+    """
+    logger.error(f"Error: {message} (Status code: {status_code})")
+    return JSONResponse({'error': message, 'status_code': status_code}, status_code=status_code)
+
+
+def _in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+
+async def run_db(fn, *args):
+    """
+    Run fn(*args) in the threadpool, within an app context, so that it gets its own database session.
+    """
+    return await run_in_threadpool(_in_app_context, fn, *args)
+
+
+async def start_agent(request):
+    """
+    Async variant of routes.start_agent.
+    """
+    agent_id = request.path_params['agent_id']
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            return error_response("Request must be JSON", 400)
+        if not isinstance(data, dict) or 'inputs' not in data:
+            return error_response("Request must contain 'inputs' field", 400)
+
+        inputs = data['inputs']
+        logger.info(f"Received inputs for agent {agent_id}: {inputs}")
+
+        def create():
+            agent, image, run = create_run(agent_id, inputs)
+            return image.name, run.id, get_start_payload(agent, run, inputs), get_resource_profile(agent.config)
+
+        try:
+            image_name, run_id, payload, profile = await run_db(create)
+        except RunNotFoundError as e:
+            return error_response(str(e), 404)
+
+        def record_start(error=None, container_id=None):
+            record_run_start(db.session.get(Run, run_id), error, container_id)
+
+        # Bring up the container, if not already running
+        try:
+            container_id, supervisor_port, supervisor_host = await run_in_threadpool(
+                get_or_start_container, image_name, profile)
+        except NoCapacityError:
+            # Wait for capacity rather than overcommitting a docker host.
+            try:
+                position = await run_db(admission_queue.enqueue, run_id)
+            except AdmissionQueueFullError as e:
+                await run_db(record_start, str(e))
+                return error_response(f"No capacity to start the run: {str(e)}", 503)
+            return JSONResponse({'status': 'PENDING', 'runId': run_id, 'queuePosition': position}, status_code=202)
+        except Exception as e:
+            await run_db(record_start, str(e))
+            raise
+        logger.info(f"Container {container_id} with supervisor at {supervisor_host}:{supervisor_port} running for agent {agent_id}")
+
+        # Wait for the supervisor API to come up within the container, without holding a thread.
+        # The future is shared with the other waiters on the container: shielded, so that a timeout or a
+        # disconnected client doesn't cancel it.
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(
+                    readiness_tracker.wait_until_ready(container_id, supervisor_port, supervisor_host))),
+                READINESS_TIMEOUT + 1)
+        except (SupervisorNotReadyError, asyncio.TimeoutError) as e:
+            error = f"Supervisor API did not become available in time: {e}"
+            await run_in_threadpool(remove_unhealthy_container, container_id)
+            await run_db(record_start, error)
+            raise RuntimeError(error)
+
+        # Make the API request to the supervisor for starting the agent run.
+        try:
+            response = await get_supervisor_client(supervisor_port, supervisor_host).arequest(
+                'POST', f'/api/run/{run_id}/start', json=payload)
+        except SupervisorUnavailableError as e:
+            await run_db(record_start, str(e))
+            raise
+        if response.status_code != 200:
+            await run_db(record_start, response.text)
+            raise Exception(f"Failed to start agent run: {response.text}")
+
+        # Update run status to RUNNING
+        await run_db(record_start, None, container_id)
+        logger.info(f"Agent run {run_id} started successfully for agent {agent_id}")
+        started = response.json()
+
+    except Exception as e:
+        return error_response(f"Internal server error: {str(e)}", 500)
+
+    if started.get('status') == 'QUEUED':
+        # Waiting for a slot in its container.
+        return JSONResponse({'status': 'QUEUED', 'runId': run_id, 'queuePosition': started.get('position')})
+    return JSONResponse({'status': 'RUNNING', 'runId': run_id})
+
+
+async def stream_run_output(request):
+    """
+    Async variant of routes.stream_run_output.
+    """
+    agent_id = request.path_params['agent_id']
+    run_id = request.path_params['run_id']
+
+    def get_run():
+        run = db.session.query(Run).options(defer(Run.output)) \
+            .filter(Run.id == run_id, Run.agent_id == agent_id).first()
+        if not run:
+            return None, None, None
+        if run.status in FINAL_STATUSES:
+            return run.status, final_output_events(run), None
+        image = db.session.query(Image).filter(Image.id == run.image_id).first()
+        return run.status, None, image.name if image else None
+
+    def get_container():
+        return get_run_container(db.session.get(Run, run_id), image_name)
+
+    status, events, image_name = await run_db(get_run)
+    if status is None:
+        return error_response(f"Run with id {run_id} not found for agent {agent_id}", 404)
+
+    # If the run is in a final state, send the output from the database
+    if events is not None:
+        return StreamingResponse(iter(events), media_type='text/event-stream')
+
+    if image_name is None:
+        return error_response(f"Image not found for run {run_id}", 404)
+
+    try:
+        container_id, supervisor_port, supervisor_host = await run_db(get_container)
+        supervisor_client = get_supervisor_client(supervisor_port, supervisor_host)
+
+        headers = {}
+        if request.headers.get('Last-Event-ID'):
+            headers['Last-Event-ID'] = request.headers['Last-Event-ID']
+        response = await supervisor_client.astream(f'/api/run/{run_id}/stream', headers=headers)
+    except RunContainerNotFoundError as e:
+        status, events, _ = await run_db(get_run)
+        if events is not None:
+            # Failed with its container.
+            return StreamingResponse(iter(events), media_type='text/event-stream')
+        return error_response(str(e), 503)
+    except SupervisorUnavailableError as e:
+        return error_response(str(e), 503)
+    except Exception as e:
+        return error_response(f"Internal server error: {str(e)}", 500)
+
+    if response.status_code != 200:
+        await response.aread()
+        await response.aclose()
+        return error_response(f"Failed to stream run output: {response.text}", 500)
+
+    def complete(final_status):
+        run = db.session.get(Run, run_id)
+        if run.status not in FINAL_STATUSES:
+            complete_run(run, final_status, supervisor_client)
+
+    async def generate():
+        event = None
+        final_status = None
+        try:
+            # Relay the supervisor events as they arrive, watching for the final status.
+            async for line in response.aiter_lines():
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:') and event == 'status':
+                    final_status = json.loads(line[len('data:'):].strip()).get('status')
+                elif line == '':
+                    event = None
+                yield line + '\n'
+        finally:
+            await response.aclose()
+
+        # Store the complete output and the final status of the run
+        if final_status in FINAL_STATUSES:
+            await run_db(complete, final_status)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    yield
+    # Let the builds running in this process complete before it exits
+    await run_in_threadpool(drain_builds)
+
+
+asgi_app = Starlette(lifespan=lifespan, routes=[
+    Route('/api/agent/{agent_id}/run/start', start_agent, methods=['POST']),
+    Route('/api/agent/{agent_id}/run/{run_id}/stream', stream_run_output, methods=['GET']),
+    Mount('/', app=WsgiToAsgi(app)),
+])
@@ -0,0 +1,51 @@
+import hashlib
+import hmac
+import os
+
+# Callbacks from the container supervisors to the manager.
+
+# Base URL of the manager API as seen from the containers, e.g. http://host.docker.internal:5000
+# Supervisors push their readiness and the completion of the runs to it. If not set, the manager
+# only learns about them by polling the supervisors.
+MANAGER_CALLBACK_URL = os.getenv("MANAGER_CALLBACK_URL")
+# Secret used to sign the callback URLs, so that only the supervisors can call them.
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET")
+
+# Signed subject of the container readiness callback.
+READY_CALLBACK_SUBJECT = "container-ready"
+
+
+def callbacks_enabled():
+    return bool(MANAGER_CALLBACK_URL and CALLBACK_SECRET)
+
+
+def callback_token(subject):
+    return hmac.new(CALLBACK_SECRET.encode(), str(subject).encode(), hashlib.sha256).hexdigest()
+
+
+def verify_callback_token(subject, token):
+    if not CALLBACK_SECRET or not token:
+        return False
+    return hmac.compare_digest(callback_token(subject), token)
+
+
+def _callback_url(path, subject):
+    return f"{MANAGER_CALLBACK_URL.rstrip('/')}{path}?token={callback_token(subject)}"
+
+
+def get_run_callback_url(run):
+    """
+    Returns the URL the supervisor calls when the run completes, or None if callbacks are not configured.
+    """
+    if not callbacks_enabled():
+        return None
+    return _callback_url(f"/api/agent/{run.agent_id}/run/{run.id}/complete", run.id)
+
+
+def get_ready_callback_url():
+    """
+    Returns the URL the supervisors call once ready to serve, or None if callbacks are not configured.
+    """
+    if not callbacks_enabled():
+        return None
+    return _callback_url("/api/container/ready", READY_CALLBACK_SUBJECT)
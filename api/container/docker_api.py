@@ -0,0 +1,353 @@
+import http.client
+import io
+import json
+import os
+import queue
+import re
+import socket
+import subprocess
+import tarfile
+import tempfile
+import logging
+from pathlib import Path
+from urllib.parse import urlencode, urlparse
+
+# Client for the Docker Engine HTTP API.
+# Talks to the daemon over its unix socket (or tcp) and reuses connections across calls,
+# instead of forking the docker cli for every operation.
+
+DOCKER_HOST = os.getenv("DOCKER_HOST", "unix:///var/run/docker.sock")
+DOCKER_API_VERSION = os.getenv("DOCKER_API_VERSION", "v1.41")
+# Maximum number of idle connections kept open to the daemon.
+DOCKER_POOL_SIZE = int(os.getenv("DOCKER_POOL_SIZE", "10"))
+# Timeout in seconds for regular (non streaming) API calls.
+DOCKER_TIMEOUT = float(os.getenv("DOCKER_TIMEOUT", "60"))
+
+# Build with BuildKit, through the docker cli since the Engine API only exposes BuildKit over a gRPC session.
+# BuildKit is required for the cache mounts of the Dockerfiles; without it they are ignored.
+DOCKER_BUILDKIT = os.getenv("DOCKER_BUILDKIT", "1") == "1"
+
+# Size in bytes of the chunks of the image tarballs copied between docker hosts.
+IMAGE_TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+# Name under which the Dockerfile is added to the build context sent to the daemon.
+CONTEXT_DOCKERFILE_NAME = ".launchpad.Dockerfile"
+
+logger = logging.getLogger(__name__)
+
+
+class DockerAPIError(RuntimeError):
+  """
+  Error returned by the docker daemon.
+  """
+  def __init__(self, status, message):
+    super().__init__(f"Docker API error {status}: {message}")
+    self.status = status
+    self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  """
+  HTTP connection over a unix domain socket.
+  """
+  def __init__(self, socket_path, timeout=None):
+    super().__init__("localhost", timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    sock.connect(self.socket_path)
+    self.sock = sock
+
+
+class DockerClient:
+  """
+  Minimal Docker Engine API client with a pool of keep-alive connections.
+  base_url is either unix:///path/to/docker.sock or tcp://host:port.
+  """
+
+  def __init__(self, base_url=DOCKER_HOST, api_version=DOCKER_API_VERSION, pool_size=DOCKER_POOL_SIZE,
+               timeout=DOCKER_TIMEOUT):
+    self.base_url = base_url
+    self.api_version = api_version
+    self.timeout = timeout
+    self._idle_connections = queue.LifoQueue(maxsize=pool_size)
+
+    parsed = urlparse(base_url)
+    if parsed.scheme == "unix":
+      self._socket_path = parsed.path
+      self._address = None
+    elif parsed.scheme in ("tcp", "http"):
+      self._socket_path = None
+      self._address = (parsed.hostname, parsed.port or 2375)
+    else:
+      raise ValueError(f"Unsupported docker host: {base_url}")
+
+  def _new_connection(self, timeout):
+    if self._socket_path:
+      return UnixHTTPConnection(self._socket_path, timeout=timeout)
+    return http.client.HTTPConnection(*self._address, timeout=timeout)
+
+  def _url(self, path, params=None):
+    url = f"/{self.api_version}{path}"
+    if params:
+      url += "?" + urlencode({k: v for k, v in params.items() if v is not None})
+    return url
+
+  def _release(self, connection):
+    try:
+      self._idle_connections.put_nowait(connection)
+    except queue.Full:
+      connection.close()
+
+  def request(self, method, path, params=None, body=None, headers=None):
+    """
+    Perform an API call and return the decoded JSON response (None if the response is empty).
+    Connections are taken from the pool and returned to it once the response is fully read.
+    """
+    headers = dict(headers or {})
+    if isinstance(body, (dict, list)):
+      body = json.dumps(body).encode()
+      headers["Content-Type"] = "application/json"
+
+    url = self._url(path, params)
+    # A pooled connection may have been closed by the daemon while idle.
+    # In that case, retry once on a fresh connection.
+    for attempt in range(2):
+      try:
+        connection = self._idle_connections.get_nowait()
+        reused = True
+      except queue.Empty:
+        connection = self._new_connection(self.timeout)
+        reused = False
+
+      try:
+        connection.request(method, url, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+      except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+        connection.close()
+        if reused and attempt == 0:
+          continue
+        raise
+      except Exception:
+        connection.close()
+        raise
+
+      if response.will_close:
+        connection.close()
+      else:
+        self._release(connection)
+      break
+
+    if response.status >= 400:
+      raise DockerAPIError(response.status, self._error_message(data))
+    if not data:
+      return None
+    return json.loads(data)
+
+  def stream(self, method, path, params=None, body=None, headers=None):
+    """
+    Perform a streaming API call (build, events, ...) on a dedicated connection.
+    Yields the JSON messages of the response as they arrive.
+    """
+    connection = self._new_connection(None)
+    try:
+      connection.request(method, self._url(path, params), body=body, headers=headers or {})
+      response = connection.getresponse()
+      if response.status >= 400:
+        raise DockerAPIError(response.status, self._error_message(response.read()))
+
+      while True:
+        line = response.readline()
+        if not line:
+          break
+        line = line.strip()
+        if line:
+          yield json.loads(line)
+    finally:
+      connection.close()
+
+  @staticmethod
+  def _error_message(data):
+    try:
+      return json.loads(data).get("message", data.decode(errors="replace"))
+    except ValueError:
+      return data.decode(errors="replace")
+
+  # Containers
+
+  def list_containers(self, filters=None):
+    params = {"filters": json.dumps(filters)} if filters else None
+    return self.request("GET", "/containers/json", params=params)
+
+  def inspect_container(self, container_id):
+    return self.request("GET", f"/containers/{container_id}/json")
+
+  def create_container(self, config, name=None):
+    return self.request("POST", "/containers/create", params={"name": name}, body=config)["Id"]
+
+  def start_container(self, container_id):
+    self.request("POST", f"/containers/{container_id}/start")
+
+  def rename_container(self, container_id, name):
+    self.request("POST", f"/containers/{container_id}/rename", params={"name": name})
+
+  def run_container(self, image_name, exposed_port, env=None, labels=None, host_config=None, name=None):
+    """
+    Create and start a container from the image, binding exposed_port to a random host port.
+    host_config holds additional HostConfig settings, e.g. resource limits.
+    Returns the container id.
+    """
+    port_key = f"{exposed_port}/tcp"
+    config = {
+      "Image": image_name,
+      "Env": [f"{key}={value}" for key, value in (env or {}).items()],
+      "Labels": labels or {},
+      "ExposedPorts": {port_key: {}},
+      "HostConfig": {
+        "PortBindings": {port_key: [{"HostPort": ""}]},
+        # Let the supervisor reach the manager running on the host (run completion callbacks).
+        "ExtraHosts": ["host.docker.internal:host-gateway"],
+        **(host_config or {}),
+      },
+    }
+    container_id = self.create_container(config, name=name)
+    self.start_container(container_id)
+    return container_id
+
+  def remove_container(self, container_id, force=False):
+    self.request("DELETE", f"/containers/{container_id}", params={"force": "1" if force else None})
+
+  def container_host_port(self, container_id, exposed_port):
+    """
+    Returns the host port bound to the exposed_port of the container, or None.
+    """
+    container = self.inspect_container(container_id)
+    bindings = (container.get("NetworkSettings", {}).get("Ports") or {}).get(f"{exposed_port}/tcp")
+    if not bindings:
+      return None
+    return bindings[0]["HostPort"]
+
+  def events(self, filters=None):
+    """
+    Yields the daemon events as they happen. Blocks until the connection is closed.
+    """
+    params = {"filters": json.dumps(filters)} if filters else None
+    return self.stream("GET", "/events", params=params)
+
+  # System
+
+  def info(self):
+    return self.request("GET", "/info")
+
+  # Images
+
+  def list_images(self, filters=None):
+    params = {"filters": json.dumps(filters)} if filters else None
+    return self.request("GET", "/images/json", params=params)
+
+  def export_image(self, image_name):
+    """
+    Yields the chunks of the tarball of the image, as produced by docker save.
+    """
+    connection = self._new_connection(None)
+    try:
+      connection.request("GET", self._url(f"/images/{image_name}/get"))
+      response = connection.getresponse()
+      if response.status >= 400:
+        raise DockerAPIError(response.status, self._error_message(response.read()))
+      while True:
+        chunk = response.read(IMAGE_TRANSFER_CHUNK_SIZE)
+        if not chunk:
+          break
+        yield chunk
+    finally:
+      connection.close()
+
+  def load_image(self, chunks):
+    """
+    Load an image from the chunks of its tarball, as docker load. The tarball is streamed to the daemon.
+    """
+    # http.client sends iterable bodies with chunked transfer encoding.
+    for message in self.stream("POST", "/images/load", params={"quiet": "1"}, body=chunks,
+                               headers={"Content-Type": "application/x-tar"}):
+      if "error" in message:
+        raise DockerAPIError(500, message["error"])
+
+  def build_image(self, context_dir, dockerfile, tag, buildargs=None, labels=None, on_output=None):
+    """
+    Build an image from context_dir using the given Dockerfile.
+    The build output is passed line by line to on_output as it is produced.
+    Files matching the <dockerfile>.dockerignore next to the Dockerfile are not sent to the daemon.
+    """
+    if DOCKER_BUILDKIT:
+      return self._build_image_buildkit(context_dir, dockerfile, tag, buildargs, labels, on_output)
+
+    # The classic builder doesn't support the BuildKit RUN flags: build without the cache mounts.
+    dockerfile_content = re.sub(r'^(RUN\s+)(--mount=\S+\s+)+', r'\1', Path(dockerfile).read_text(), flags=re.M)
+    ignored = _ignored_names(dockerfile)
+
+    # The build context is streamed to the daemon from a temporary tar file rather than held in memory.
+    with tempfile.TemporaryFile() as context:
+      with tarfile.open(fileobj=context, mode="w") as tar:
+        tar.add(str(context_dir), arcname=".",
+                filter=lambda info: None if ignored.intersection(Path(info.name).parts) else info)
+        dockerfile_info = tarfile.TarInfo(CONTEXT_DOCKERFILE_NAME)
+        dockerfile_info.size = len(dockerfile_content.encode())
+        tar.addfile(dockerfile_info, io.BytesIO(dockerfile_content.encode()))
+      context_size = context.tell()
+      context.seek(0)
+
+      params = {
+        "t": tag,
+        "dockerfile": CONTEXT_DOCKERFILE_NAME,
+        "rm": "1",
+        "buildargs": json.dumps(buildargs) if buildargs else None,
+        "labels": json.dumps(labels) if labels else None,
+      }
+      headers = {"Content-Type": "application/x-tar", "Content-Length": str(context_size)}
+      for message in self.stream("POST", "/build", params=params, body=context, headers=headers):
+        if "error" in message:
+          raise DockerAPIError(500, message["error"].strip())
+        output = message.get("stream") or message.get("status")
+        if output and on_output:
+          for line in output.rstrip("\n").splitlines():
+            on_output(line)
+
+  def _build_image_buildkit(self, context_dir, dockerfile, tag, buildargs, labels, on_output):
+    command = ["docker", "build", "--progress=plain", "-f", str(dockerfile), "-t", tag]
+    for key, value in (buildargs or {}).items():
+      command += ["--build-arg", f"{key}={value}"]
+    for key, value in (labels or {}).items():
+      command += ["--label", f"{key}={value}"]
+    command.append(str(context_dir))
+
+    env = dict(os.environ, DOCKER_BUILDKIT="1", DOCKER_HOST=self.base_url.replace("http://", "tcp://", 1))
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    # Keep the end of the output for the error message
+    last_lines = []
+    for line in process.stdout:
+      line = line.rstrip("\n")
+      last_lines = (last_lines + [line])[-10:]
+      if on_output:
+        on_output(line)
+    if process.wait() != 0:
+      raise DockerAPIError(500, "\n".join(last_lines))
+
+
+def _ignored_names(dockerfile):
+  """
+  Names of the files and directories excluded from the build context by the <dockerfile>.dockerignore file.
+  Only the "**/name" and "name" patterns are supported.
+  """
+  ignore_file = Path(f"{dockerfile}.dockerignore")
+  if not ignore_file.exists():
+    return set()
+  lines = [line.strip() for line in ignore_file.read_text().splitlines()]
+  return {line.removeprefix("**/") for line in lines if line and not line.startswith("#")}
+
+
+# Shared client for the local docker daemon.
+docker_client = DockerClient()
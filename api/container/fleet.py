@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+import logging
+from urllib.parse import urlparse, parse_qsl
+
+from api.container.docker_api import DockerClient, docker_client, DOCKER_HOST
+
+# Fleet of docker hosts running the containers.
+#
+# Each new container is placed on one of the hosts, according to their capacity in CPUs, memory and number
+# of containers, and to the resources reserved by the containers running on them. The images are built by
+# the docker host of the manager (DOCKER_HOST), and copied to the other hosts the first time a container of
+# the image is placed on them. The supervisors are reached at the address of their host, on the published port.
+
+# Comma separated docker hosts, e.g. unix:///var/run/docker.sock,tcp://10.0.0.5:2375
+# Per host options can be given as query parameters: cpus, memory (in bytes) and max_containers, which
+# default to the CPUs and memory reported by the daemon and to DOCKER_HOST_MAX_CONTAINERS, and address,
+# where the published ports are reached (the host of a tcp URL, localhost for a unix socket by default).
+# e.g. tcp://10.0.0.5:2375?cpus=8&max_containers=20. Defaults to DOCKER_HOST alone.
+DOCKER_HOSTS = os.getenv("DOCKER_HOSTS") or DOCKER_HOST
+# Placement of the new containers: least_loaded spreads them over the hosts, bin_pack fills the most
+# loaded host they fit on first, keeping the other hosts free for large containers or to be scaled down.
+DOCKER_PLACEMENT = os.getenv("DOCKER_PLACEMENT", "least_loaded")
+# Default maximum number of containers per host. 0 for no limit.
+DOCKER_HOST_MAX_CONTAINERS = int(os.getenv("DOCKER_HOST_MAX_CONTAINERS", "0"))
+# Interval in seconds at which the containers running on the hosts are recounted, so that the containers
+# started by the other manager processes are accounted for.
+FLEET_REFRESH_INTERVAL = float(os.getenv("FLEET_REFRESH_INTERVAL", "30"))
+
+# Number of seconds an unreachable host is left out of the placement.
+HOST_RETRY_DELAY = 30
+
+# Labels of the containers started by the manager, with the resources they reserve.
+CONTAINER_LABEL = "launchpad.container"
+CPU_RESERVATION_LABEL = "launchpad.cpus"
+MEMORY_RESERVATION_LABEL = "launchpad.memory"
+
+logger = logging.getLogger(__name__)
+
+
+class NoCapacityError(RuntimeError):
+  """
+  No docker host can take the container.
+  """
+  pass
+
+
+class DockerHost:
+  """
+  A docker daemon of the fleet, with its capacity and the resources reserved by its containers.
+  """
+
+  def __init__(self, url, client=None):
+    url, _, query = url.strip().partition("?")
+    options = dict(parse_qsl(query))
+    parsed = urlparse(url)
+
+    self.url = url
+    self.client = client or DockerClient(url)
+    self.address = options.get("address") or (parsed.hostname if parsed.scheme in ("tcp", "http") else "localhost")
+    self.cpus = float(options["cpus"]) if "cpus" in options else None
+    self.memory = int(options["memory"]) if "memory" in options else None
+    self.max_containers = int(options.get("max_containers", DOCKER_HOST_MAX_CONTAINERS))
+
+    # container_id -> (cpus, memory) reserved by the containers running on the host.
+    self.containers = {}
+    # Reservations of the containers being started.
+    self.pending = {}
+    self.unreachable_until = 0
+    # Images known to be present on the host.
+    self.images = set()
+    self.images_lock = threading.Lock()
+
+  @property
+  def reachable(self):
+    return time.monotonic() >= self.unreachable_until
+
+  def mark_unreachable(self, error):
+    logger.warning(f"Docker host {self.url} is unreachable: {error}")
+    self.unreachable_until = time.monotonic() + HOST_RETRY_DELAY
+
+  def load_capacity(self):
+    """
+    Read the CPUs and memory of the host from the daemon, unless configured.
+    """
+    if self.cpus is None or self.memory is None:
+      info = self.client.info()
+      if self.cpus is None:
+        self.cpus = float(info["NCPU"])
+      if self.memory is None:
+        self.memory = int(info["MemTotal"])
+
+  def reserved(self):
+    reservations = list(self.containers.values()) + list(self.pending.values())
+    return (sum(cpus for cpus, _ in reservations), sum(memory for _, memory in reservations), len(reservations))
+
+  def fits(self, cpus, memory):
+    reserved_cpus, reserved_memory, count = self.reserved()
+    if self.max_containers and count + 1 > self.max_containers:
+      return False
+    return reserved_cpus + cpus <= self.cpus and reserved_memory + memory <= self.memory
+
+  def load(self, cpus=0, memory=0):
+    """
+    Load of the host with an additional container reserving cpus and memory: the highest fraction of
+    its capacity in use, then the number of containers.
+    """
+    reserved_cpus, reserved_memory, count = self.reserved()
+    fractions = [(reserved_cpus + cpus) / self.cpus if self.cpus else 0,
+                 (reserved_memory + memory) / self.memory if self.memory else 0]
+    if self.max_containers:
+      fractions.append((count + 1) / self.max_containers)
+    return (max(fractions), count)
+
+  def stats(self):
+    reserved_cpus, reserved_memory, count = self.reserved()
+    return {
+      'url': self.url,
+      'address': self.address,
+      'reachable': self.reachable,
+      'cpus': self.cpus,
+      'memory': self.memory,
+      'maxContainers': self.max_containers,
+      'containers': count,
+      'reservedCpus': reserved_cpus,
+      'reservedMemory': reserved_memory,
+    }
+
+
+class DockerFleet:
+  """
+  Places the new containers on the docker hosts, and keeps track of the host of each container.
+  """
+
+  def __init__(self, hosts, build_client=docker_client, placement=DOCKER_PLACEMENT):
+    if placement not in ("least_loaded", "bin_pack"):
+      raise ValueError(f"Unsupported DOCKER_PLACEMENT: {placement}")
+    self.hosts = hosts
+    # Docker client of the host building the images.
+    self.build_client = build_client
+    self.placement = placement
+    self._lock = threading.Lock()
+    self._refreshed_at = None
+
+  @classmethod
+  def from_config(cls, hosts=DOCKER_HOSTS):
+    # The host building the images shares the client of the builder.
+    return cls([DockerHost(url, docker_client if url.partition("?")[0].strip() == DOCKER_HOST else None)
+                for url in hosts.split(",") if url.strip()])
+
+  def host_of(self, container_id):
+    """
+    Returns the host running the container, or None if unknown.
+    Docker reports either short (12 chars) or full ids, so they are compared by prefix.
+    """
+    self.refresh()
+    with self._lock:
+      for host in self.hosts:
+        for known_id in host.containers:
+          if known_id.startswith(container_id) or container_id.startswith(known_id):
+            return host
+    return None
+
+  def refresh(self, force=False):
+    """
+    Recount the containers running on the hosts, at most every FLEET_REFRESH_INTERVAL seconds.
+    """
+    with self._lock:
+      now = time.monotonic()
+      if not force and self._refreshed_at is not None and now - self._refreshed_at < FLEET_REFRESH_INTERVAL:
+        return
+      self._refreshed_at = now
+
+    for host in self.hosts:
+      if not host.reachable:
+        continue
+      try:
+        host.load_capacity()
+        containers = host.client.list_containers(filters={"label": [CONTAINER_LABEL], "status": ["running"]})
+      except Exception as e:
+        host.mark_unreachable(e)
+        continue
+      running = {}
+      for container in containers:
+        labels = container.get("Labels") or {}
+        running[container["Id"]] = (float(labels.get(CPU_RESERVATION_LABEL, 0)),
+                                    int(labels.get(MEMORY_RESERVATION_LABEL, 0)))
+      with self._lock:
+        host.containers = running
+
+  def _candidates(self, cpus, memory):
+    """
+    Hosts the container fits on, by order of preference.
+    """
+    with self._lock:
+      hosts = [host for host in self.hosts if host.reachable and host.cpus is not None and host.fits(cpus, memory)]
+      hosts.sort(key=lambda host: host.load(cpus, memory), reverse=self.placement == "bin_pack")
+      return hosts
+
+  def start_container(self, image_name, exposed_port, env=None, cpus=0, memory=0, host_config=None, name=None):
+    """
+    Start a container from the image on the preferred host it fits on, reserving cpus and memory on it.
+    Without reservations, the hosts are loaded by number of containers.
+    Returns the tuple (host, container_id). Raises NoCapacityError if it fits on no host.
+    """
+    self.refresh()
+    for host in self._candidates(cpus, memory):
+      token = object()
+      with self._lock:
+        # The load may have changed since the candidates were sorted.
+        if not host.fits(cpus, memory):
+          continue
+        host.pending[token] = (cpus, memory)
+      try:
+        self.ensure_image(host, image_name)
+        labels = {
+          CONTAINER_LABEL: "1",
+          CPU_RESERVATION_LABEL: str(cpus),
+          MEMORY_RESERVATION_LABEL: str(memory),
+        }
+        container_id = host.client.run_container(image_name, exposed_port, env=env, labels=labels,
+                                                 host_config=host_config, name=name)
+      except OSError as e:
+        # Try the next host.
+        host.mark_unreachable(e)
+        continue
+      except RuntimeError as e:
+        logger.error(f"Failed to start a container of image {image_name} on docker host {host.url}: {str(e)}")
+        continue
+      finally:
+        with self._lock:
+          host.pending.pop(token, None)
+
+      with self._lock:
+        host.containers[container_id] = (cpus, memory)
+      logger.info(f"Placed container {container_id} of image {image_name} on docker host {host.url}")
+      return (host, container_id)
+
+    raise NoCapacityError(f"No docker host has the capacity to run a container of image {image_name}")
+
+  def ensure_image(self, host, image_name):
+    """
+    Copy the image from the build host to the host, if not present.
+    """
+    if host.client is self.build_client or image_name in host.images:
+      return
+    with host.images_lock:
+      if image_name in host.images:
+        return
+      if not host.client.list_images(filters={"reference": [image_name]}):
+        logger.info(f"Copying image {image_name} to docker host {host.url}")
+        host.client.load_image(self.build_client.export_image(image_name))
+      host.images.add(image_name)
+
+  def release(self, container_id):
+    """
+    Release the reservation of a container that is gone.
+    """
+    with self._lock:
+      for host in self.hosts:
+        for known_id in list(host.containers):
+          if known_id.startswith(container_id) or container_id.startswith(known_id):
+            del host.containers[known_id]
+
+  def stats(self):
+    self.refresh()
+    with self._lock:
+      return {'placement': self.placement, 'hosts': [host.stats() for host in self.hosts]}
@@ -1,104 +1,294 @@
-import requests
-import subprocess
-import time
+import os
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from api.callbacks import get_ready_callback_url
+from api.container.docker_api import docker_client, DockerAPIError
+from api.container.fleet import DockerFleet, NoCapacityError
+from api.container.pool import WarmPool
+from api.container.readiness import ReadinessTracker, SupervisorNotReadyError, READINESS_TIMEOUT
+from api.container.registry import ContainerRegistry
+from api.container.resources import get_resource_profile
+from api.container.supervisor_client import get_supervisor_client, SupervisorUnavailableError
 
 SUPERVISOR_PORT = 4000
 
+# Maximum number of containers running an image. Once the runs of all its containers use all their slots
+# (MAX_CONCURRENT_RUNS of the supervisors), another container is started, up to this number.
+MAX_CONTAINERS_PER_IMAGE = int(os.getenv("MAX_CONTAINERS_PER_IMAGE", "1"))
+
+# Name prefix of the containers warming up or waiting in a warm pool. Docker labels can't change once the
+# container is created, the name can: warm containers are renamed when handed over, so that no manager
+# process uses them before.
+WARM_CONTAINER_PREFIX = "launchpad-warm-"
+
+# Timeout in seconds of a single supervisor health probe.
+READINESS_PROBE_TIMEOUT = 0.5
+# Maximum number of supervisors asked for their load concurrently, by all the run starts of the process.
+CONTAINER_LOAD_CONCURRENCY = 32
+
 # Utilities to manage docker containers.
-# Calling the docker cli directly. In the future consider using a library like docker-py.
+# Talking to the docker daemons through their HTTP API, see docker_api.py.
+# Containers are identified by the tuple (container_id, port, host) where port is the port of the docker
+# host mapped to the container's port SUPERVISOR_PORT, and host the address of the docker host.
 
 logger = logging.getLogger(__name__)
 
-def get_running_container_info(image_name):
-  """
-  Check if a container is already running for the given image.
-  Returns a tuple (container_id, port) where port is the host port mapped to container's port SUPERVISOR_PORT.
-  """
-  check_running = subprocess.run(
-    ["docker", "ps", "--filter", f"ancestor={image_name}", "--format", "{{.ID}}"],
-    capture_output=True,
-    text=True,
-    check=True
-  )
-  
-  # If we find a running container, get its ID and mapped port
-  if check_running.stdout.strip():
-    container_id = check_running.stdout.strip()
-    # Get the port mapping for this container
-    port_result = subprocess.run(
-      ["docker", "port", container_id, str(SUPERVISOR_PORT)],
-      capture_output=True,
-      text=True,
-      check=True
-    )
-    # Extract the port number from output like "0.0.0.0:49153"
-    port = port_result.stdout.strip().split(":")[-1]
-    return (container_id, port)
-  
-  return None
-    
+# Docker hosts the containers are placed on.
+fleet = DockerFleet.from_config()
+
+
+def get_running_containers_info(image_name):
+  """
+  Look up the containers running the given image, on all the docker hosts.
+  Returns a list of tuples (container_id, port, host).
+  """
+  containers_info = []
+  for docker_host in fleet.hosts:
+    if not docker_host.reachable:
+      continue
+    try:
+      containers = docker_host.client.list_containers(filters={"ancestor": [image_name], "status": ["running"]})
+    except OSError as e:
+      docker_host.mark_unreachable(e)
+      continue
 
+    for container in containers:
+      # Skip the containers warming up or waiting in the warm pool of any manager process
+      if any(name.lstrip("/").startswith(WARM_CONTAINER_PREFIX) for name in container.get("Names") or []):
+        continue
+      # The port mappings are part of the listing, no need to inspect the container.
+      for port in container.get("Ports", []):
+        if port.get("PrivatePort") == SUPERVISOR_PORT and port.get("PublicPort"):
+          containers_info.append((container["Id"], str(port["PublicPort"]), docker_host.address))
+          break
 
+  return containers_info
 
-# Check if a container is already running for the given image.
-# If not, start a new container.
-def get_or_start_container(image_name):
+
+def start_container(image_name, profile=None, warm=False):
+  """
+  Start a new container from the given image, on the docker host chosen by the fleet, with the limits
+  of the resource profile (default profile if None). Warm containers are not used until handed over.
+  Returns a tuple (container_id, port, host). Raises NoCapacityError if no docker host has the capacity.
+  """
+  profile = profile or get_resource_profile()
+
+  # Let the supervisor notify the manager as soon as it is ready
+  env = {}
+  ready_callback_url = get_ready_callback_url()
+  if ready_callback_url:
+    env["LAUNCHPAD_READY_URL"] = ready_callback_url
+  if profile.max_runs:
+    env["MAX_CONCURRENT_RUNS"] = str(profile.max_runs)
+
+  # Bind port SUPERVISOR_PORT of the container (supervisor port) to a random port of the docker host
+  name = f"{WARM_CONTAINER_PREFIX}{uuid.uuid4().hex[:12]}" if warm else None
+  docker_host, container_id = fleet.start_container(image_name, SUPERVISOR_PORT, env=env, cpus=profile.cpus,
+                                                    memory=profile.memory, host_config=profile.host_config(),
+                                                    name=name)
+
+  # Get the port mapping for the new container
+  port = docker_host.client.container_host_port(container_id, SUPERVISOR_PORT)
+  return (container_id, port, docker_host.address)
+
+
+def stop_container(container_id):
   """
-  Start a container from the given image.
-  Returns a tuple (container_id, port) where port is the host port mapped to container's port SUPERVISOR_PORT.
+  Stop and remove the container, releasing its reservation right away rather than on its destroy event.
   """
+  docker_host = fleet.host_of(container_id)
+  client = docker_host.client if docker_host else docker_client
+  client.remove_container(container_id, force=True)
+  fleet.release(container_id)
+
+
+def start_warm_container(image_name, profile=None):
+  return start_container(image_name, profile, warm=True)
+
+
+def hand_over_container(container_id):
+  """
+  Rename a warm container being handed over, so that it is used like the other containers.
+  """
+  docker_host = fleet.host_of(container_id)
+  client = docker_host.client if docker_host else docker_client
+  client.rename_container(container_id, f"launchpad-{uuid.uuid4().hex[:12]}")
+
+
+def probe_supervisor(supervisor_port, supervisor_host="localhost"):
+  return get_supervisor_client(supervisor_port, supervisor_host).is_healthy(timeout=READINESS_PROBE_TIMEOUT)
+
+
+# Supervisors of the containers being started, probed with backoff or notified ready.
+readiness_tracker = ReadinessTracker(probe_supervisor)
+
+
+def wait_for_container_supervisor(container_id, supervisor_port, supervisor_host="localhost", timeout=READINESS_TIMEOUT):
+  """
+  Wait for the supervisor API to become available in the container.
+  Raises RuntimeError after the timeout: the container is not healthy, see remove_unhealthy_container.
+  Use readiness_tracker.wait_until_ready directly to wait without blocking the calling thread.
+  """
+  future = readiness_tracker.wait_until_ready(container_id, supervisor_port, supervisor_host, timeout=timeout)
   try:
-    # First check if there is already a container running
-    container_info = get_running_container_info(image_name)
-    if container_info:
+    future.result(timeout=timeout + 1)
+  except (SupervisorNotReadyError, FutureTimeoutError) as e:
+    raise RuntimeError(f"Supervisor API did not become available in time: {e}")
+  logger.info("Supervisor API is healthy.")
+
+
+def remove_unhealthy_container(container_id):
+  """
+  Stop a container whose supervisor did not become healthy, so that the next runs don't use it.
+  """
+  logger.warning(f"Supervisor of container {container_id} is not healthy, stopping the container")
+  container_registry.invalidate_container(container_id)
+  try:
+    stop_container(container_id)
+  except (RuntimeError, OSError) as e:
+    logger.error(f"Failed to stop unhealthy container {container_id}: {str(e)}")
+
+
+# Cache of the running containers, to avoid calling the docker daemon on every request.
+container_registry = ContainerRegistry(get_running_containers_info,
+                                       docker_clients=[docker_host.client for docker_host in fleet.hosts])
+
+# Containers started ahead of time, ready to be handed over.
+warm_pool = WarmPool(start_warm_container, stop_container, wait_for_container_supervisor, hand_over_container)
+container_registry.on_container_gone(warm_pool.discard)
+container_registry.on_container_gone(readiness_tracker.mark_gone)
+container_registry.on_container_gone(fleet.release)
+container_registry.on_container_healthy(readiness_tracker.mark_ready)
+
+
+def get_container_load(container_info):
+  """
+  Load of the container reported by its supervisor: {"running": n, "queued": n, "maxConcurrent": n}.
+  Returns None if the supervisor can't be reached.
+  """
+  try:
+    response = get_supervisor_client(*container_info[1:]).get('/api/health')
+  except SupervisorUnavailableError:
+    return None
+  if response.status_code != 200:
+    return None
+  # Supervisors of images built before the run scheduler run all their runs at once.
+  return response.json().get('runs') or {"running": 0, "queued": 0, "maxConcurrent": 0}
+
+
+# Threads asking the supervisors of an image for their load.
+load_executor = ThreadPoolExecutor(max_workers=CONTAINER_LOAD_CONCURRENCY, thread_name_prefix="container_load")
+
+
+def get_container_loads(containers):
+  """
+  Load of each of the containers, asked to their supervisors concurrently. None for the supervisors that
+  can't be reached.
+  """
+  if len(containers) == 1:
+    return [get_container_load(containers[0])]
+  return list(load_executor.map(get_container_load, containers))
+
+
+def get_free_slots(load):
+  """
+  Number of runs the container can start right away, according to its load.
+  """
+  if not load["maxConcurrent"]:
+    return float("inf")
+  return load["maxConcurrent"] - load["running"] - load["queued"]
+
+
+def find_container(image_name, container_id=None):
+  """
+  Returns the tuple (container_id, port, host) of the running container of the image with the given id,
+  or of any running container of the image if no id is given. None if there is no such container.
+  """
+  containers = container_registry.get(image_name)
+  if container_id is None:
+    return containers[0] if containers else None
+  for container_info in containers:
+    if container_info[0].startswith(container_id) or container_id.startswith(container_info[0]):
       return container_info
-    
-    # If not, start a new container.
-    # Bind port SUPERVISOR_PORT of the container (supervisor port) to a random port on localhost
-    start_result = subprocess.run(
-      ["docker", "run", "-d", "-p", f":{SUPERVISOR_PORT}", image_name],
-      capture_output=True,
-      text=True,
-      check=True
-    )
-    
-    container_id = start_result.stdout.strip()
-    # Get the port mapping for the new container
-    port_result = subprocess.run(
-      ["docker", "port", container_id, "4000"],
-      capture_output=True,
-      text=True,
-      check=True
-    )
-    # Extract the port number from output
-    port = port_result.stdout.strip().split(":")[-1]
-    return (container_id, port)
-    
-  except subprocess.CalledProcessError as e:
-    raise RuntimeError(f"Failed to start container: {e}")
+  return None
+
 
-def wait_for_container_supervisor(supervisor_port):
+def is_container_gone(image_name, container_id=None):
   """
-  Wait for the supervisor API to become available in the container.
-  Timesout after 30 seconds, which indicates the container may not be healthy
-  and an action should be attempted (stop + restart?) to recover.
-  """
-  supervisor_health_url = f"http://localhost:{supervisor_port}/api/health"
-  
-  timeout = 30
-  start_time = time.time()
-  
-  while time.time() - start_time < timeout:
+  Returns True if docker confirms that the container is not running anymore: not found, or exited.
+  Without container id, confirms that no container of the image is running.
+  Returns False if the container is running, or if it can't be confirmed, e.g. a docker host is unreachable.
+  """
+  if container_id is None:
+    if not all(docker_host.reachable for docker_host in fleet.hosts):
+      return False
+    # Not from the registry: a fresh listing of all the hosts.
+    containers = get_running_containers_info(image_name)
+    return not containers and all(docker_host.reachable for docker_host in fleet.hosts)
+
+  docker_host = fleet.host_of(container_id)
+  for docker_host in [docker_host] if docker_host else fleet.hosts:
+    if not docker_host.reachable:
+      return False
     try:
-      response = requests.get(supervisor_health_url)
-      if response.status_code == 200:
-        logger.info("Supervisor API is healthy.")
-        return
-    except requests.ConnectionError:
-      logger.warning("Connection error while waiting for supervisor API. Will retry...")
-      pass
-    
-    time.sleep(1)
-  
-  raise RuntimeError("Supervisor API did not become available in time.")
+      container = docker_host.client.inspect_container(container_id)
+    except DockerAPIError as e:
+      if e.status == 404:
+        continue
+      return False
+    except OSError as e:
+      docker_host.mark_unreachable(e)
+      return False
+    return not container.get("State", {}).get("Running", False)
+  return True
+
+
+# Check if a container is already running for the given image, with a free run slot.
+# If not, take a warm container from the pool or start a new container.
+def get_or_start_container(image_name, profile=None):
+  """
+  Get a running container for the given image to start a run, starting one with the resource profile if needed.
+  The runs are spread over the containers of the image by their load, and a container is started once all
+  are busy, up to MAX_CONTAINERS_PER_IMAGE. Runs beyond the capacity of the containers queue in the least
+  loaded one.
+  Returns a tuple (container_id, port, host). Raises NoCapacityError if no docker host has the capacity
+  to start one.
+  """
+  try:
+    # First check if there is already a container running
+    warm_pool.touch(image_name, profile)
+    containers = container_registry.get(image_name)
+    if containers and MAX_CONTAINERS_PER_IMAGE <= 1:
+      return containers[0]
+
+    least_loaded = None
+    if containers:
+      loads = zip(get_container_loads(containers), containers)
+      loads = [(get_free_slots(load), container_info) for load, container_info in loads if load is not None]
+      # The supervisors not reachable are not considered, unless none is.
+      free_slots, least_loaded = max(loads, key=lambda load: load[0]) if loads else (0, containers[0])
+      if free_slots > 0 or len(containers) >= MAX_CONTAINERS_PER_IMAGE:
+        return least_loaded
+      logger.info(f"The {len(containers)} containers of image {image_name} are busy, starting another one")
+
+    # Then hand over a warm container, already started and healthy.
+    # If there is none, start a new container.
+    container_info = warm_pool.acquire(image_name)
+    if not container_info:
+      try:
+        container_info = start_container(image_name, profile)
+      except NoCapacityError:
+        if least_loaded is None:
+          raise
+        # Queue the run in the existing containers rather than waiting for a docker host.
+        return least_loaded
+
+    container_registry.put(image_name, *container_info)
+    return container_info
+
+  except NoCapacityError:
+    raise
+  except (RuntimeError, OSError) as e:
+    raise RuntimeError(f"Failed to start container: {e}")
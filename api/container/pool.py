@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+
+# Number of idle containers, with a healthy supervisor, kept ready for each image. 0 disables the pool.
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "0"))
+# Maximum number of images with warm containers. The least recently used images are evicted first.
+WARM_POOL_MAX_IMAGES = int(os.getenv("WARM_POOL_MAX_IMAGES", "10"))
+# Number of seconds after which the warm containers of an image that was not used are stopped.
+WARM_POOL_IDLE_TIMEOUT = float(os.getenv("WARM_POOL_IDLE_TIMEOUT", "1800"))
+# Maximum interval in seconds between two checks of the pool by the refill thread.
+WARM_POOL_REFILL_INTERVAL = float(os.getenv("WARM_POOL_REFILL_INTERVAL", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class WarmPool:
+  """
+  Pool of pre-started containers per image, so that starting a run is a hand-off rather than a boot.
+  A background thread refills the pool, and evicts the images by LRU order and idle time.
+  """
+
+  def __init__(self, start_container, stop_container, wait_until_ready, hand_over, size=WARM_POOL_SIZE,
+               max_images=WARM_POOL_MAX_IMAGES, idle_timeout=WARM_POOL_IDLE_TIMEOUT):
+    # start_container(image_name, profile) -> (container_id, port, host), started marked as warm, so that
+    # it is not used before being handed over.
+    # stop_container(container_id)
+    # wait_until_ready(container_id, port, host) raises if the supervisor of the container does not become healthy.
+    # hand_over(container_id) removes the warm mark of the container.
+    self._start_container = start_container
+    self._stop_container = stop_container
+    self._wait_until_ready = wait_until_ready
+    self._hand_over = hand_over
+    self.size = size
+    self.max_images = max_images
+    self.idle_timeout = idle_timeout
+
+    # image_name -> {'idle': deque of (container_id, port, host), 'profile': resource profile, 'last_used': monotonic time}
+    # Ordered from the least to the most recently used image.
+    self._images = OrderedDict()
+    self._condition = threading.Condition()
+    self._refill_thread = None
+
+  @property
+  def enabled(self):
+    return self.size > 0
+
+  def touch(self, image_name, profile=None):
+    """
+    Record the use of the image, registering it in the pool if needed.
+    The warm containers of the image are started with the resource profile, if given.
+    """
+    if not self.enabled:
+      return
+    with self._condition:
+      entry = self._images.get(image_name)
+      if entry is None:
+        entry = {'idle': deque(), 'profile': None}
+        self._images[image_name] = entry
+        self._condition.notify()
+      if profile is not None:
+        entry['profile'] = profile
+      entry['last_used'] = time.monotonic()
+      self._images.move_to_end(image_name)
+    self._start_refill_thread()
+
+  def acquire(self, image_name):
+    """
+    Take a warm container of the image out of the pool.
+    Returns the tuple (container_id, port, host), or None if there is no warm container available.
+    """
+    if not self.enabled:
+      return None
+    self.touch(image_name)
+    with self._condition:
+      idle = self._images[image_name]['idle']
+      if not idle:
+        return None
+      container_info = idle.popleft()
+      # Wake up the refill thread to replace the container.
+      self._condition.notify()
+    logger.info(f"Handing over warm container {container_info[0]} of image {image_name}")
+    try:
+      self._hand_over(container_info[0])
+    except Exception as e:
+      logger.error(f"Failed to hand over warm container {container_info[0]}: {str(e)}")
+      try:
+        self._stop_container(container_info[0])
+      except Exception as e:
+        logger.error(f"Failed to stop warm container {container_info[0]}: {str(e)}")
+      return None
+    return container_info
+
+  def discard(self, container_id):
+    """
+    Remove a container that is gone from the pool.
+    """
+    with self._condition:
+      for entry in self._images.values():
+        for container_info in list(entry['idle']):
+          if container_info[0].startswith(container_id) or container_id.startswith(container_info[0]):
+            entry['idle'].remove(container_info)
+            self._condition.notify()
+
+  def evict_one(self):
+    """
+    Stop a warm container of the least recently used image, to free its capacity for a run.
+    Returns True if a container was stopped.
+    """
+    with self._condition:
+      for image_name, entry in self._images.items():
+        if entry['idle']:
+          container_info = entry['idle'].pop()
+          break
+      else:
+        return False
+    logger.info(f"Evicting warm container {container_info[0]} of image {image_name} to free capacity")
+    try:
+      self._stop_container(container_info[0])
+    except Exception as e:
+      logger.error(f"Failed to stop warm container {container_info[0]}: {str(e)}")
+      return False
+    return True
+
+  def _start_refill_thread(self):
+    with self._condition:
+      if self._refill_thread is not None:
+        return
+      self._refill_thread = threading.Thread(target=self._refill_loop, name="warm_pool_refill", daemon=True)
+    self._refill_thread.start()
+
+  def _refill_loop(self):
+    while True:
+      try:
+        self._evict()
+        image_name = self._next_image_to_refill()
+        if image_name is not None:
+          self._add_container(image_name)
+          continue
+      except Exception as e:
+        logger.error(f"Error while refilling the warm pool: {str(e)}")
+
+      with self._condition:
+        self._condition.wait(timeout=WARM_POOL_REFILL_INTERVAL)
+
+  def _next_image_to_refill(self):
+    # Refill the most recently used images first.
+    with self._condition:
+      for image_name in reversed(self._images):
+        if len(self._images[image_name]['idle']) < self.size:
+          return image_name
+    return None
+
+  def _add_container(self, image_name):
+    logger.info(f"Starting warm container for image {image_name}")
+    with self._condition:
+      profile = self._images[image_name]['profile'] if image_name in self._images else None
+    container_info = self._start_container(image_name, profile)
+    container_id = container_info[0]
+    try:
+      self._wait_until_ready(*container_info)
+    except Exception as e:
+      logger.error(f"Warm container {container_id} of image {image_name} did not become ready: {str(e)}")
+      self._stop_container(container_id)
+      raise
+
+    with self._condition:
+      entry = self._images.get(image_name)
+      if entry is not None:
+        entry['idle'].append(container_info)
+        return
+    # The image was evicted while the container was starting.
+    self._stop_container(container_id)
+
+  def _evict(self):
+    """
+    Stop the warm containers of the images idle for too long, and of the least recently used images
+    beyond the maximum number of images.
+    """
+    evicted = []
+    now = time.monotonic()
+    with self._condition:
+      for image_name, entry in list(self._images.items()):
+        if now - entry['last_used'] > self.idle_timeout or len(self._images) > self.max_images:
+          evicted.append((image_name, list(entry['idle'])))
+          del self._images[image_name]
+
+    for image_name, containers in evicted:
+      logger.info(f"Evicting image {image_name} from the warm pool")
+      for container_id, *_ in containers:
+        try:
+          self._stop_container(container_id)
+        except Exception as e:
+          logger.error(f"Failed to stop warm container {container_id}: {str(e)}")
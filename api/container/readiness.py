@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+# Delay in seconds before the first probe of a starting supervisor. Doubles after each failed probe,
+# up to READINESS_MAX_DELAY.
+READINESS_INITIAL_DELAY = float(os.getenv("READINESS_INITIAL_DELAY", "0.005"))
+READINESS_MAX_DELAY = float(os.getenv("READINESS_MAX_DELAY", "0.5"))
+# Number of seconds after which a supervisor that did not become ready is considered unhealthy.
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class SupervisorNotReadyError(RuntimeError):
+  pass
+
+
+class ReadinessTracker:
+  """
+  Tracks the containers whose supervisor is starting.
+  A single prober thread probes all the pending supervisors with exponential backoff. Readiness can also
+  be pushed, by the supervisor calling the manager or by the docker HEALTHCHECK status.
+  Waiters get a concurrent.futures.Future (awaitable with asyncio.wrap_future), so that many pending
+  starts can wait concurrently without one polling thread each. The future is shared by the waiters of a
+  container: they must not cancel it, asyncio.shield it.
+  """
+
+  def __init__(self, probe, initial_delay=READINESS_INITIAL_DELAY, max_delay=READINESS_MAX_DELAY):
+    # probe(port, host) -> True if the supervisor listening on host:port is healthy.
+    self._probe = probe
+    self._initial_delay = initial_delay
+    self._max_delay = max_delay
+    # container_id -> {'port', 'host', 'future', 'delay', 'next_probe', 'deadline'}
+    self._pending = {}
+    self._condition = threading.Condition()
+    self._prober = None
+
+  def wait_until_ready(self, container_id, port, host="localhost", timeout=READINESS_TIMEOUT):
+    """
+    Returns a Future resolved once the supervisor of the container is ready, or failed with
+    SupervisorNotReadyError if it is not ready within the timeout.
+    """
+    with self._condition:
+      entry = self._pending.get(container_id)
+      if entry is None:
+        now = time.monotonic()
+        entry = {
+          'port': port,
+          'host': host,
+          'future': Future(),
+          'delay': self._initial_delay,
+          'next_probe': now,
+          'deadline': now + timeout,
+        }
+        self._pending[container_id] = entry
+        self._condition.notify()
+    self._start_prober()
+    return entry['future']
+
+  def mark_ready(self, container_id):
+    """
+    Readiness pushed for the container. Docker may report short (12 chars) or full ids.
+    """
+    self._resolve(container_id, None)
+
+  def mark_gone(self, container_id):
+    """
+    The container stopped, its supervisor will never become ready.
+    """
+    self._resolve(container_id, SupervisorNotReadyError(f"Container {container_id} stopped before being ready"))
+
+  def _resolve(self, container_id, error):
+    with self._condition:
+      matches = [pending_id for pending_id in self._pending
+                 if pending_id.startswith(container_id) or container_id.startswith(pending_id)]
+      entries = [self._pending.pop(pending_id) for pending_id in matches]
+    for entry in entries:
+      # A waiter may have cancelled the future.
+      if entry['future'].done():
+        continue
+      if error is None:
+        entry['future'].set_result(True)
+      else:
+        entry['future'].set_exception(error)
+
+  def _start_prober(self):
+    with self._condition:
+      if self._prober is not None:
+        return
+      self._prober = threading.Thread(target=self._probe_loop, name="supervisor_readiness", daemon=True)
+    self._prober.start()
+
+  def _probe_loop(self):
+    while True:
+      with self._condition:
+        now = time.monotonic()
+        due = [(container_id, entry) for container_id, entry in self._pending.items() if entry['next_probe'] <= now]
+        if not due:
+          next_probe = min((entry['next_probe'] for entry in self._pending.values()), default=None)
+          self._condition.wait(timeout=None if next_probe is None else next_probe - now)
+          continue
+
+      for container_id, entry in due:
+        try:
+          self._probe_entry(container_id, entry)
+        except Exception as e:
+          # The prober serves all the pending containers: never let one of them stop it.
+          logger.error(f"Failed to probe the supervisor of container {container_id}: {str(e)}")
+
+  def _probe_entry(self, container_id, entry):
+    try:
+      ready = self._probe(entry['port'], entry['host'])
+    except Exception:
+      ready = False
+
+    if ready:
+      logger.info(f"Supervisor of container {container_id} is ready.")
+      self.mark_ready(container_id)
+    elif time.monotonic() >= entry['deadline']:
+      self._resolve(container_id, SupervisorNotReadyError(
+        f"Supervisor of container {container_id} did not become available in time."))
+    else:
+      with self._condition:
+        entry['next_probe'] = time.monotonic() + entry['delay']
+        entry['delay'] = min(entry['delay'] * 2, self._max_delay)
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+import logging
+
+from api.container.docker_api import docker_client
+
+# Number of seconds a registry entry is trusted before being revalidated against docker.
+# The docker events stream normally invalidates entries much sooner, the TTL is a safety
+# net for events missed while the stream is (re)connecting.
+CONTAINER_REGISTRY_TTL = float(os.getenv("CONTAINER_REGISTRY_TTL", "30"))
+
+# Container events after which the container can no longer serve requests.
+CONTAINER_GONE_EVENTS = ("die", "stop", "kill", "destroy", "oom")
+
+logger = logging.getLogger(__name__)
+
+
+class ContainerRegistry:
+  """
+  In-process cache mapping an image name to its running containers [(container_id, port, host), ...].
+  Kept current by listening to the docker events stream of each docker host, with TTL-based revalidation
+  as a fallback.
+  """
+
+  def __init__(self, resolve, ttl=CONTAINER_REGISTRY_TTL, docker_clients=None):
+    # resolve(image_name) looks up the running containers of an image from docker.
+    # Returns a list of tuples (container_id, port, host), empty if there is none.
+    self._resolve = resolve
+    self._ttl = ttl
+    self._docker_clients = docker_clients or [docker_client]
+    self._entries = {} # image_name -> ([(container_id, port, host), ...], validated_at)
+    self._lock = threading.Lock()
+    self._listeners = None
+    self._gone_callbacks = []
+    self._healthy_callbacks = []
+
+  def get(self, image_name):
+    """
+    Returns the list of tuples (container_id, port, host) of the containers running the image, empty if none.
+    Answered from memory unless the entry is missing or expired.
+    """
+    self.start_event_listener()
+
+    with self._lock:
+      entry = self._entries.get(image_name)
+    if entry and time.monotonic() - entry[1] < self._ttl:
+      return list(entry[0])
+
+    containers = self._resolve(image_name)
+    with self._lock:
+      if containers:
+        self._entries[image_name] = (list(containers), time.monotonic())
+      else:
+        self._entries.pop(image_name, None)
+    return list(containers)
+
+  def put(self, image_name, container_id, port, host):
+    """
+    Add a container started for the image.
+    """
+    with self._lock:
+      containers = self._entries[image_name][0] if image_name in self._entries else []
+      if not any(container_info[0] == container_id for container_info in containers):
+        containers.append((container_id, port, host))
+      # Not revalidated: the entry expires no later than the containers already known.
+      validated_at = self._entries[image_name][1] if image_name in self._entries else time.monotonic()
+      self._entries[image_name] = (containers, validated_at)
+
+  def invalidate_image(self, image_name):
+    with self._lock:
+      self._entries.pop(image_name, None)
+
+  def invalidate_container(self, container_id):
+    """
+    Drop the given container from the entries.
+    Docker reports either short (12 chars) or full ids, so they are compared by prefix.
+    """
+    with self._lock:
+      for image_name, (containers, _) in list(self._entries.items()):
+        for container_info in list(containers):
+          if container_info[0].startswith(container_id) or container_id.startswith(container_info[0]):
+            logger.info(f"Container {container_info[0]} of image {image_name} is gone. Removing it from the registry.")
+            containers.remove(container_info)
+        if not containers:
+          del self._entries[image_name]
+
+  def on_container_gone(self, callback):
+    """
+    Register a function called with the id of each container reported gone by docker.
+    """
+    self._gone_callbacks.append(callback)
+
+  def on_container_healthy(self, callback):
+    """
+    Register a function called with the id of each container reported healthy by its docker HEALTHCHECK.
+    """
+    self._healthy_callbacks.append(callback)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def start_event_listener(self):
+    """
+    Start the background threads following the docker events stream of each host, if not already started.
+    """
+    with self._lock:
+      if self._listeners is not None:
+        return
+      self._listeners = [threading.Thread(target=self._listen_events, args=(client,),
+                                          name=f"container_registry_events_{i}", daemon=True)
+                         for i, client in enumerate(self._docker_clients)]
+    for listener in self._listeners:
+      listener.start()
+
+  def _listen_events(self, client):
+    backoff = 1
+    while True:
+      try:
+        events = client.events(filters={"type": ["container"]})
+        # Events may have been missed while disconnected.
+        self.clear()
+        backoff = 1
+        for event in events:
+          self._handle_event(event)
+        logger.warning("Docker events stream ended. Reconnecting...")
+      except Exception as e:
+        logger.warning(f"Error while listening to docker events: {str(e)}. Reconnecting...")
+
+      time.sleep(backoff)
+      backoff = min(backoff * 2, 30)
+
+  def _handle_event(self, event):
+    action = event.get("Action") or event.get("status") or ""
+    container_id = event.get("id") or event.get("Actor", {}).get("ID")
+    if container_id and action.split(":")[0] in CONTAINER_GONE_EVENTS:
+      self.invalidate_container(container_id)
+      for callback in self._gone_callbacks:
+        callback(container_id)
+    elif container_id and action.strip() == "health_status: healthy":
+      for callback in self._healthy_callbacks:
+        callback(container_id)
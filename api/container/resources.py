@@ -0,0 +1,81 @@
+import json
+import os
+import logging
+
+# Resource profiles of the agents.
+#
+# The profile of an agent is named by the resourceProfile field of its configuration, "default" otherwise.
+# A profile sets the limits of the containers of the agent, which are also reserved on their docker host
+# for the placement, and the limits of each run within the container, applied by the supervisor.
+
+# JSON object of the profiles by name, e.g.
+# {"default": {"cpus": 1, "memory": 1073741824, "pids": 512}, "large": {"cpus": 4, "memory": 8589934592}}
+# Fields, all optional, 0 for no limit:
+# - cpus: CPU shares of the container (1024 per CPU), and CPUs reserved on the host
+# - memory: memory of the container in bytes, without swap, also reserved on the host
+# - pids: maximum number of processes and threads in the container
+# - runCpus / runMemory / runPids: limits of each run of the container (CPU quota, memory in bytes, pids)
+# - maxRuns: maximum number of runs executing concurrently in a container, the others are queued by its
+#   supervisor (default: MAX_CONCURRENT_RUNS of the supervisor)
+RESOURCE_PROFILES = json.loads(os.getenv("RESOURCE_PROFILES") or "{}")
+DEFAULT_RESOURCE_PROFILE = "default"
+
+# Number of CPU shares of a container using a full CPU.
+CPU_SHARES_PER_CPU = 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceProfile:
+  """
+  Limits of the containers of an agent, and of each of its runs.
+  """
+
+  def __init__(self, name, spec=None):
+    spec = spec or {}
+    self.name = name
+    self.cpus = float(spec.get("cpus", 0))
+    self.memory = int(spec.get("memory", 0))
+    self.pids = int(spec.get("pids", 0))
+    self.run_cpus = float(spec.get("runCpus", 0))
+    self.run_memory = int(spec.get("runMemory", 0))
+    self.run_pids = int(spec.get("runPids", 0))
+    self.max_runs = int(spec.get("maxRuns", 0))
+
+  def host_config(self):
+    """
+    Docker HostConfig limits of the containers.
+    """
+    host_config = {}
+    if self.cpus:
+      host_config["CpuShares"] = int(self.cpus * CPU_SHARES_PER_CPU)
+    if self.memory:
+      host_config["Memory"] = self.memory
+      # No swap on top of the memory limit.
+      host_config["MemorySwap"] = self.memory
+    if self.pids:
+      host_config["PidsLimit"] = self.pids
+    return host_config
+
+  def run_limits(self):
+    """
+    Limits of each run, sent to the supervisor when starting the run.
+    """
+    limits = {"cpus": self.run_cpus, "memory": self.run_memory, "pids": self.run_pids}
+    return {key: value for key, value in limits.items() if value}
+
+
+_profiles = {name: ResourceProfile(name, spec) for name, spec in RESOURCE_PROFILES.items()}
+_profiles.setdefault(DEFAULT_RESOURCE_PROFILE, ResourceProfile(DEFAULT_RESOURCE_PROFILE))
+
+
+def get_resource_profile(agent_config=None):
+  """
+  Returns the resource profile of the agent with the given configuration.
+  """
+  name = (agent_config or {}).get("resourceProfile") or DEFAULT_RESOURCE_PROFILE
+  profile = _profiles.get(name)
+  if profile is None:
+    logger.warning(f"Unknown resource profile {name}, using the {DEFAULT_RESOURCE_PROFILE} profile")
+    profile = _profiles[DEFAULT_RESOURCE_PROFILE]
+  return profile
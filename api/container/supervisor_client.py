@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# HTTP client for the supervisor API running in the agent containers.
+# Keeps one keep-alive session per supervisor, so polls reuse their TCP connections,
+# and bounds every call with timeouts so a hung container cannot pin a Flask worker.
+
+SUPERVISOR_CONNECT_TIMEOUT = float(os.getenv("SUPERVISOR_CONNECT_TIMEOUT", "2"))
+SUPERVISOR_READ_TIMEOUT = float(os.getenv("SUPERVISOR_READ_TIMEOUT", "10"))
+# Read timeout of the streaming calls, i.e. maximum interval between two chunks of the stream.
+# The supervisor sends keepalives on idle streams.
+SUPERVISOR_STREAM_READ_TIMEOUT = float(os.getenv("SUPERVISOR_STREAM_READ_TIMEOUT", "60"))
+# Number of retries, with exponential backoff, on connection errors and 502/503/504 responses.
+# Reads are only retried for idempotent requests.
+SUPERVISOR_RETRIES = int(os.getenv("SUPERVISOR_RETRIES", "2"))
+SUPERVISOR_BACKOFF_FACTOR = float(os.getenv("SUPERVISOR_BACKOFF_FACTOR", "0.1"))
+# Maximum number of connections kept open to a single supervisor.
+SUPERVISOR_POOL_SIZE = int(os.getenv("SUPERVISOR_POOL_SIZE", "10"))
+# Number of consecutive failures after which calls to a supervisor fail fast,
+# and number of seconds before a call is let through again to probe it.
+SUPERVISOR_CIRCUIT_THRESHOLD = int(os.getenv("SUPERVISOR_CIRCUIT_THRESHOLD", "5"))
+SUPERVISOR_CIRCUIT_RESET = float(os.getenv("SUPERVISOR_CIRCUIT_RESET", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class SupervisorUnavailableError(RuntimeError):
+  """
+  The supervisor could not be reached, timed out or its circuit breaker is open.
+  """
+  pass
+
+
+class CircuitBreaker:
+  """
+  Fails calls fast after too many consecutive failures, until the reset period expires.
+  """
+
+  def __init__(self, threshold=SUPERVISOR_CIRCUIT_THRESHOLD, reset_after=SUPERVISOR_CIRCUIT_RESET):
+    self.threshold = threshold
+    self.reset_after = reset_after
+    self.failures = 0
+    self.opened_at = None
+    self._lock = threading.Lock()
+
+  def allow(self):
+    with self._lock:
+      if self.opened_at is None:
+        return True
+      # Half open: let calls through again once the reset period expired.
+      # A single failure re-opens the circuit.
+      return time.monotonic() - self.opened_at >= self.reset_after
+
+  def record_success(self):
+    with self._lock:
+      self.failures = 0
+      self.opened_at = None
+
+  def record_failure(self):
+    with self._lock:
+      self.failures += 1
+      if self.failures >= self.threshold:
+        self.opened_at = time.monotonic()
+
+
+class SupervisorClient:
+  """
+  Client for the supervisor API of a single container.
+  """
+
+  def __init__(self, port, host="localhost"):
+    self.base_url = f"http://{host}:{port}"
+    self.timeout = (SUPERVISOR_CONNECT_TIMEOUT, SUPERVISOR_READ_TIMEOUT)
+    self.circuit_breaker = CircuitBreaker()
+
+    retry = Retry(
+      total=SUPERVISOR_RETRIES,
+      backoff_factor=SUPERVISOR_BACKOFF_FACTOR,
+      status_forcelist=(502, 503, 504),
+      raise_on_status=False
+    )
+    self.session = requests.Session()
+    self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=SUPERVISOR_POOL_SIZE, max_retries=retry))
+    # Health probes must fail fast, without retries.
+    self.probe_session = requests.Session()
+    self.probe_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+    self._async_client = None
+
+  def request(self, method, path, **kwargs):
+    """
+    Call the supervisor API. Returns the response, whatever its status code.
+    Raises SupervisorUnavailableError if the supervisor can not be reached.
+    """
+    if not self.circuit_breaker.allow():
+      raise SupervisorUnavailableError(f"Supervisor at {self.base_url} is unavailable (circuit open)")
+
+    kwargs.setdefault("timeout", self.timeout)
+    try:
+      response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+    except requests.RequestException as e:
+      self.circuit_breaker.record_failure()
+      raise SupervisorUnavailableError(f"Supervisor at {self.base_url} is unavailable: {e}")
+
+    if response.status_code >= 500:
+      self.circuit_breaker.record_failure()
+    else:
+      self.circuit_breaker.record_success()
+    return response
+
+  def get(self, path, **kwargs):
+    return self.request("GET", path, **kwargs)
+
+  def post(self, path, **kwargs):
+    return self.request("POST", path, **kwargs)
+
+  def stream(self, path, **kwargs):
+    """
+    Call a streaming endpoint. The response body must be consumed, then closed, by the caller.
+    """
+    kwargs.setdefault("timeout", (SUPERVISOR_CONNECT_TIMEOUT, SUPERVISOR_STREAM_READ_TIMEOUT))
+    return self.request("GET", path, stream=True, **kwargs)
+
+  # Async variants, used by the ASGI serving mode. They share the circuit breaker of the client.
+
+  @property
+  def async_client(self):
+    """
+    httpx.AsyncClient for the supervisor, created on first use. Must be used from a single event loop.
+    """
+    if self._async_client is None:
+      import httpx
+      self._async_client = httpx.AsyncClient(
+        base_url=self.base_url,
+        timeout=httpx.Timeout(SUPERVISOR_READ_TIMEOUT, connect=SUPERVISOR_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_keepalive_connections=SUPERVISOR_POOL_SIZE),
+        # Retries connection failures only.
+        transport=httpx.AsyncHTTPTransport(retries=SUPERVISOR_RETRIES),
+      )
+    return self._async_client
+
+  async def arequest(self, method, path, stream=False, **kwargs):
+    """
+    Async variant of request(). With stream, the response body must be consumed, then closed
+    (aclose), by the caller.
+    """
+    import httpx
+
+    if not self.circuit_breaker.allow():
+      raise SupervisorUnavailableError(f"Supervisor at {self.base_url} is unavailable (circuit open)")
+
+    try:
+      request = self.async_client.build_request(method, path, **kwargs)
+      response = await self.async_client.send(request, stream=stream)
+    except httpx.HTTPError as e:
+      self.circuit_breaker.record_failure()
+      raise SupervisorUnavailableError(f"Supervisor at {self.base_url} is unavailable: {e}")
+
+    if response.status_code >= 500:
+      self.circuit_breaker.record_failure()
+    else:
+      self.circuit_breaker.record_success()
+    return response
+
+  async def astream(self, path, **kwargs):
+    """
+    Async variant of stream().
+    """
+    import httpx
+
+    kwargs.setdefault("timeout", httpx.Timeout(SUPERVISOR_STREAM_READ_TIMEOUT, connect=SUPERVISOR_CONNECT_TIMEOUT))
+    return await self.arequest("GET", path, stream=True, **kwargs)
+
+  def is_healthy(self, timeout=None):
+    """
+    Probe the supervisor health endpoint, without retries nor circuit breaking.
+    A successful probe closes the circuit.
+    """
+    try:
+      response = self.probe_session.get(f"{self.base_url}/api/health", timeout=timeout or self.timeout)
+    except requests.RequestException:
+      return False
+    if response.status_code != 200:
+      return False
+    self.circuit_breaker.record_success()
+    return True
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_supervisor_client(port, host="localhost"):
+  """
+  Returns the shared client for the supervisor listening on host:port.
+  """
+  key = (host, str(port))
+  with _clients_lock:
+    client = _clients.get(key)
+    if client is None:
+      client = SupervisorClient(port, host)
+      _clients[key] = client
+    return client
@@ -2,12 +2,19 @@ import os
 import sys
 import argparse
 import tempfile
+import threading
 import subprocess
 import logging
 from pathlib import Path
 import glob
 import re
 
+from api.container.docker_api import docker_client, DockerAPIError
+from api.image.cache import (BUILD_CACHE_ENABLED, resolve_commit_sha, compute_base_image_key,
+                             compute_build_key, find_cached_image, build_labels)
+from api.image.scheduler import build_scheduler
+from api.image.mirror import GIT_MIRROR_ENABLED, update_mirror, mirror_head_sha, clone_from_mirror
+
 
 STAGING_ROOT_DIR = os.getenv("STAGING_ROOT_DIR")
 if (STAGING_ROOT_DIR is None):
@@ -18,17 +25,27 @@ if (IMAGES_ROOT_DIR is None):
     raise ValueError("IMAGES_ROOT_DIR environment variable is not set.")
 
 
+# Directory of the Dockerfiles used to build the images, and of the supervisor code added to them.
+DOCKERFILE_DIR = Path(__file__).parent
+SUPERVISOR_DIR = Path(__file__).parent.parent.parent / "supervisor"
+
+# Repository of the supervisor base images, tagged with a hash of the supervisor code and base Dockerfile.
+BASE_IMAGE_NAME = "launchpad_supervisor_base"
+_base_image_lock = threading.Lock()
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Clone the agent repo to the staging/agent directory
-def clone_repository(staging_dir, github_url):
+def clone_repository(staging_dir, github_url, commit_sha=None, mirror_dir=None):
     """
     Clone a GitHub repository into a unique temporary staging directory.
     
     Args:
         github_url (str): The URL of the GitHub repository to clone
+        commit_sha (str): If provided, the commit to check out
+        mirror_dir (Path): If provided, the local mirror of the repository to clone from
         
     Returns:
         Path: The path to the staging directory containing the cloned repository
@@ -37,6 +54,12 @@ def clone_repository(staging_dir, github_url):
         staging_agent_dir = Path(staging_dir) / "agent"
         staging_agent_dir.mkdir(exist_ok=True)
 
+        if mirror_dir is not None:
+            logger.info(f"Cloning repository {github_url} from mirror {mirror_dir}")
+            clone_from_mirror(mirror_dir, staging_agent_dir, commit_sha)
+            logger.info(f"Successfully cloned repository to {staging_agent_dir}")
+            return staging_agent_dir
+
         # Clone the repository into the agent staging directory
         logger.info(f"Cloning repository: {github_url}")
         subprocess.run(["git", "clone", github_url, str(staging_agent_dir)], 
@@ -44,6 +67,13 @@ def clone_repository(staging_dir, github_url):
                       stdout=subprocess.PIPE, 
                       stderr=subprocess.PIPE)
         
+        # Check out the exact commit the build key was computed for, in case the branch moved since.
+        if commit_sha is not None:
+            subprocess.run(["git", "-C", str(staging_agent_dir), "checkout", "--detach", commit_sha],
+                          check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
         logger.info(f"Successfully cloned repository to {staging_agent_dir}")
         return staging_agent_dir
     
@@ -115,41 +145,38 @@ def extract_input_keys(agent_dir):
         logger.error(f"Error extracting input keys: {str(e)}")
         raise
 
-def add_supervisor(staging_dir):
+def get_base_image_name():
     """
-    Clone a GitHub repository into a unique temporary staging directory.
+    Name of the supervisor base image for the current supervisor code and base Dockerfile.
+    """
+    if not SUPERVISOR_DIR.exists():
+        raise FileNotFoundError(f"Supervisor directory not found at {SUPERVISOR_DIR}")
+    base_image_key = compute_base_image_key(SUPERVISOR_DIR, DOCKERFILE_DIR / "Dockerfile.base")
+    return f"{BASE_IMAGE_NAME}:{base_image_key[:16]}"
+
+def ensure_base_image(base_image):
+    """
+    Build the supervisor base image, shared by all the agent images, unless it already exists.
     
     Args:
-        staging_dir (Path): Path to the staging directory
-        
-    Returns:
+        base_image (str): The name of the base image, as returned by get_base_image_name
     """
-    try:
-        current_dir = Path(__file__).parent.parent.parent  # Go up to the root of the codebase
-        supervisor_dir = current_dir / "supervisor"
-        
-        if not supervisor_dir.exists():
-            raise FileNotFoundError(f"Supervisor directory not found at {supervisor_dir}")
-        
-        # Create the destination directory in staging
-        staging_supervisor_dir = Path(staging_dir) / "supervisor"
-        staging_supervisor_dir.mkdir(exist_ok=True)
-        
-        # Copy supervisor files to staging directory
-        logger.info(f"Copying supervisor code to {staging_supervisor_dir}")
-        subprocess.run(["cp", "-r", f"{supervisor_dir}/.", f"{staging_supervisor_dir}/"], 
-                        check=True, 
-                        stdout=subprocess.PIPE, 
-                        stderr=subprocess.PIPE)
-        
-        logger.info(f"Successfully copied supervisor code to staging directory")
-        return staging_supervisor_dir
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to copy supervisor code: {e.stderr.decode().strip()}")
-        raise
-    except Exception as e:
-        logger.error(f"An error occurred while preparing staging: {str(e)}")
-        raise
+    with _base_image_lock:
+        try:
+            if docker_client.list_images(filters={"reference": [base_image]}):
+                return
+
+            logger.info(f"Building supervisor base image: {base_image}")
+            docker_client.build_image(
+                SUPERVISOR_DIR,
+                DOCKERFILE_DIR / "Dockerfile.base",
+                base_image,
+                on_output=lambda line: logger.info(f"[docker build {base_image}] {line}")
+            )
+            logger.info(f"Successfully built supervisor base image {base_image}")
+        except DockerAPIError as e:
+            logger.error(f"Failed to build supervisor base image: {e.message}")
+            raise
 
 def prepare_staging(staging_dir):
     # Add Flask dependency to pyproject.toml
@@ -192,13 +219,15 @@ def prepare_staging(staging_dir):
 
     return staging_supervisor_dir
 
-def build_docker_image(staging_dir, agent_id, image_id):
+def build_docker_image(staging_dir, agent_id, image_id, base_image, labels=None):
     """
     Build a Docker image from the staging directory.
     
     Args:
         staging_dir (Path): Path to the staging directory
         agent_id (int): The ID of the agent
+        base_image (str): The name of the supervisor base image to build on
+        labels (dict): Labels to add to the image
         
     Returns:
         str: The name of the built Docker image
@@ -207,20 +236,18 @@ def build_docker_image(staging_dir, agent_id, image_id):
         image_name = f"agent_{agent_id}_image_{image_id}"
         image_path = Path(IMAGES_ROOT_DIR) / f"{image_name}.tar"
         
-        # Get the directory containing this script for the Dockerfile
-        dockerfile_dir = Path(__file__).parent
+        dockerfile_dir = DOCKERFILE_DIR
         
         logger.info(f"Building Docker image with name: {image_name}")
         
-        # Build the Docker image
-        subprocess.run(
-            ["docker", "build", 
-                "-t", image_name, 
-                "-f", f"{dockerfile_dir}/Dockerfile", 
-                staging_dir],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+        # Build the Docker image, logging the build output as it is produced
+        docker_client.build_image(
+            staging_dir,
+            dockerfile_dir / "Dockerfile",
+            image_name,
+            buildargs={"BASE_IMAGE": base_image},
+            labels=labels,
+            on_output=lambda line: logger.info(f"[docker build {image_name}] {line}")
         )
         
         # For now store the image on disk but later push to a registry
@@ -237,8 +264,8 @@ def build_docker_image(staging_dir, agent_id, image_id):
         #logger.info(f"Docker image saved successfully to: {image_path}")
         return str(image_name)
     
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to build Docker image: {e.stderr.decode().strip()}")
+    except DockerAPIError as e:
+        logger.error(f"Failed to build Docker image: {e.message}")
         raise
     except Exception as e:
         logger.error(f"An error occurred while building image: {str(e)}")
@@ -246,7 +273,42 @@ def build_docker_image(staging_dir, agent_id, image_id):
 
 # Main entry point method for building an image for an agent.
 # Returns the name of the built image and the input keys extracted from the agent configuration files.
-def build_image(github_url, agent_id, image_id):
+# on_progress, if provided, is called with the build completion percentage after each stage.
+def build_image(github_url, agent_id, image_id, on_progress=None):
+    def report_progress(progress):
+        if on_progress is not None:
+            on_progress(progress)
+
+    # Reuse the image already built from the same commit, supervisor code and Dockerfile, if any.
+    base_image = get_base_image_name()
+    commit_sha = None
+    mirror_dir = None
+    if GIT_MIRROR_ENABLED:
+        # Fetch the new commits into the local mirror of the repository, and build its HEAD.
+        mirror_dir = update_mirror(github_url)
+        commit_sha = mirror_head_sha(mirror_dir)
+    elif BUILD_CACHE_ENABLED:
+        commit_sha = resolve_commit_sha(github_url)
+
+    # Identical builds requested concurrently, e.g. by a burst of image creations for the same agent,
+    # are coalesced into one: the others wait for it and reuse its image.
+    build_key = None
+    if BUILD_CACHE_ENABLED:
+        build_key = compute_build_key(github_url, commit_sha, base_image, DOCKERFILE_DIR / "Dockerfile")
+    coalesce_key = build_key or (github_url, commit_sha or image_id)
+    return build_scheduler.coalesce(coalesce_key, lambda: _build_image(
+        github_url, agent_id, image_id, base_image, commit_sha, mirror_dir, build_key, report_progress))
+
+
+def _build_image(github_url, agent_id, image_id, base_image, commit_sha, mirror_dir, build_key, report_progress):
+    labels = None
+    if build_key is not None:
+        cached_image = find_cached_image(build_key)
+        if cached_image is not None:
+            logger.info(f"Reusing image {cached_image[0]} built from commit {commit_sha} of {github_url}")
+            report_progress(100)
+            return cached_image
+        logger.info(f"No cached image for commit {commit_sha} of {github_url}, building it")
 
     # Create a unique temporary staging directory
     staging_dir = tempfile.mkdtemp(dir=STAGING_ROOT_DIR, prefix="repo_staging_")
@@ -254,23 +316,27 @@ def build_image(github_url, agent_id, image_id):
 
     # Clone the repository
     logger.info(f"Cloning repository: {github_url}")
-    agent_dir = clone_repository(staging_dir, github_url)
+    agent_dir = clone_repository(staging_dir, github_url, commit_sha, mirror_dir)
     logger.info(f"Repository cloned successfully to: {agent_dir}")
+    report_progress(30)
     
     # Check the repo is a valid crewAI agent by parsing the config/agents.yaml and config/tasks.yaml files
     # and extract the inputs key names.
     input_keys = extract_input_keys(agent_dir)
     logger.info(f"Extracted input keys: {input_keys}")
+    report_progress(40)
 
-    # Add the supervisor code to staging
-    logger.info("Preparing staging directory...")
-    add_supervisor(staging_dir)
-    logger.info(f"Supervisor code staged at: {staging_dir}")
+    # Build the supervisor base image if this is the first build since the supervisor code changed
+    ensure_base_image(base_image)
+    report_progress(50)
 
     # Build the Docker image
     logger.info("Building Docker image...")
-    image_name = build_docker_image(staging_dir, agent_id, image_id)
+    if build_key is not None:
+        labels = build_labels(build_key, commit_sha, input_keys)
+    image_name = build_docker_image(staging_dir, agent_id, image_id, base_image, labels)
     logger.info(f"Docker image built and saved with name: {image_name}")
+    report_progress(100)
 
     return image_name, input_keys
 
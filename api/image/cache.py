@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+import subprocess
+import logging
+from pathlib import Path
+
+from api.container.docker_api import docker_client
+
+# Content-addressed cache of the built images.
+#
+# Each image is labelled with a build key, hash of everything that goes into the image:
+# the repository URL, the commit built, the supervisor base image and the Dockerfile.
+# A build whose key matches an existing image reuses it instead of cloning and building again.
+# The labels live with the images in the docker daemon, so the cache survives restarts and
+# disappears with the images.
+
+BUILD_CACHE_ENABLED = os.getenv("BUILD_CACHE", "1") == "1"
+
+BUILD_KEY_LABEL = "launchpad.build_key"
+INPUT_KEYS_LABEL = "launchpad.input_keys"
+COMMIT_LABEL = "launchpad.commit"
+
+# Directories of the supervisor that are not part of the image.
+IGNORED_DIRS = {"__pycache__", ".venv", ".git"}
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_commit_sha(github_url):
+    """
+    Resolve the commit currently at the HEAD of the remote repository, without cloning it.
+
+    Args:
+        github_url (str): The URL of the GitHub repository
+
+    Returns:
+        str: The commit SHA
+    """
+    result = subprocess.run(["git", "ls-remote", github_url, "HEAD"],
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = result.stdout.decode().split()
+    if not output:
+        raise ValueError(f"Unable to resolve the HEAD commit of {github_url}")
+    return output[0]
+
+
+def hash_directory(directory):
+    """
+    Hash the relative paths and contents of all the files in a directory.
+    """
+    digest = hashlib.sha256()
+    directory = Path(directory)
+    for path in sorted(directory.rglob("*")):
+        relative_path = path.relative_to(directory)
+        if path.is_dir() or IGNORED_DIRS.intersection(relative_path.parts):
+            continue
+        digest.update(str(relative_path).encode())
+        digest.update(b"\0")
+        digest.update(path.read_bytes())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def compute_base_image_key(supervisor_dir, dockerfile):
+    """
+    Compute the key identifying the content of the supervisor base image.
+    """
+    digest = hashlib.sha256()
+    for part in (hash_directory(supervisor_dir), hash_file(dockerfile)):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def compute_build_key(github_url, commit_sha, base_image, dockerfile):
+    """
+    Compute the key identifying the content of an image.
+    The base image name identifies the supervisor code and base Dockerfile.
+    """
+    digest = hashlib.sha256()
+    for part in (github_url, commit_sha, base_image, hash_file(dockerfile)):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def build_labels(build_key, commit_sha, input_keys):
+    """
+    Labels to add to a built image, so that it can be found and reused by later builds.
+    """
+    return {
+        BUILD_KEY_LABEL: build_key,
+        COMMIT_LABEL: commit_sha,
+        INPUT_KEYS_LABEL: json.dumps(input_keys),
+    }
+
+
+def find_cached_image(build_key):
+    """
+    Look for an existing image built with the same key.
+
+    Returns:
+        tuple: (image_name, input_keys) of the cached image, or None
+    """
+    images = docker_client.list_images(filters={"label": [f"{BUILD_KEY_LABEL}={build_key}"]})
+    for image in images or []:
+        tags = [tag for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"]
+        if not tags:
+            continue
+        image_name = tags[0].rsplit(":", 1)[0] if tags[0].endswith(":latest") else tags[0]
+        input_keys = json.loads((image.get("Labels") or {}).get(INPUT_KEYS_LABEL, "[]"))
+        return image_name, input_keys
+    return None
@@ -0,0 +1,86 @@
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+import subprocess
+import logging
+from pathlib import Path
+
+# Local store of bare mirrors of the agent repositories, one per repository URL.
+# Builds fetch the new objects into the mirror and clone from it, rather than cloning the full history
+# from GitHub each time.
+
+GIT_MIRROR_ENABLED = os.getenv("GIT_MIRROR", "1") == "1"
+GIT_MIRROR_ROOT_DIR = os.getenv("GIT_MIRROR_ROOT_DIR") or os.path.join(os.getenv("STAGING_ROOT_DIR", "."), "git_mirrors")
+# Build from the mirror as is when the remote can't be reached, instead of failing the build.
+GIT_MIRROR_OFFLINE_FALLBACK = os.getenv("GIT_MIRROR_OFFLINE_FALLBACK", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+def mirror_path(github_url):
+    """
+    Path of the mirror of the repository. Readable name, made unique by a hash of the URL.
+    """
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', github_url.rstrip('/').split('/')[-1]).removesuffix('.git')
+    url_hash = hashlib.sha256(github_url.encode()).hexdigest()[:16]
+    return Path(GIT_MIRROR_ROOT_DIR) / f"{name}_{url_hash}.git"
+
+
+def _git(*args):
+    return subprocess.run(["git", *args],
+                          check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
+
+def update_mirror(github_url):
+    """
+    Create the mirror of the repository, or fetch the objects added to the remote since the last update.
+    Concurrent updates of the same mirror, including from other processes, are serialized with a file lock.
+
+    Returns:
+        Path: The path to the bare mirror
+    """
+    path = mirror_path(github_url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if (path / "HEAD").exists():
+                logger.info(f"Fetching {github_url} into mirror {path}")
+                _git("-C", str(path), "fetch", "--prune", "origin")
+            else:
+                logger.info(f"Creating mirror of {github_url} at {path}")
+                # Clone to a temporary path, so that an interrupted clone is not mistaken for a mirror.
+                tmp_path = Path(f"{path}.tmp")
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                _git("clone", "--mirror", github_url, str(tmp_path))
+                tmp_path.rename(path)
+        except subprocess.CalledProcessError as e:
+            error = e.stderr.decode().strip()
+            if GIT_MIRROR_OFFLINE_FALLBACK and (path / "HEAD").exists():
+                logger.warning(f"Failed to update mirror of {github_url}, building from the cached mirror: {error}")
+            else:
+                logger.error(f"Failed to update mirror of {github_url}: {error}")
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
+
+
+def mirror_head_sha(path):
+    """
+    Returns the commit at the HEAD of the mirror, i.e. of the default branch of the remote.
+    """
+    return _git("-C", str(path), "rev-parse", "HEAD").stdout.decode().strip()
+
+
+def clone_from_mirror(path, destination_dir, commit_sha):
+    """
+    Check out the commit from the mirror into destination_dir.
+    The clone shares the objects of the mirror instead of copying them, so it is nearly instant.
+    """
+    _git("clone", "--shared", "--no-checkout", str(path), str(destination_dir))
+    _git("-C", str(destination_dir), "checkout", "--detach", commit_sha)
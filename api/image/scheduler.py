@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Maximum number of image builds running concurrently in this process.
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS", "2"))
+# Maximum number of image builds of a single tenant running concurrently, so that a burst of builds
+# from one tenant doesn't hold all the workers.
+BUILD_WORKERS_PER_TENANT = int(os.getenv("BUILD_WORKERS_PER_TENANT", "1"))
+
+# Number of recent builds the wait time statistics are computed on.
+WAIT_TIME_WINDOW = 100
+
+logger = logging.getLogger(__name__)
+
+
+class BuildScheduler:
+    """
+    Runs the builds on a bounded pool of workers, with a global and a per tenant concurrency limit.
+    Builds of a tenant at its limit wait in the tenant queue without holding a worker, and the tenants
+    with queued builds are served round robin.
+    Builds submitted with the key of a queued build follow it, without being queued, and builds with the key
+    of a running build wait in the queue until it completes. Identical builds running at the same time are
+    also coalesced into one with coalesce().
+    """
+
+    def __init__(self, max_workers=BUILD_WORKERS, max_per_tenant=BUILD_WORKERS_PER_TENANT):
+        self.max_workers = max_workers
+        self.max_per_tenant = max_per_tenant
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image_build")
+        self._lock = threading.Lock()
+        # Notified when a build completes, i.e. a worker may be idle.
+        self._idle = threading.Condition(self._lock)
+        # tenant -> deque of queued jobs (fn, args, future, queued_at, key). Ordered by the next tenant to serve.
+        self._queues = OrderedDict()
+        # tenant -> number of running builds
+        self._running = {}
+        # key -> Future of the queued build with the key, and keys of the running builds
+        self._queued_keys = {}
+        self._running_keys = set()
+        self._wait_times = deque(maxlen=WAIT_TIME_WINDOW)
+        # key -> Future of the build in flight
+        self._in_flight = {}
+        self._coalesced = 0
+        # Set on shutdown: no build is started anymore.
+        self._draining = False
+
+    def submit(self, tenant, fn, *args, key=None, follow=None):
+        """
+        Queue fn(*args) to run within the concurrency limits of the tenant. Returns a Future.
+        If a build with the same key is queued, follow(result, *args) is called instead with the result of
+        that build once it completes, without queuing this one. If that build returns None (skipped) or
+        raises, this one is queued then.
+        """
+        future = Future()
+        with self._lock:
+            leader = self._queued_keys.get(key) if key is not None and follow is not None else None
+            if leader is None:
+                self._queues.setdefault(tenant, deque()).append((fn, args, future, time.monotonic(), key))
+                if key is not None:
+                    self._queued_keys[key] = future
+                self._dispatch()
+                return future
+            self._coalesced += 1
+        logger.info(f"Following the identical build queued: {key}")
+        leader.add_done_callback(lambda leader: self._follow(leader, tenant, fn, follow, args, future))
+        return future
+
+    def _follow(self, leader, tenant, fn, follow, args, future):
+        # Runs in the thread completing the leader, once its build is done.
+        result = None if leader.cancelled() or leader.exception() else leader.result()
+        if result is None:
+            with self._lock:
+                if self._draining:
+                    future.cancel()
+                    return
+                self._queues.setdefault(tenant, deque()).append((fn, args, future, time.monotonic(), None))
+                self._dispatch()
+            return
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(follow(result, *args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _next_job(self):
+        # Called with the lock held. Returns the tenant and the job to start next, or (None, None).
+        for tenant, queue in self._queues.items():
+            if self._running.get(tenant, 0) >= self.max_per_tenant:
+                continue
+            # The builds with the key of a running build wait for it without holding a worker.
+            job = next((job for job in queue if job[4] is None or job[4] not in self._running_keys), None)
+            if job is not None:
+                return tenant, job
+        return None, None
+
+    def _dispatch(self):
+        # Called with the lock held. Start the queued builds allowed by the limits.
+        while not self._draining and sum(self._running.values()) < self.max_workers:
+            tenant, job = self._next_job()
+            if tenant is None:
+                return
+            self._queues[tenant].remove(job)
+            if self._queues[tenant]:
+                # Serve the other tenants before the next build of this one.
+                self._queues.move_to_end(tenant)
+            else:
+                del self._queues[tenant]
+            key = job[4]
+            if key is not None:
+                if self._queued_keys.get(key) is job[2]:
+                    del self._queued_keys[key]
+                self._running_keys.add(key)
+            self._running[tenant] = self._running.get(tenant, 0) + 1
+            self._wait_times.append(time.monotonic() - job[3])
+            self._executor.submit(self._run, tenant, *job[:3], key)
+
+    def _run(self, tenant, fn, args, future, key=None):
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        with self._lock:
+            self._running[tenant] -= 1
+            if not self._running[tenant]:
+                del self._running[tenant]
+            self._running_keys.discard(key)
+            self._dispatch()
+            self._idle.notify_all()
+
+    def wait_for_idle_worker(self, timeout):
+        """
+        Wait until a worker is idle and no build is queued, up to timeout seconds.
+        Returns False if the workers are still busy after the timeout.
+        """
+        with self._idle:
+            return self._idle.wait_for(
+                lambda: not self._draining and not self._queues and sum(self._running.values()) < self.max_workers,
+                timeout)
+
+    def drain(self, timeout):
+        """
+        Stop starting builds, on shutdown: the queued builds are cancelled, and the running builds are waited for,
+        up to timeout seconds. Returns the args of the cancelled builds, and whether the running builds completed.
+        """
+        with self._lock:
+            self._draining = True
+            cancelled = [job for queue in self._queues.values() for job in queue]
+            self._queues.clear()
+            self._queued_keys.clear()
+        for _, args, future, _, _ in cancelled:
+            future.cancel()
+        with self._idle:
+            completed = self._idle.wait_for(lambda: not self._running, timeout)
+        return [args for _, args, _, _, _ in cancelled], completed
+
+    def coalesce(self, key, fn):
+        """
+        Run fn(), unless a call with the same key is already in flight, in which case wait for it and
+        return its result instead.
+        """
+        with self._lock:
+            leader = self._in_flight.get(key)
+            if leader is None:
+                future = self._in_flight[key] = Future()
+            else:
+                self._coalesced += 1
+        if leader is not None:
+            logger.info(f"Waiting for the identical build in flight: {key}")
+            return leader.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        """
+        Queue depth, running builds and wait times (in seconds) of the builds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            queued = {tenant: len(queue) for tenant, queue in self._queues.items()}
+            oldest = min((queue[0][3] for queue in self._queues.values()), default=None)
+            wait_times = list(self._wait_times)
+            return {
+                'maxWorkers': self.max_workers,
+                'maxWorkersPerTenant': self.max_per_tenant,
+                'queued': sum(queued.values()),
+                'running': sum(self._running.values()),
+                'queuedByTenant': {str(tenant): count for tenant, count in queued.items()},
+                'runningByTenant': {str(tenant): count for tenant, count in self._running.items()},
+                'inFlight': len(self._in_flight),
+                'coalesced': self._coalesced,
+                'oldestQueuedWait': None if oldest is None else now - oldest,
+                'averageWait': sum(wait_times) / len(wait_times) if wait_times else None,
+                'maxWait': max(wait_times, default=None),
+            }
+
+
+# Shared scheduler of the image builds of this process.
+build_scheduler = BuildScheduler()
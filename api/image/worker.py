@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+import logging
+from datetime import datetime
+
+from sqlalchemy.orm.attributes import flag_modified
+
+from api import app, db
+from api.models import Agent, Image
+from api.image.builder import build_image
+from api.image.scheduler import build_scheduler
+from api.jobs import publish_job
+from api.container.manage import warm_pool
+from api.container.resources import get_resource_profile
+
+# Interval in seconds at which the builds claimed by this process record that they are alive,
+# by updating Image.updated_at. Builds of a crashed process stop beating and are reclaimed by the
+# job dispatcher once stale.
+BUILD_HEARTBEAT_INTERVAL = float(os.getenv("BUILD_HEARTBEAT_INTERVAL", "30"))
+# Maximum number of seconds the running builds are given to complete when the process shuts down.
+BUILD_DRAIN_TIMEOUT = float(os.getenv("BUILD_DRAIN_TIMEOUT", "300"))
+
+logger = logging.getLogger(__name__)
+
+# Progress (percentage) of the builds currently running in this process, keyed by image id.
+_build_progress = {}
+_build_progress_lock = threading.Lock()
+
+# Progress reported for an image based on its build status, when finer grained
+# progress is not available (e.g. build running in another process).
+STATUS_PROGRESS = {
+    'PENDING': 0,
+    'RUNNING': 10,
+    'DONE': 100,
+    'ERROR': 100,
+}
+
+
+def _set_build_progress(image_id, progress):
+    with _build_progress_lock:
+        _build_progress[image_id] = progress
+
+
+def get_build_progress(image):
+    """
+    Returns the completion percentage of the build of the given Image record.
+    """
+    with _build_progress_lock:
+        progress = _build_progress.get(image.id)
+    if progress is not None and image.build_status == 'RUNNING':
+        return progress
+    return STATUS_PROGRESS.get(image.build_status, 0)
+
+
+# Ids of the images claimed by this process and not built yet.
+_heartbeat_images = set()
+_heartbeat_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def _start_heartbeat(image_id):
+    global _heartbeat_thread
+    with _heartbeat_lock:
+        _heartbeat_images.add(image_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name="build_heartbeat", daemon=True)
+            _heartbeat_thread.start()
+
+
+def _stop_heartbeat(image_id):
+    with _heartbeat_lock:
+        _heartbeat_images.discard(image_id)
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(BUILD_HEARTBEAT_INTERVAL)
+        with _heartbeat_lock:
+            image_ids = list(_heartbeat_images)
+        if not image_ids:
+            continue
+        try:
+            with app.app_context():
+                (db.session.query(Image)
+                 .filter(Image.id.in_(image_ids), Image.build_status == 'RUNNING')
+                 .update({'updated_at': datetime.utcnow()}, synchronize_session=False))
+                db.session.commit()
+        except Exception as e:
+            logger.error(f"Failed to record the heartbeat of builds {image_ids}: {str(e)}")
+
+
+def build_tenant(agent):
+    """
+    Tenant the builds of the agent are accounted to for the concurrency limits: the owner of the agent
+    if known, otherwise the agent itself.
+    """
+    return agent.config.get('userId') or f"agent_{agent.id}"
+
+
+def build_coalesce_key(agent):
+    """
+    Key of the builds of the agent known before they are queued: builds of the same repository requested
+    while one is queued are identical.
+    """
+    return agent.config.get('githubUrl')
+
+
+def submit_build(image_id, tenant, claimed=False, key=None):
+    """
+    Queue the build of a PENDING Image record. Returns immediately.
+    Builds submitted while the workers, or the workers of the tenant, are busy wait in the scheduler
+    queue, their Image record staying in PENDING state.
+    Builds with the key (build_coalesce_key) of a queued build follow it and get its image, without taking
+    a worker.
+    If claimed, the Image record was already moved to RUNNING by the caller.
+    """
+    logger.info(f"Queuing build for image {image_id} of tenant {tenant}")
+    if claimed:
+        _start_heartbeat(image_id)
+    return build_scheduler.submit(tenant, run_build, image_id, claimed, key=key, follow=follow_build)
+
+
+def drain_builds(timeout=BUILD_DRAIN_TIMEOUT):
+    """
+    Drain the builds of this process on shutdown: the running builds are given up to timeout seconds to complete,
+    and the builds claimed but not started yet are released, to be claimed by the other processes.
+    """
+    logger.info("Draining the image builds")
+    cancelled, completed = build_scheduler.drain(timeout)
+    released = [image_id for image_id, claimed in cancelled if claimed]
+    for image_id in released:
+        _stop_heartbeat(image_id)
+    if released:
+        with app.app_context():
+            (db.session.query(Image)
+             .filter(Image.id.in_(released), Image.build_status == 'RUNNING')
+             .update({'build_status': 'PENDING'}, synchronize_session=False))
+            db.session.commit()
+            publish_job()
+        logger.info(f"Released the queued builds {released}")
+    if not completed:
+        logger.warning(f"Builds still running after {timeout}s, they are dispatched again once stale")
+
+
+def claim_image(image_id):
+    """
+    Move the Image record from PENDING to RUNNING. Returns False if it is not PENDING anymore,
+    i.e. its build was claimed by another worker.
+    """
+    claimed = (db.session.query(Image)
+               .filter(Image.id == image_id, Image.build_status == 'PENDING')
+               .update({'build_status': 'RUNNING'}, synchronize_session=False))
+    db.session.commit()
+    return claimed == 1
+
+
+def record_build(image, agent, image_name, input_keys):
+    """
+    Record the image built for the Image record, and the input keys of the agent.
+    """
+    # Update the agent configuration with input_keys
+    agent.config['inputKeys'] = input_keys # Note: camelcase for JSON in DB as a convention
+    # Flag the column as modified to ensure SQLAlchemy detects the change
+    flag_modified(agent, 'config')
+    logger.info(f"Updated agent {agent.id} with inputKeys: {input_keys}")
+
+    # Update the image name and status in the database
+    image.name = image_name
+    image.build_status = 'DONE'
+    db.session.commit()
+
+    # Get containers ready for the first runs of the new image
+    warm_pool.touch(image_name, get_resource_profile(agent.config))
+
+
+def follow_build(built, image_id, claimed=False):
+    """
+    Complete the Image record with the outcome of the identical build it followed: the tuple
+    (image_name, input_keys), or False if that build failed.
+    Runs in the build worker thread of the build followed.
+    """
+    with app.app_context():
+        if not claimed and not claim_image(image_id):
+            logger.warning(f"Image {image_id} not found or not PENDING. Skipping build.")
+            return None
+        image = db.session.get(Image, image_id)
+        agent = db.session.get(Agent, image.agent_id)
+        try:
+            if not built:
+                raise RuntimeError("The identical build followed failed")
+            logger.info(f"Image {image_id} reuses image {built[0]} of the identical build followed")
+            record_build(image, agent, *built)
+        except Exception as e:
+            logger.error(f"Error completing image {image_id} for agent {agent.id}: {str(e)}")
+            db.session.rollback()
+            image.build_status = 'ERROR'
+            db.session.commit()
+            return False
+        finally:
+            _stop_heartbeat(image_id)
+        return built
+
+
+def run_build(image_id, claimed=False):
+    """
+    Build the docker image for the given Image record and update it with the outcome.
+    Returns the tuple (image_name, input_keys), False if the build failed, or None if it was skipped.
+    Runs in a build worker thread.
+    """
+    with app.app_context():
+        if not claimed and not claim_image(image_id):
+            logger.warning(f"Image {image_id} not found or not PENDING. Skipping build.")
+            return None
+        _start_heartbeat(image_id)
+
+        image = db.session.get(Image, image_id)
+        agent = db.session.get(Agent, image.agent_id)
+        _set_build_progress(image_id, STATUS_PROGRESS['RUNNING'])
+
+        try:
+            github_url = agent.config.get('githubUrl')
+            logger.info(f"Creating image for agent {agent.id} with repository URL {github_url}")
+            image_name, input_keys = build_image(
+                github_url, agent.id, image_id,
+                on_progress=lambda progress: _set_build_progress(image_id, progress))
+            logger.info(f"Image creation done for agent {agent.id}. Image name: {image_name}")
+            record_build(image, agent, image_name, input_keys)
+            return image_name, input_keys
+        except Exception as e:
+            logger.exception(f"Error building image {image_id} for agent {agent.id}: {str(e)}")
+            db.session.rollback()
+            image.build_status = 'ERROR'
+            db.session.commit()
+            return False
+        finally:
+            _stop_heartbeat(image_id)
+            with _build_progress_lock:
+                _build_progress.pop(image_id, None)
@@ -0,0 +1,195 @@
+import os
+import select
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from api import db
+from api.models import Image
+
+# Dispatch of the pending image builds to the processor workers.
+#
+# With BUILD_DISPATCH=queue, image creations only record a PENDING Image and notify the workers.
+# Workers long-poll /api/job/process: the request claims the oldest PENDING Image with
+# SELECT ... FOR UPDATE SKIP LOCKED, so that concurrent workers never claim the same one, or waits
+# for a notification of a new job. With BUILD_DISPATCH=local, builds run in the process receiving
+# the image creation.
+
+BUILD_DISPATCH = os.getenv("BUILD_DISPATCH", "local")
+# Postgres connection used to LISTEN for new jobs. LISTEN needs a session: use a direct or session pooler
+# connection string, not the transaction pooler of DATABASE_URL. Without it, only the jobs created by
+# this process wake the waiting workers immediately, the others are found within JOB_RECHECK_INTERVAL.
+DATABASE_LISTEN_URL = os.getenv("DATABASE_LISTEN_URL")
+# Maximum number of seconds a worker request waits for a job.
+JOB_POLL_TIMEOUT = float(os.getenv("JOB_POLL_TIMEOUT", "25"))
+# Interval in seconds at which waiting workers check for new jobs when not listening for notifications.
+JOB_RECHECK_INTERVAL = float(os.getenv("JOB_RECHECK_INTERVAL", "2"))
+
+# Number of seconds without heartbeat after which a RUNNING build is considered abandoned by a crashed
+# process, and is claimed again. Must be a few times BUILD_HEARTBEAT_INTERVAL.
+BUILD_STALE_TIMEOUT = float(os.getenv("BUILD_STALE_TIMEOUT", "120"))
+# Minimum interval in seconds between two checks for abandoned builds by this process.
+RECLAIM_INTERVAL = 30
+
+JOB_CHANNEL = "launchpad_jobs"
+LISTEN_RECONNECT_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+class JobNotifier:
+    """
+    Wakes up the requests waiting for a job, when a job is created by this process or notified by Postgres.
+    """
+
+    def __init__(self, listen_url=DATABASE_LISTEN_URL):
+        self._listen_url = listen_url
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._listening = False
+        self._listener = None
+
+    @property
+    def listening(self):
+        return self._listening
+
+    @property
+    def generation(self):
+        with self._condition:
+            return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """
+        Wait until notified of a job created after generation was read, or until the timeout.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._generation != generation, timeout=timeout)
+
+    def start_listener(self):
+        if not self._listen_url:
+            return
+        with self._condition:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen_loop, name="job_listener", daemon=True)
+        self._listener.start()
+
+    def _listen_loop(self):
+        import psycopg2
+
+        while True:
+            connection = None
+            try:
+                connection = psycopg2.connect(self._listen_url)
+                connection.autocommit = True
+                connection.cursor().execute(f"LISTEN {JOB_CHANNEL}")
+                self._listening = True
+                logger.info(f"Listening for new jobs on channel {JOB_CHANNEL}")
+                # Jobs may have been created while not listening.
+                self.notify()
+
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    if connection.notifies:
+                        connection.notifies.clear()
+                        self.notify()
+            except Exception as e:
+                logger.error(f"Job listener connection failed: {str(e)}")
+            finally:
+                self._listening = False
+                if connection is not None:
+                    connection.close()
+            time.sleep(LISTEN_RECONNECT_DELAY)
+
+
+job_notifier = JobNotifier()
+
+
+def publish_job():
+    """
+    Notify the workers that a job was created. Call after committing the job.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify(:channel, '')"), {'channel': JOB_CHANNEL})
+        db.session.commit()
+    job_notifier.notify()
+
+
+_last_reclaim = 0
+
+
+def reclaim_stale_jobs():
+    """
+    Move the RUNNING builds whose heartbeat stopped back to PENDING, so that they are claimed again.
+    """
+    global _last_reclaim
+    now = time.monotonic()
+    if now - _last_reclaim < RECLAIM_INTERVAL:
+        return
+    _last_reclaim = now
+
+    stale_before = datetime.utcnow() - timedelta(seconds=BUILD_STALE_TIMEOUT)
+    reclaimed = (db.session.query(Image)
+                 .filter(Image.build_status == 'RUNNING', Image.updated_at < stale_before)
+                 .update({'build_status': 'PENDING'}, synchronize_session=False))
+    db.session.commit()
+    if reclaimed:
+        logger.warning(f"Reclaimed {reclaimed} abandoned builds")
+        job_notifier.notify()
+
+
+def claim_next_job():
+    """
+    Claim the oldest PENDING Image by moving it to RUNNING. Returns its id, or None if there is no job.
+    """
+    reclaim_stale_jobs()
+    while True:
+        # Rows locked by the concurrent claims are skipped rather than waited for.
+        image_id = (db.session.query(Image.id)
+                    .filter(Image.build_status == 'PENDING')
+                    .order_by(Image.id)
+                    .with_for_update(skip_locked=True)
+                    .limit(1)
+                    .scalar())
+        if image_id is None:
+            db.session.rollback()
+            return None
+        # Conditional update, so that the claim stays exclusive on databases without row locks.
+        claimed = (db.session.query(Image)
+                   .filter(Image.id == image_id, Image.build_status == 'PENDING')
+                   .update({'build_status': 'RUNNING'}, synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            return image_id
+
+
+def wait_for_job(timeout=JOB_POLL_TIMEOUT):
+    """
+    Claim the next job, waiting up to timeout seconds for one to be created.
+    Returns the id of the claimed Image, or None.
+    """
+    job_notifier.start_listener()
+    deadline = time.monotonic() + timeout
+    while True:
+        # Read the generation before checking, so that a job notified in between is not missed.
+        generation = job_notifier.generation
+        image_id = claim_next_job()
+        if image_id is not None:
+            return image_id
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        if not job_notifier.listening:
+            remaining = min(remaining, JOB_RECHECK_INTERVAL)
+        job_notifier.wait(generation, remaining)
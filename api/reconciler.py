@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.orm import defer
+
+from api import app, db
+from api.models import Image, Run
+from api.admission import ADMISSION_TIMEOUT
+from api.runs import FINAL_STATUSES, apply_run_status, complete_run, get_supervisor_runs_status
+from api.run_output import append_run_output, fetch_run_output, get_runs_output_offsets
+from api.container.manage import find_container, is_container_gone
+from api.container.supervisor_client import get_supervisor_client
+
+# Background reconciliation of the runs in progress.
+#
+# Periodically sweeps the runs that are neither PENDING nor in a final state, asks their supervisors for
+# their status along with their new output, one call per container and several containers concurrently,
+# and stores them in one commit per container. The runs are kept up to date in the database even if no
+# client polls them. The runs left PENDING for too long, e.g. by a restart, are failed.
+# With several manager processes, a Postgres advisory lock elects the one doing a sweep.
+
+# Interval in seconds between two sweeps. 0 disables the reconciler.
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "10"))
+# Number of runs read from the database at a time.
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "200"))
+# Number of containers queried concurrently.
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "8"))
+
+# Key of the advisory lock held by the process sweeping the runs.
+RECONCILE_LOCK_KEY = 0x6c70_7263  # "lprc"
+
+logger = logging.getLogger(__name__)
+
+_reconciler_thread = None
+_reconciler_lock = threading.Lock()
+
+
+def start_reconciler():
+    """
+    Start the reconciler thread of this process, unless disabled or already started.
+    """
+    global _reconciler_thread
+    if RECONCILE_INTERVAL <= 0:
+        return
+    with _reconciler_lock:
+        if _reconciler_thread is not None:
+            return
+        _reconciler_thread = threading.Thread(target=_reconcile_loop, name="run_reconciler", daemon=True)
+    _reconciler_thread.start()
+
+
+def _reconcile_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        try:
+            with app.app_context():
+                reconcile_runs()
+        except Exception as e:
+            logger.error(f"Error while reconciling the runs: {str(e)}")
+
+
+def reconcile_runs():
+    """
+    Sweep the runs in progress once. Returns the number of runs checked, or None if another process
+    is sweeping them.
+    """
+    # The lock is held by a dedicated transaction for the duration of the sweep, so that it works
+    # through the transaction pooler, and is released if the process dies.
+    with db.engine.connect() as lock_connection:
+        if db.engine.dialect.name == 'postgresql':
+            locked = lock_connection.execute(
+                text("SELECT pg_try_advisory_xact_lock(:key)"), {'key': RECONCILE_LOCK_KEY}).scalar()
+            if not locked:
+                return None
+
+        fail_stale_pending_runs()
+
+        checked = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY, thread_name_prefix="run_reconciler") as executor:
+            while True:
+                runs = (db.session.query(Run.id, Run.image_id, Run.config)
+                        .filter(Run.status.notin_(FINAL_STATUSES + ('PENDING',)), Run.id > last_id)
+                        .order_by(Run.id)
+                        .limit(RECONCILE_BATCH_SIZE)
+                        .all())
+                db.session.rollback()
+                if not runs:
+                    break
+                last_id = runs[-1].id
+                checked += len(runs)
+
+                run_ids_by_container = {}
+                for run in runs:
+                    container_key = (run.image_id, (run.config or {}).get('containerId'))
+                    run_ids_by_container.setdefault(container_key, []).append(run.id)
+                image_ids = {image_id for image_id, _ in run_ids_by_container}
+                image_names = dict(db.session.query(Image.id, Image.name).filter(Image.id.in_(image_ids)).all())
+                db.session.rollback()
+
+                # Wait for the batch to be processed before reading the next one.
+                list(executor.map(
+                    lambda item: _reconcile_container_runs(image_names.get(item[0][0]), item[0][1], item[1]),
+                    run_ids_by_container.items()))
+        return checked
+
+
+def fail_stale_pending_runs():
+    """
+    Fail the runs left PENDING for longer than ADMISSION_TIMEOUT, e.g. whose start was interrupted by a restart
+    of their manager process. The runs waiting for capacity are updated on each attempt to start them.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=ADMISSION_TIMEOUT)
+    failed = (db.session.query(Run)
+              .filter(Run.status == 'PENDING', Run.updated_at < stale_before)
+              .update({'status': 'ERROR', 'output': 'Error: The run was not started in time'},
+                      synchronize_session=False))
+    db.session.commit()
+    if failed:
+        logger.warning(f"Failed {failed} runs left PENDING for more than {ADMISSION_TIMEOUT}s")
+
+
+def _reconcile_run_with_output_call(run, status, supervisor_client):
+    """
+    Update a run from a supervisor of an image built before the output was returned along with the status:
+    its output is fetched and stored with a call of its own.
+    """
+    try:
+        if status not in FINAL_STATUSES:
+            fetch_run_output(run, supervisor_client)
+        if status not in (run.status, 'QUEUED'):
+            apply_run_status(run, status, supervisor_client)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to reconcile run {run.id}: {str(e)}")
+
+
+def _reconcile_container_runs(image_name, container_id, run_ids):
+    """
+    Update the runs of a container of the image from its supervisor. Runs in a reconciler worker thread.
+    The runs started before their container was recorded are looked up in any container of the image.
+    """
+    if image_name is None:
+        return
+    with app.app_context():
+        try:
+            runs = db.session.query(Run).options(defer(Run.output)).filter(Run.id.in_(run_ids)).all()
+            container_info = find_container(image_name, container_id)
+            if container_info is None:
+                # Missing from the listing, which skips the unreachable docker hosts: only fail the runs once
+                # docker confirms that their container is gone.
+                if not is_container_gone(image_name, container_id):
+                    logger.warning(f"Container {container_id} of image {image_name} not found, checking it again later")
+                    return
+                # The agent processes of the runs ended with their container.
+                for run in runs:
+                    logger.warning(f"Container of run {run.id} is not running anymore, marking it as failed")
+                    complete_run(run, 'ERROR')
+                return
+
+            supervisor_client = get_supervisor_client(*container_info[1:])
+            offsets = get_runs_output_offsets(run_ids)
+            statuses = get_supervisor_runs_status(supervisor_client, run_ids, offsets)
+
+            for run in runs:
+                status = statuses.get(str(run.id)) or {}
+                if status.get('code') == 200 and 'output' not in status:
+                    _reconcile_run_with_output_call(run, status['status'], supervisor_client)
+                    continue
+                try:
+                    # The runs of the container are stored in one commit, each in a savepoint so that
+                    # a failing run doesn't discard the others.
+                    with db.session.begin_nested():
+                        if status.get('code') == 404:
+                            # The supervisor doesn't know the run, e.g. the container was replaced.
+                            logger.warning(f"Run {run.id} unknown to its supervisor, marking it as failed")
+                            complete_run(run, 'ERROR', commit=False)
+                        elif status.get('code') == 200:
+                            delta = status['output']
+                            if delta['stdout'] or delta['stderr']:
+                                append_run_output(run.id, offsets[run.id], delta, commit=False)
+                            if status['status'] not in (run.status, 'QUEUED'):
+                                apply_run_status(run, status['status'], None, commit=False)
+                except Exception as e:
+                    logger.error(f"Failed to reconcile run {run.id}: {str(e)}")
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to reconcile the runs of image {image_name}: {str(e)}")
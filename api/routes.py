@@ -1,26 +1,51 @@
+import json
 import logging
-import requests
+import time
 import traceback
 
-from flask import request, jsonify
+from flask import Response, request, jsonify, stream_with_context
 from api import app
 from api.models import db, Image, Run, Agent
-from api.image.builder import build_image
-from api.container.manage import get_or_start_container, wait_for_container_supervisor
+from api.image.worker import submit_build, build_tenant, build_coalesce_key, get_build_progress
+from api.image.scheduler import build_scheduler
+from api.container.manage import readiness_tracker, fleet
+from api.container.fleet import NoCapacityError
+from api.container.resources import get_resource_profile
+from api.container.supervisor_client import get_supervisor_client, SupervisorUnavailableError
+from api.callbacks import verify_callback_token, READY_CALLBACK_SUBJECT
+from api.runs import (FINAL_STATUSES, RunNotFoundError, complete_run, apply_run_status, create_run,
+                      get_start_payload, get_run_container, record_run_start, final_output_events,
+                      get_supervisor_runs_status, RunContainerNotFoundError)
+from api.admission import AdmissionQueueFullError, admission_queue, launch_run
+from api.jobs import BUILD_DISPATCH, JOB_POLL_TIMEOUT, publish_job, wait_for_job
+from api.run_cache import cached_run_response, final_run_response, run_response_cache
+from api.run_output import parse_cursor, public_output, fetch_run_output, read_run_output
 from api.utils import create_error_response
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm import defer
+from sqlalchemy.pool import QueuePool
 
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of runs in a request of the bulk status endpoint.
+RUNS_STATUS_BATCH_LIMIT = 500
+
+BUILD_STATUS_MESSAGES = {
+    'PENDING': 'Waiting for a build worker',
+    'RUNNING': 'Building container image',
+    'DONE': 'Container image ready',
+    'ERROR': 'Container image build failed',
+}
+
 @app.route('/api/agent/<agent_id>/image/create', methods=['POST'])
 def create_image(agent_id):
     """
     Create a new agent image. Get everything ready for running it.
+    The build runs asynchronously, use the image status endpoint to follow its progress.
     ---
     responses:
-      200:
-        description: Agent image creation successfull
+      202:
+        description: Agent image creation queued
       400:
         description: Invalid request parameters
     """
@@ -38,38 +63,16 @@ def create_image(agent_id):
         if not github_url:
             return create_error_response("Agent configuration missing githubUrl", 400)
 
-        # Create a record in the database for the image
+        # Create a record in the database for the image. It is picked up by the build workers.
         image = Image(agent_id=agent_id, build_status="PENDING")
         db.session.add(image)
         db.session.commit()
         logger.info(f"Image record created in database for agent {agent_id}")
 
-        # Start the image creation process
-        try:
-            logger.info(f"Creating image for agent {agent_id} with repository URL {github_url}")
-            image_name, input_keys = build_image(github_url, agent_id, image.id)
-            logger.info(f"Image creation done for agent {agent_id}. Image name: {image_name}")
-            logger.info(f"Input keys extracted: {input_keys}")
-
-            # Update the agent configuration with input_keys
-            if agent.config is None:
-              agent.config = {}
-            agent.config['inputKeys'] = input_keys # Note: camelcase for JSON in DB as a convention
-            # Flag the column as modified to ensure SQLAlchemy detects the change
-            flag_modified(agent, 'config')
-            db.session.commit()
-            logger.info(f"Updated agent {agent_id} with inputKeys: {input_keys}")
-
-            # Update the image name and status in the database
-            image.name = image_name
-            image.build_status = 'DONE'
-            db.session.commit()
-        except Exception as e:
-            logger.error(f"Error building image for agent {agent_id}: {str(e)}")
-            # Update image status to ERROR in the DB and return the error in the API response
-            image.build_status = 'ERROR'
-            db.session.commit()
-            raise e
+        if BUILD_DISPATCH == 'queue':
+            publish_job()
+        else:
+            submit_build(image.id, build_tenant(agent), key=build_coalesce_key(agent))
 
     except ValueError as e:
         return create_error_response(str(e), 400)
@@ -77,7 +80,7 @@ def create_image(agent_id):
         print(traceback.format_exc())
         return create_error_response(f"Internal server error: {str(e)}", 500)
 
-    return jsonify({'status': 'DONE', 'imageName': image_name})
+    return jsonify({'status': 'PENDING', 'imageId': image.id}), 202
 
 
 @app.route('/api/agent/<agent_id>/image/status', methods=['GET'])
@@ -98,25 +101,81 @@ def get_image_status(agent_id):
         if not agent:
             return create_error_response(f"Agent with id {agent_id} not found", 404)
             
-        # TODO: implement logic to check image creation status
-        # This could involve checking a status field in the agent record
-        # or querying a separate image_build table
-        
-        # Placeholder for actual status check
-        status = "IN_PROGRESS"  # Could be one of: PENDING, IN_PROGRESS, COMPLETED, FAILED
-        progress = 75  # Optional: percentage complete
-        
+        # Use the image requested by the caller, or default to the most recent one.
+        query = db.session.query(Image).filter(Image.agent_id == agent_id)
+        image_id = request.args.get('imageId')
+        if image_id:
+            query = query.filter(Image.id == image_id)
+        image = query.order_by(Image.id.desc()).first()
+
+        if not image:
+            return create_error_response(f"No image found for agent {agent_id}", 404)
+
         return jsonify({
-            'status': status,
-            'progress': progress,
-            'message': 'Building container image'
+            'imageId': image.id,
+            'imageName': image.name,
+            'status': image.build_status, # One of: PENDING, RUNNING, DONE, ERROR
+            'progress': get_build_progress(image), # Percentage complete
+            'message': BUILD_STATUS_MESSAGES.get(image.build_status, '')
         })
-        
+
     except Exception as e:
         logger.error(f"Error while checking image status: {str(e)}")
         return create_error_response(f"Internal server error: {str(e)}", 500)
 
 
+@app.route('/api/image/queue', methods=['GET'])
+def get_build_queue():
+    """
+    Get the state of the image build queue of this process: queue depth, running builds and wait times.
+    ---
+    responses:
+      200:
+        description: Build queue statistics
+    """
+    return jsonify(build_scheduler.stats())
+
+
+@app.route('/api/job/process', methods=['GET'])
+def process_job():
+    """
+    Long-poll endpoint of the processor workers. Once a build worker of this process is idle, waits for a
+    pending image build, claims it and starts it in the build workers, then returns without waiting for it.
+    Concurrent requests are each given a different build.
+    ---
+    parameters:
+      - name: timeout
+        in: query
+        description: Maximum number of seconds to wait for a job
+    responses:
+      202:
+        description: Job claimed and started
+      204:
+        description: No job to process, or no idle build worker, before the timeout
+    """
+    try:
+        timeout = min(float(request.args.get('timeout', JOB_POLL_TIMEOUT)), JOB_POLL_TIMEOUT)
+    except ValueError:
+        return create_error_response("Invalid timeout", 400)
+
+    # Only claim a build this process can start right away: the others stay PENDING, for the other processes.
+    deadline = time.monotonic() + timeout
+    if not build_scheduler.wait_for_idle_worker(timeout):
+        return '', 204
+    image_id = wait_for_job(max(deadline - time.monotonic(), 0))
+    if image_id is None:
+        return '', 204
+
+    try:
+        image = db.session.get(Image, image_id)
+        agent = db.session.get(Agent, image.agent_id)
+        submit_build(image_id, build_tenant(agent), claimed=True, key=build_coalesce_key(agent))
+        return jsonify({'job_id': image_id, 'status': 'RUNNING'}), 202
+    except Exception as e:
+        logger.error(f"Error while processing job {image_id}: {str(e)}")
+        return create_error_response(f"Internal server error: {str(e)}", 500)
+
+
 @app.route('/api/agent/<agent_id>/input', methods=['GET'])
 def get_agent_input(agent_id):
     """
@@ -148,60 +207,30 @@ def start_agent(agent_id):
         inputs = data['inputs']
         logger.info(f"Received inputs for agent {agent_id}: {inputs}")
 
-        # Query the agent from the database
-        agent = db.session.query(Agent).filter(Agent.id == agent_id).first()
-        if not agent:
-            return create_error_response(f"Agent with id {agent_id} not found", 404)
-
-        # Query the image from the database
-        image = db.session.query(Image).filter(Image.agent_id == agent_id).first()
-        if not image:
-            return create_error_response(f"No image found for agent {agent_id}", 404)
-
-        # Insert the run record into the database
-        config = {
-          'agent': agent.config,
-          'inputs': inputs
-        }
-        run = Run(agent_id=agent_id, image_id=image.id, config=config, status="PENDING")
-        db.session.add(run)
-        db.session.commit()
-        logger.info(f"Run record created in database for agent {agent_id}")
-
-        # Bring up the container, if not already running        
-        container_id, supervisor_port = get_or_start_container(image.name)
-        logger.info(f"Container {container_id} with supervisor port {supervisor_port} running for agent {agent_id}")
-
-        # Wait for the supervisor API to come up within the container.
-        # This is a blocking call that waits for the supervisor API to become available.
-        # If the API is not available within 30 seconds, this will raise an exception.
-        # TODO: take action to recover or delete the container and mark the container as unhealthy in the DB.
-        wait_for_container_supervisor(supervisor_port)
-
-        # Call the supervisor API to start the agent run
-        # Prepare the request payload with environment variables and inputs
-        payload = {
-          'envs': agent.config.get('envs', {}),
-          'inputs': inputs
-        }
-
-        # Make the API request to the supervisor for starting the agent run.
-        response = requests.post(f'http://localhost:{supervisor_port}/api/run/{run.id}/start', json=payload)
-        if response.status_code != 200:
-          run.status = 'ERROR'
-          run.output = 'Error: ' + response.text
-          db.session.commit()
-          raise Exception(f"Failed to start agent run: {response.text}")
-
-        # Update run status to RUNNING
-        run.status = "RUNNING"
-        db.session.commit()
+        try:
+            agent, image, run = create_run(agent_id, inputs)
+        except RunNotFoundError as e:
+            return create_error_response(str(e), 404)
 
-        logger.info(f"Agent run {run.id} started successfully for agent {agent_id}")
+        payload = get_start_payload(agent, run, inputs)
+        profile = get_resource_profile(agent.config)
+        try:
+            started = launch_run(run, image.name, payload, profile)
+        except NoCapacityError:
+            # Wait for capacity rather than overcommitting a docker host.
+            try:
+                position = admission_queue.enqueue(run.id)
+            except AdmissionQueueFullError as e:
+                record_run_start(run, error=str(e))
+                return create_error_response(f"No capacity to start the run: {str(e)}", 503)
+            return jsonify({'status': 'PENDING', 'runId': run.id, 'queuePosition': position}), 202
 
     except Exception as e:
         return create_error_response(f"Internal server error: {str(e)}", 500)
 
+    if started.get('status') == 'QUEUED':
+        # Waiting for a slot in its container.
+        return jsonify({'status': 'QUEUED', 'runId': run.id, 'queuePosition': started.get('position')})
     return jsonify({'status': 'RUNNING', 'runId': run.id})
 
 
@@ -217,14 +246,25 @@ def get_run_status(agent_id, run_id):
       404:
         description: Job not found
     """
+    # The status of a run in a final state doesn't change anymore, it may be cached.
+    cached_response = cached_run_response(agent_id, run_id, 'status')
+    if cached_response is not None:
+      return cached_response
+
     # Query the run from the database
-    run = db.session.query(Run).filter(Run.id == run_id, Run.agent_id == agent_id).first()
+    run = db.session.query(Run).options(defer(Run.output)) \
+      .filter(Run.id == run_id, Run.agent_id == agent_id).first()
     if not run:
       return create_error_response(f"Run with id {run_id} not found for agent {agent_id}", 404)
     
     if (run.status in ['DONE', 'ERROR']):
       # These are final states, no need to check the container.
-      return jsonify({'status': run.status})
+      return final_run_response(agent_id, run_id, {'status': run.status}, 'status')
+
+    if run.status == 'PENDING':
+      # Not started yet, possibly waiting for capacity.
+      position = admission_queue.position(run.id)
+      return jsonify({'status': 'PENDING'} if position is None else {'status': 'PENDING', 'queuePosition': position})
 
     # Query the image to get the container details
     image = db.session.query(Image).filter(Image.id == run.image_id).first()
@@ -232,43 +272,213 @@ def get_run_status(agent_id, run_id):
       return create_error_response(f"Image not found for run {run_id}", 404)
       
     # Get the container and supervisor port
-    container_id, supervisor_port = get_or_start_container(image.name)
+    try:
+        container_id, supervisor_port, supervisor_host = get_run_container(run, image.name)
+    except RunContainerNotFoundError as e:
+        if run.status in FINAL_STATUSES:
+            # Failed with its container.
+            return final_run_response(agent_id, run_id, {'status': run.status}, 'status')
+        return create_error_response(str(e), 503)
+    supervisor_client = get_supervisor_client(supervisor_port, supervisor_host)
 
-    response = requests.get(f'http://localhost:{supervisor_port}/api/run/{run_id}/status')
+    try:
+        response = supervisor_client.get(f'/api/run/{run_id}/status')
+    except SupervisorUnavailableError as e:
+        return create_error_response(str(e), 503)
     if response.status_code != 200:
         logger.error(f"Failed to get run status: {response.text}")
         return create_error_response(f"Failed to get run status: {response.text}", 500)
     
-    status = response.json().get('status', 'UNKNOWN')
+    run_status = response.json()
+    status = run_status.get('status', 'UNKNOWN')
     if status == 'UNKNOWN':
         return create_error_response("Failed to get run status", 500)
-    if status not in ['RUNNING', 'DONE', 'ERROR']:
-        return create_error_response(f"Invalid status: {status}", 500)
 
     # Update the run status in the database
-    logger.info(f"Run {run_id} status: {status}")
-    run.status = status
-    db.session.commit()
-
+    try:
+        apply_run_status(run, status, supervisor_client)
+    except ValueError as e:
+        return create_error_response(str(e), 500)
+    except SupervisorUnavailableError as e:
+        return create_error_response(str(e), 503)
+
+    if status in FINAL_STATUSES:
+        return final_run_response(agent_id, run_id, {'status': status}, 'status')
+    if status == 'QUEUED':
+        # Waiting for a slot in its container.
+        return jsonify({'status': status, 'queuePosition': run_status.get('position')})
     return jsonify({'status': status})
 
 
+@app.route('/api/runs/status', methods=['POST'])
+def get_runs_status():
+    """
+    Get the status of several runs at once, e.g. for a dashboard.
+    Expects {"runIds": [...]}. The runs are read with a single query, and the supervisor of each container
+    is called once for all its runs. Returns {"runs": {run_id: {"status": ...} or {"error": ...}}}.
+    ---
+    responses:
+      200:
+        description: Statuses retrieved
+      400:
+        description: Invalid run ids
+    """
+    data = request.get_json(silent=True) or {}
+    run_ids = data.get('runIds')
+    if not isinstance(run_ids, list) or not run_ids:
+        return create_error_response("Request must contain a non empty 'runIds' list", 400)
+    if len(run_ids) > RUNS_STATUS_BATCH_LIMIT:
+        return create_error_response(f"At most {RUNS_STATUS_BATCH_LIMIT} runs per request", 400)
+    try:
+        run_ids = {int(run_id) for run_id in run_ids}
+    except (TypeError, ValueError):
+        return create_error_response("Invalid run id in 'runIds'", 400)
+
+    results = {str(run_id): {'error': 'Run not found'} for run_id in run_ids}
+    runs = db.session.query(Run).options(defer(Run.output)).filter(Run.id.in_(run_ids)).all()
+
+    # Runs in a final state, or not started yet, are answered from the database.
+    # The other runs are grouped by container.
+    runs_by_container = {}
+    for run in runs:
+        if run.status in FINAL_STATUSES or run.status == 'PENDING':
+            results[str(run.id)] = {'status': run.status}
+        else:
+            runs_by_container.setdefault((run.image_id, run.config.get('containerId')), []).append(run)
+
+    image_ids = {image_id for image_id, _ in runs_by_container}
+    images = {image.id: image for image in db.session.query(Image).filter(Image.id.in_(image_ids)).all()} if image_ids else {}
+    for (image_id, _), container_runs in runs_by_container.items():
+        image = images.get(image_id)
+        if image is None:
+            continue
+        try:
+            container_id, supervisor_port, supervisor_host = get_run_container(container_runs[0], image.name)
+            supervisor_client = get_supervisor_client(supervisor_port, supervisor_host)
+            statuses = get_supervisor_runs_status(supervisor_client, [run.id for run in container_runs])
+        except RunContainerNotFoundError as e:
+            if container_runs[0].status in FINAL_STATUSES:
+                # The container is gone, with the other runs of the container.
+                for run in container_runs[1:]:
+                    complete_run(run, 'ERROR')
+                for run in container_runs:
+                    results[str(run.id)] = {'status': run.status}
+            else:
+                for run in container_runs:
+                    results[str(run.id)] = {'error': str(e)}
+            continue
+        except Exception as e:
+            logger.error(f"Failed to get the status of the runs of image {image.name}: {str(e)}")
+            for run in container_runs:
+                results[str(run.id)] = {'error': str(e)}
+            continue
+
+        for run in container_runs:
+            status = statuses.get(str(run.id)) or {}
+            if status.get('code', 200) != 200 or 'status' not in status:
+                results[str(run.id)] = {'error': status.get('message', 'Failed to get run status')}
+                continue
+            try:
+                apply_run_status(run, status['status'], supervisor_client)
+                if status['status'] == 'QUEUED':
+                    results[str(run.id)] = {'status': 'QUEUED', 'queuePosition': status.get('position')}
+                else:
+                    results[str(run.id)] = {'status': run.status}
+            except Exception as e:
+                db.session.rollback()
+                results[str(run.id)] = {'error': str(e)}
+
+    return jsonify({'runs': results})
+
+
+@app.route('/api/agent/<agent_id>/run/<run_id>/complete', methods=['POST'])
+def complete_run_callback(agent_id, run_id):
+    """
+    Callback of the container supervisor when the agent process of a run exits.
+    Moves the run to its final status without waiting for a client to poll it.
+    ---
+    responses:
+      200:
+        description: Job status updated
+      400:
+        description: Invalid status
+      403:
+        description: Invalid callback token
+      404:
+        description: Job not found
+    """
+    if not verify_callback_token(run_id, request.args.get('token')):
+        return create_error_response("Invalid callback token", 403)
+
+    data = request.get_json(silent=True) or {}
+    status = data.get('status')
+    if status not in FINAL_STATUSES:
+        return create_error_response(f"Invalid status: {status}", 400)
+
+    run = db.session.query(Run).options(defer(Run.output)) \
+      .filter(Run.id == run_id, Run.agent_id == agent_id).first()
+    if not run:
+        return create_error_response(f"Run with id {run_id} not found for agent {agent_id}", 404)
+
+    if run.status in FINAL_STATUSES:
+        # Already completed by a status poll.
+        return jsonify({'status': run.status})
+
+    logger.info(f"Run {run_id} exited with code {data.get('exit_code')} after {data.get('duration')}s. "
+                f"Resource usage: {data.get('rusage')}")
+
+    # Store the remaining output of the run along with its final status.
+    supervisor_client = None
+    image = db.session.query(Image).filter(Image.id == run.image_id).first()
+    if image:
+        try:
+            container_id, supervisor_port, supervisor_host = get_run_container(run, image.name, fail_if_gone=False)
+            supervisor_client = get_supervisor_client(supervisor_port, supervisor_host)
+        except RuntimeError as e:
+            logger.error(f"Unable to find the container of run {run_id}, its output may be incomplete: {str(e)}")
+
+    try:
+        complete_run(run, status, supervisor_client)
+    except SupervisorUnavailableError as e:
+        logger.error(f"Unable to fetch the output of run {run_id}: {str(e)}")
+        db.session.rollback()
+        complete_run(run, status)
+
+    return jsonify({'status': run.status})
+
+
 # Returns the logs of an agent run
 @app.route('/api/agent/<agent_id>/run/<run_id>/output', methods=['GET'])
 def get_run_output(agent_id, run_id):
     """
     Get the logs for a specific agent run.
     Update the output in the database if the run is in not yet in a final state.
+    If a cursor query parameter is provided (empty for the first call), only the output written
+    since that cursor is returned, along with the cursor to use for the next call.
     ---
     responses:
       200:
         description: Job output retrieved successfully
+      400:
+        description: Invalid cursor
       404:
         description: Job not found
     """
     try:
-      # Query the run from the database
-      run = db.session.query(Run).filter(Run.id == run_id, Run.agent_id == agent_id).first()
+      cursor = parse_cursor(request.args.get('cursor'))
+    except ValueError:
+      return create_error_response(f"Invalid cursor: {request.args.get('cursor')}", 400)
+
+    # The output of a run in a final state doesn't change anymore, it may be cached.
+    cache_key = ('output',) if cursor is None else ('output', request.args.get('cursor'))
+    cached_response = cached_run_response(agent_id, run_id, *cache_key)
+    if cached_response is not None:
+      return cached_response
+
+    try:
+      # Query the run from the database. The output is only loaded if needed.
+      run = db.session.query(Run).options(defer(Run.output)) \
+        .filter(Run.id == run_id, Run.agent_id == agent_id).first()
       if not run:
         return create_error_response(f"Run with id {run_id} not found for agent {agent_id}", 404)
       
@@ -276,31 +486,35 @@ def get_run_output(agent_id, run_id):
       if run.status == 'PENDING':
         return jsonify({})
 
-      # If the run is in a final state, return the output from the database
-      if run.status in ['DONE', 'ERROR']:
-        return jsonify(run.output)
-
-      # Query the image to get the container details
-      image = db.session.query(Image).filter(Image.id == run.image_id).first()
-      if not image:
-        return create_error_response(f"Image not found for run {run_id}", 404)
-        
-      # Get the container and supervisor port
-      container_id, supervisor_port = get_or_start_container(image.name)
-      
-      # Call the supervisor API to get the run output
-      response = requests.get(f'http://localhost:{supervisor_port}/api/run/{run_id}/output')
-      if response.status_code != 200:
-        logger.error(f"Failed to get run output: {response.text}")
-        return create_error_response(f"Failed to get run output: {response.text}", 500)
-        
-      # Extract the output from the JSON response
-      output_data = response.json()
-      
-      # Update the run record in the database with the output
-      run.output = output_data
-      db.session.commit()
-
+      # If the run is not in a final state, fetch the new output from the supervisor.
+      # Otherwise the output in the database is complete.
+      if run.status not in ['DONE', 'ERROR']:
+        # Query the image to get the container details
+        image = db.session.query(Image).filter(Image.id == run.image_id).first()
+        if not image:
+          return create_error_response(f"Image not found for run {run_id}", 404)
+          
+        # Get the container and supervisor port
+        try:
+          container_id, supervisor_port, supervisor_host = get_run_container(run, image.name)
+        except RunContainerNotFoundError:
+          if run.status not in FINAL_STATUSES:
+            raise
+          # Failed with its container: the output in the database is all there is.
+        else:
+          # Call the supervisor API to get the run output written since the last call
+          fetch_run_output(run, get_supervisor_client(supervisor_port, supervisor_host))
+
+      if cursor is None:
+        output_data = public_output(run.output)
+      else:
+        output_data = read_run_output(run.id, cursor)
+
+      if run.status in FINAL_STATUSES:
+        return final_run_response(agent_id, run_id, output_data, *cache_key)
+
+    except SupervisorUnavailableError as e:
+      return create_error_response(str(e), 503)
     except Exception as e:
       logger.error(f"Error retrieving run output: {str(e)}")
       return create_error_response(f"Internal server error: {str(e)}", 500)
@@ -308,6 +522,160 @@ def get_run_output(agent_id, run_id):
     return jsonify(output_data)
 
 
+# Streams the logs of an agent run
+@app.route('/api/agent/<agent_id>/run/<run_id>/stream', methods=['GET'])
+def stream_run_output(agent_id, run_id):
+    """
+    Stream the logs of an agent run as Server-Sent Events, until the run reaches a final state.
+    'stdout' and 'stderr' events carry the new output, a final 'status' event carries the status of the run.
+    Clients reconnecting with the Last-Event-ID header resume where they left off.
+    ---
+    responses:
+      200:
+        description: Event stream of the job output
+      404:
+        description: Job not found
+    """
+    run = db.session.query(Run).options(defer(Run.output)) \
+      .filter(Run.id == run_id, Run.agent_id == agent_id).first()
+    if not run:
+      return create_error_response(f"Run with id {run_id} not found for agent {agent_id}", 404)
+
+    # If the run is in a final state, send the output from the database
+    if run.status in ['DONE', 'ERROR']:
+      return Response(final_output_events(run), mimetype='text/event-stream')
+
+    # Query the image to get the container details
+    image = db.session.query(Image).filter(Image.id == run.image_id).first()
+    if not image:
+      return create_error_response(f"Image not found for run {run_id}", 404)
+
+    try:
+      container_id, supervisor_port, supervisor_host = get_run_container(run, image.name)
+      supervisor_client = get_supervisor_client(supervisor_port, supervisor_host)
+
+      headers = {}
+      if request.headers.get('Last-Event-ID'):
+        headers['Last-Event-ID'] = request.headers['Last-Event-ID']
+      response = supervisor_client.stream(f'/api/run/{run_id}/stream', headers=headers)
+    except RunContainerNotFoundError as e:
+      if run.status in FINAL_STATUSES:
+        # Failed with its container.
+        return Response(final_output_events(run), mimetype='text/event-stream')
+      return create_error_response(str(e), 503)
+    except SupervisorUnavailableError as e:
+      return create_error_response(str(e), 503)
+    except Exception as e:
+      logger.error(f"Error streaming run output: {str(e)}")
+      return create_error_response(f"Internal server error: {str(e)}", 500)
+
+    if response.status_code != 200:
+      response.close()
+      return create_error_response(f"Failed to stream run output: {response.text}", 500)
+
+    # Do not hold a database connection for the duration of the stream
+    db.session.close()
+
+    def generate():
+      event = None
+      final_status = None
+      try:
+        # Relay the supervisor events as they arrive, watching for the final status.
+        for line in response.iter_lines(decode_unicode=True):
+          if line.startswith('event:'):
+            event = line[len('event:'):].strip()
+          elif line.startswith('data:') and event == 'status':
+            final_status = json.loads(line[len('data:'):].strip()).get('status')
+          elif line == '':
+            event = None
+          yield line + '\n'
+      finally:
+        response.close()
+
+      # Store the complete output and the final status of the run
+      if final_status in FINAL_STATUSES:
+        run = db.session.get(Run, run_id)
+        if run.status not in FINAL_STATUSES:
+          complete_run(run, final_status, supervisor_client)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+      'Cache-Control': 'no-cache',
+      'X-Accel-Buffering': 'no',
+    })
+
+
+@app.route('/api/container/ready', methods=['POST'])
+def container_ready_callback():
+    """
+    Callback of a container supervisor once it is ready to serve requests.
+    Lets pending run starts proceed without waiting for the next readiness probe.
+    ---
+    responses:
+      200:
+        description: Readiness recorded
+      400:
+        description: Missing container id
+      403:
+        description: Invalid callback token
+    """
+    if not verify_callback_token(READY_CALLBACK_SUBJECT, request.args.get('token')):
+        return create_error_response("Invalid callback token", 403)
+
+    data = request.get_json(silent=True) or {}
+    container_id = data.get('containerId')
+    if not container_id:
+        return create_error_response("Request must contain 'containerId' field", 400)
+
+    logger.info(f"Supervisor of container {container_id} reported ready")
+    readiness_tracker.mark_ready(container_id)
+    return jsonify({'status': 'OK'})
+
+
+@app.route('/api/container/hosts', methods=['GET'])
+def get_container_hosts():
+    """
+    Get the docker hosts running the containers, with their capacity and the resources reserved on them.
+    ---
+    responses:
+      200:
+        description: Docker hosts statistics
+    """
+    return jsonify(dict(fleet.stats(), admission=admission_queue.stats()))
+
+
+@app.route('/api/db/pool', methods=['GET'])
+def get_db_pool_stats():
+    """
+    Get the state of the database connection pool of this process.
+    ---
+    responses:
+      200:
+        description: Connection pool statistics
+    """
+    pool = db.engine.pool
+    stats = {'mode': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checkedIn': pool.checkedin(),
+            'checkedOut': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    return jsonify(stats)
+
+
+@app.route('/api/run/cache', methods=['GET'])
+def get_run_cache_stats():
+    """
+    Get the state of the cache of the responses of the finished runs of this process.
+    ---
+    responses:
+      200:
+        description: Run response cache statistics
+    """
+    return jsonify(run_response_cache.stats())
+
+
 # Development endpoint to test the proxy
 @app.route('/api/echo', methods=['POST'])
 def proxy():
@@ -0,0 +1,155 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+from flask import Response, request
+
+from api import app
+
+# Cache of the responses about runs in a final state (DONE or ERROR).
+#
+# The status and output of a run don't change anymore once it is in a final state, so the serialized
+# responses are kept in memory, in an LRU bounded by their total size, and optionally shared between the
+# manager processes through a Redis compatible store. Repeated fetches of finished runs don't reach the
+# database. Responses carry an ETag, so that clients revalidating them get a 304 without a body.
+
+# Maximum total size in bytes of the cached responses of this process. 0 disables the cache.
+RUN_CACHE_MAX_BYTES = int(os.getenv("RUN_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Redis compatible store shared by the manager processes, e.g. redis://localhost:6379/0. Optional.
+RUN_CACHE_REDIS_URL = os.getenv("RUN_CACHE_REDIS_URL")
+# Number of seconds the responses are kept in the shared store.
+RUN_CACHE_REDIS_TTL = int(os.getenv("RUN_CACHE_REDIS_TTL", str(24 * 3600)))
+
+logger = logging.getLogger(__name__)
+
+
+class RunResponseCache:
+    """
+    LRU of serialized responses, bounded by their total size in bytes, backed by an optional shared store.
+    """
+
+    def __init__(self, max_bytes=RUN_CACHE_MAX_BYTES, redis_url=RUN_CACHE_REDIS_URL, redis_ttl=RUN_CACHE_REDIS_TTL):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._redis = None
+        self._redis_ttl = redis_ttl
+        self._hits = 0
+        self._shared_hits = 0
+        self._misses = 0
+        if redis_url and max_bytes > 0:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(redis_url)
+            except ImportError:
+                logger.warning("RUN_CACHE_REDIS_URL is set but the redis package is not installed. "
+                               "Using the in-process cache only.")
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def _redis_key(key):
+        return "launchpad:run:" + ":".join(str(part) for part in key)
+
+    def get(self, key):
+        """
+        Returns the cached body for the key, or None.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return body
+
+        if self._redis is not None:
+            try:
+                body = self._redis.get(self._redis_key(key))
+            except Exception as e:
+                logger.warning(f"Failed to read the shared run cache: {str(e)}")
+                body = None
+            if body is not None:
+                with self._lock:
+                    self._shared_hits += 1
+                self._put_local(key, body)
+                return body
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, key, body):
+        if not self.enabled:
+            return
+        self._put_local(key, body)
+        if self._redis is not None:
+            try:
+                self._redis.set(self._redis_key(key), body, ex=self._redis_ttl)
+            except Exception as e:
+                logger.warning(f"Failed to write the shared run cache: {str(e)}")
+
+    def _put_local(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        """
+        Size of the cache of this process, and its hits and misses since the process started.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'maxBytes': self.max_bytes,
+                'shared': self._redis is not None,
+                'hits': self._hits,
+                'sharedHits': self._shared_hits,
+                'misses': self._misses,
+            }
+
+
+run_response_cache = RunResponseCache()
+
+
+def json_response(body):
+    """
+    Response for the serialized JSON body, with an ETag. Answers 304 if the request has a matching If-None-Match.
+    """
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
+
+
+def cached_run_response(agent_id, run_id, *key):
+    """
+    Returns the cached response for the run, or None if not cached.
+    key identifies the response among the responses about the run.
+    """
+    body = run_response_cache.get((str(agent_id), str(run_id), *key))
+    if body is None:
+        return None
+    return json_response(body)
+
+
+def final_run_response(agent_id, run_id, data, *key):
+    """
+    Serialize the response about a run in a final state, cache it and return it.
+    """
+    body = app.json.dumps(data).encode()
+    run_response_cache.put((str(agent_id), str(run_id), *key), body)
+    return json_response(body)
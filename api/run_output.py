@@ -0,0 +1,150 @@
+import logging
+
+from sqlalchemy import Integer, Text, cast, func, select, update
+
+from api import db
+from api.models import Run
+
+# Helpers to store the output of agent runs incrementally.
+#
+# Run.output holds the stdout and stderr of the run, along with the byte offsets in the supervisor
+# log files up to which they have been fetched:
+#   {'stdout': '...', 'stderr': '...', 'stdout_offset': 1234, 'stderr_offset': 56}
+# Each poll only fetches the bytes written since these offsets, and appends them in the database
+# rather than rewriting the whole JSON column.
+#
+# Clients follow the output with a cursor, 'stdout_length:stderr_length' in characters of the stored
+# output, and only receive the output written since their cursor.
+
+OUTPUT_STREAMS = ('stdout', 'stderr')
+
+logger = logging.getLogger(__name__)
+
+
+def _stored_text(stream):
+    return func.coalesce(Run.output[stream].as_string(), '')
+
+
+def _stored_offset(stream):
+    return func.coalesce(cast(Run.output[f'{stream}_offset'].as_string(), Integer), 0)
+
+
+def parse_cursor(value):
+    """
+    Parse an output cursor. Returns None if no cursor was provided.
+    Raises ValueError if the cursor is malformed.
+    """
+    if value is None:
+        return None
+    if value == '':
+        return {'stdout': 0, 'stderr': 0}
+    stdout_length, stderr_length = (int(length) for length in value.split(':'))
+    if stdout_length < 0 or stderr_length < 0:
+        raise ValueError(f"Invalid output cursor: {value}")
+    return {'stdout': stdout_length, 'stderr': stderr_length}
+
+
+def format_cursor(lengths):
+    return f"{lengths['stdout']}:{lengths['stderr']}"
+
+
+def public_output(output):
+    """
+    Strip the internal offsets from the output stored in the database.
+    """
+    if not isinstance(output, dict):
+        return output
+    return {stream: output.get(stream, '') for stream in OUTPUT_STREAMS}
+
+
+def get_output_offsets(run_id):
+    """
+    Returns the supervisor log offsets (bytes) up to which the output of the run is stored.
+    """
+    row = db.session.execute(
+        select(_stored_offset('stdout'), _stored_offset('stderr')).where(Run.id == run_id)
+    ).one()
+    return {'stdout': row[0], 'stderr': row[1]}
+
+
+def get_runs_output_offsets(run_ids):
+    """
+    Returns the supervisor log offsets of several runs in one query, as {run_id: offsets}.
+    """
+    rows = db.session.execute(
+        select(Run.id, _stored_offset('stdout'), _stored_offset('stderr')).where(Run.id.in_(run_ids))
+    ).all()
+    return {row[0]: {'stdout': row[1], 'stderr': row[2]} for row in rows}
+
+
+def append_run_output(run_id, offsets, delta, commit=True):
+    """
+    Append the output read from the supervisor log files, starting at the given offsets.
+    delta is the response of the supervisor output API.
+    The update is skipped if the stored offsets moved in the meantime, i.e. a concurrent poll
+    already appended this output. Returns True if the output was appended.
+    With commit=False, the caller commits, e.g. once for a batch of runs.
+    """
+    values = []
+    for stream in OUTPUT_STREAMS:
+        values += [
+            cast(stream, Text), _stored_text(stream) + cast(delta[stream], Text),
+            cast(f'{stream}_offset', Text), cast(delta[f'{stream}_offset'], Integer),
+        ]
+
+    result = db.session.execute(
+        update(Run)
+        .where(Run.id == run_id,
+               _stored_offset('stdout') == offsets['stdout'],
+               _stored_offset('stderr') == offsets['stderr'])
+        .values(output=func.jsonb_build_object(*values))
+        .execution_options(synchronize_session=False)
+    )
+    if commit:
+        db.session.commit()
+    return result.rowcount > 0
+
+
+def fetch_run_output(run, supervisor_client):
+    """
+    Fetch the output written by the run since the last fetch from its supervisor, and store it.
+    """
+    offsets = get_output_offsets(run.id)
+    response = supervisor_client.get(f'/api/run/{run.id}/output', params={
+        'stdout_offset': offsets['stdout'],
+        'stderr_offset': offsets['stderr'],
+    })
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to get run output: {response.text}")
+
+    delta = response.json()
+    if 'stdout_offset' not in delta:
+        # Supervisor of an image built before incremental output was supported.
+        # It returns the whole output on every call.
+        run.output = public_output(delta)
+        db.session.commit()
+        return
+
+    if delta['stdout'] or delta['stderr']:
+        append_run_output(run.id, offsets, delta)
+
+
+def read_run_output(run_id, cursor):
+    """
+    Returns the output stored for the run after the given cursor, along with the next cursor.
+    Only the new part of the output is read from the database.
+    """
+    row = db.session.execute(
+        select(
+            func.substr(_stored_text('stdout'), cursor['stdout'] + 1),
+            func.substr(_stored_text('stderr'), cursor['stderr'] + 1),
+            func.length(_stored_text('stdout')),
+            func.length(_stored_text('stderr')),
+        ).where(Run.id == run_id)
+    ).one()
+    stdout, stderr, stdout_length, stderr_length = row
+    return {
+        'stdout': stdout,
+        'stderr': stderr,
+        'cursor': format_cursor({'stdout': stdout_length, 'stderr': stderr_length}),
+    }
@@ -0,0 +1,177 @@
+import json
+import logging
+
+from sqlalchemy.orm.attributes import flag_modified
+
+from api import db
+from api.models import Agent, Image, Run
+from api.callbacks import get_run_callback_url
+from api.container.manage import find_container, is_container_gone
+from api.container.resources import get_resource_profile
+from api.container.supervisor_client import SupervisorUnavailableError
+from api.run_output import fetch_run_output, public_output
+from api.utils import format_sse
+
+FINAL_STATUSES = ('DONE', 'ERROR')
+# Statuses reported by the supervisors.
+# QUEUED runs wait for a slot in their container, they are stored as RUNNING.
+SUPERVISOR_STATUSES = ('QUEUED', 'RUNNING', 'DONE', 'ERROR')
+
+logger = logging.getLogger(__name__)
+
+
+class RunNotFoundError(LookupError):
+    """
+    The agent, or the image to run it, does not exist.
+    """
+    pass
+
+
+class RunContainerNotFoundError(SupervisorUnavailableError):
+    """
+    The container of the run is not running, or its docker host can't be reached.
+    """
+    pass
+
+
+def create_run(agent_id, inputs):
+    """
+    Record a PENDING run of the most recent successfully built image of the agent.
+    Returns the tuple (agent, image, run). Raises RunNotFoundError if there is no agent or image.
+    """
+    # Query the agent from the database
+    agent = db.session.query(Agent).filter(Agent.id == agent_id).first()
+    if not agent:
+        raise RunNotFoundError(f"Agent with id {agent_id} not found")
+
+    # Query the most recent successfully built image from the database
+    image = db.session.query(Image).filter(Image.agent_id == agent_id, Image.build_status == 'DONE') \
+        .order_by(Image.id.desc()).first()
+    if not image:
+        raise RunNotFoundError(f"No image found for agent {agent_id}")
+
+    # Insert the run record into the database
+    config = {
+        'agent': agent.config,
+        'inputs': inputs
+    }
+    run = Run(agent_id=agent_id, image_id=image.id, config=config, status="PENDING")
+    db.session.add(run)
+    db.session.commit()
+    logger.info(f"Run record created in database for agent {agent_id}")
+    return agent, image, run
+
+
+def get_start_payload(agent, run, inputs):
+    """
+    Request payload of the supervisor API starting the run, with the environment variables, inputs,
+    and the limits of the run from the resource profile of the agent.
+    """
+    return {
+        'envs': agent.config.get('envs', {}),
+        'inputs': inputs,
+        'limits': get_resource_profile(agent.config).run_limits(),
+        'callbackUrl': get_run_callback_url(run)
+    }
+
+
+def record_run_start(run, error=None, container_id=None):
+    """
+    Record the outcome of the start of the run by its supervisor: RUNNING, or ERROR with the error message.
+    The container the run was started in, if given, is recorded in the run configuration.
+    """
+    if container_id is not None:
+        run.config['containerId'] = container_id
+        flag_modified(run, 'config')
+    if error is None:
+        run.status = "RUNNING"
+    else:
+        run.status = 'ERROR'
+        run.output = 'Error: ' + error
+    db.session.commit()
+
+
+def final_output_events(run):
+    """
+    Server-Sent Events replaying the output of a run in a final state, followed by its status.
+    """
+    output = public_output(run.output)
+    if not isinstance(output, dict):
+        output = {'stderr': str(output or '')}
+    events = [format_sse(stream, content) for stream, content in output.items() if content]
+    events.append(format_sse('status', json.dumps({'status': run.status})))
+    return events
+
+
+def complete_run(run, status, supervisor_client=None, commit=True):
+    """
+    Move the run to a final status. If a supervisor client is provided, the output written by the run
+    since the last fetch is stored first, so that the output of a completed run is complete.
+    With commit=False, the caller commits, e.g. once for a batch of runs.
+    """
+    if supervisor_client is not None:
+        fetch_run_output(run, supervisor_client)
+    run.status = status
+    if commit:
+        db.session.commit()
+    logger.info(f"Run {run.id} completed with status {status}")
+
+
+def apply_run_status(run, status, supervisor_client, commit=True):
+    """
+    Record the status of the run reported by its supervisor.
+    Raises ValueError if the status is not a valid supervisor status.
+    """
+    if status not in SUPERVISOR_STATUSES:
+        raise ValueError(f"Invalid status: {status}")
+
+    logger.info(f"Run {run.id} status: {status}")
+    if status in FINAL_STATUSES:
+        complete_run(run, status, supervisor_client, commit=commit)
+    elif status != 'QUEUED':
+        run.status = status
+        if commit:
+            db.session.commit()
+
+
+def get_run_container(run, image_name, fail_if_gone=True):
+    """
+    Returns the tuple (container_id, port, host) of the container running the run.
+    Runs started before their container was recorded are looked up among the containers of their image.
+    Never starts a container, which wouldn't know the run: raises RunContainerNotFoundError if the container
+    is not found. If docker confirms that it is gone, the run is first completed as ERROR, unless fail_if_gone
+    is False.
+    """
+    container_id = run.config.get('containerId')
+    container_info = find_container(image_name, container_id)
+    if container_info is not None:
+        return container_info
+    if fail_if_gone and run.status not in FINAL_STATUSES and is_container_gone(image_name, container_id):
+        # The agent process of the run ended with its container.
+        logger.warning(f"Container of run {run.id} is not running anymore, marking it as failed")
+        complete_run(run, 'ERROR')
+        raise RunContainerNotFoundError(f"The container of run {run.id} is gone")
+    raise RunContainerNotFoundError(f"The container of run {run.id} can't be reached")
+
+
+def get_supervisor_runs_status(supervisor_client, run_ids, offsets=None):
+    """
+    Get the status of the runs from their supervisor in one call. Returns {run_id: status}.
+    With the output offsets of the runs, {run_id: offsets}, each status also has the output written since
+    these offsets in 'output', unless the supervisor predates it.
+    Falls back to one call per run for the supervisors of images built before the batch endpoint existed.
+    """
+    body = {'runIds': run_ids}
+    if offsets is not None:
+        body['offsets'] = {str(run_id): run_offsets for run_id, run_offsets in offsets.items()}
+    response = supervisor_client.post('/api/runs/status', json=body)
+    if response.status_code == 200:
+        return response.json()['runs']
+    if response.status_code != 404:
+        raise RuntimeError(f"Failed to get runs status: {response.text}")
+
+    statuses = {}
+    for run_id in run_ids:
+        response = supervisor_client.get(f'/api/run/{run_id}/status')
+        statuses[str(run_id)] = dict(response.json(), code=response.status_code)
+    return statuses
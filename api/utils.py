@@ -13,6 +13,15 @@ def create_error_response(message: str, status_code: int, log=True) -> Tuple[Any
         'status_code': status_code
     }), status_code
 
+def format_sse(event: str, data: str, event_id: str = None) -> str:
+    """Format a Server-Sent Event. Multi-line data is sent as multiple data fields."""
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    for line in data.split("\n"):
+        message += f"data: {line}\n"
+    return message + "\n"
+
 def validate_job_id(job_id: str) -> bool:
     """Validate that a job ID is a valid integer."""
     try:
@@ -0,0 +1,17 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+from api.asgi import asgi_app as app
+from api.admission import admission_queue
+from api.reconciler import start_reconciler
+
+# From crewai main.py
+import warnings
+warnings.filterwarnings("ignore", category=SyntaxWarning, module="pysbd")
+
+# Keep the runs in progress up to date in the background
+start_reconciler()
+# Start the runs waiting for capacity, also those that were waiting before a restart
+admission_queue.start()
+
+# Async serving mode, run with: uvicorn asgi:app --host 0.0.0.0 --port 5000
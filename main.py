@@ -1,12 +1,33 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import signal
+import sys
+
 from api import app
+from api.admission import admission_queue
+from api.reconciler import start_reconciler
+from api.image.worker import drain_builds
 
 # From crewai main.py
 import warnings
 warnings.filterwarnings("ignore", category=SyntaxWarning, module="pysbd")
 
+# Keep the runs in progress up to date in the background
+start_reconciler()
+# Start the runs waiting for capacity, also those that were waiting before a restart
+admission_queue.start()
+
+
+def shutdown(signum, frame):
+    # Let the builds running in this process complete before it exits
+    drain_builds()
+    sys.exit(0)
+
+
+signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGINT, shutdown)
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -1,5 +1,6 @@
 import os
-import time
+import signal
+import threading
 import logging
 import requests
 
@@ -7,18 +8,64 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
-
-while True:
-    try:
-        response = requests.get("http://localhost:8080/api/job/process")
-        if response.status_code == 200:
-            logging.info(f"Processed job ID {response.json()['job_id']}")
-        elif response.status_code == 204:
-            logging.info("No job to process")
-        else:
-            logging.error(f"Failed to process job: {response.status_code} - {response.text}")
-    except requests.RequestException as e:
-        logging.error(f"HTTP request failed: {e}")
-    
-    time.sleep(5)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+PROCESSOR_API_URL = os.getenv("PROCESSOR_API_URL", "http://localhost:8080")
+# Dispatch trigger of the image builds: the workers long-poll the manager, which claims a pending build once
+# one of its build workers is idle, and starts it in its own build workers (BUILD_WORKERS). The request
+# returns once the build is started, the processor doesn't wait for it nor add build capacity.
+
+# Number of concurrent long-poll requests. Each claims at most one build per idle build worker of the manager.
+PROCESSOR_CONCURRENCY = int(os.getenv("PROCESSOR_CONCURRENCY", "4"))
+# Maximum number of seconds a request waits for a job. The server caps it with JOB_POLL_TIMEOUT.
+# Also bounds the time to drain the workers waiting for a job on shutdown.
+JOB_POLL_TIMEOUT = float(os.getenv("JOB_POLL_TIMEOUT", "25"))
+# Margin in seconds over JOB_POLL_TIMEOUT before a request is considered lost.
+READ_TIMEOUT_MARGIN = 30
+# Delay in seconds before retrying after an error.
+ERROR_RETRY_DELAY = 5
+
+# Set on SIGTERM / SIGINT: the workers finish the request in flight and stop polling.
+stopping = threading.Event()
+
+
+def process_jobs():
+    # Jobs are long-polled: the request returns as soon as a job is available, so there is no need to sleep
+    # between requests. The session keeps the connection to the server open across requests.
+    session = requests.Session()
+    while not stopping.is_set():
+        try:
+            # The response comes within JOB_POLL_TIMEOUT: the build is not waited for.
+            response = session.get(f"{PROCESSOR_API_URL}/api/job/process",
+                                   params={"timeout": JOB_POLL_TIMEOUT},
+                                   timeout=(5, JOB_POLL_TIMEOUT + READ_TIMEOUT_MARGIN))
+            if response.status_code == 202:
+                logging.info(f"Started job ID {response.json()['job_id']}")
+            elif response.status_code == 204:
+                logging.debug("No job to process")
+            else:
+                logging.error(f"Failed to process job: {response.status_code} - {response.text}")
+                stopping.wait(ERROR_RETRY_DELAY)
+        except requests.RequestException as e:
+            logging.error(f"HTTP request failed: {e}")
+            stopping.wait(ERROR_RETRY_DELAY)
+    session.close()
+
+
+def stop(signum, frame):
+    logging.info(f"Received signal {signum}, draining the requests in flight")
+    stopping.set()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers = [threading.Thread(target=process_jobs, name=f"worker_{i}") for i in range(PROCESSOR_CONCURRENCY)]
+    for worker in workers:
+        worker.start()
+    logging.info(f"Processor started with {PROCESSOR_CONCURRENCY} workers")
+
+    for worker in workers:
+        worker.join()
+    logging.info("Processor stopped")
@@ -7,7 +7,6 @@
 import argparse
 import sys
 import os
-import subprocess
 from pathlib import Path
 import json
 
@@ -94,31 +93,29 @@ if __name__ == "__main__":
         with open(inputs_file, 'w') as f:
             json.dump(inputs, f, indent=2)
 
-        # Start the subprocess
+        # Start the agent
         agent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../agent")
-        with open(stdout_log, 'w') as stdout_file, open(stderr_log, 'w') as stderr_file:
-            # Create a copy of the current environment and add CREW_INPUT_JSON
-            env = os.environ.copy()
-            env['CREW_INPUT_JSON'] = inputs_file
-            
-            # Start the subprocess
-            process = subprocess.Popen(
-                ["uv", "run", "crewai", "run"],
-                stdout=stdout_file,
-                stderr=stderr_file,
-                cwd=agent_dir,  # Note: we change the working directory to the agent directory
-                env=env  # Pass the modified environment to the subprocess
-            )
-            
-            # Get the PID of the process and store it in a file
-            pid = process.pid
-            pid_file = os.path.join(run_dir, "pid")
-            with open(pid_file, 'w') as f:
-                f.write(str(pid))
-        
-        # Note: we do not wait for the process to complete.
-        # The supervisor will monitor the process and handle the completion.
-        print(f"Agent execution started. Logs will be stored under {run_dir}")
+
+        # Create a copy of the current environment and add CREW_INPUT_JSON
+        env = os.environ.copy()
+        env['CREW_INPUT_JSON'] = inputs_file
+
+        print(f"Starting agent execution. Logs will be stored under {run_dir}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        # Redirect the output to the log files and replace the launcher process with the agent.
+        # The agent keeps the PID of the launcher, so that the supervisor which started the launcher
+        # owns the agent process: it reaps it and records its exit code.
+        stdout_fd = os.open(stdout_log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        stderr_fd = os.open(stderr_log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(stdout_fd, sys.stdout.fileno())
+        os.dup2(stderr_fd, sys.stderr.fileno())
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+
+        os.chdir(agent_dir)  # Note: we change the working directory to the agent directory
+        os.execvpe("uv", ["uv", "run", "crewai", "run"], env)
         
     else:
         print(f"Unknown command: {command}")
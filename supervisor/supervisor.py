@@ -1,10 +1,52 @@
+import json
 import logging
 import os
+import signal
+import socket
 import subprocess
-from flask import Flask, request, jsonify
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import WSGIRequestHandler, is_running_from_reloader
+
+from zygote import rusage_to_dict
 
 SUPERVISOR_PORT = 4000
 
+# Interval in seconds between two reads of the log files when streaming the output of a run.
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "0.2"))
+# Maximum interval in seconds without sending anything on an output stream.
+STREAM_KEEPALIVE_INTERVAL = float(os.getenv("STREAM_KEEPALIVE_INTERVAL", "15"))
+# Number of attempts to notify the manager of the completion of a run.
+CALLBACK_ATTEMPTS = int(os.getenv("CALLBACK_ATTEMPTS", "5"))
+# cgroup v2 directory under which each run gets its own cgroup, with the limits sent by the manager.
+# It must be writable by the supervisor (e.g. a delegated cgroup), otherwise the runs are only bound
+# by the limits of the container.
+RUN_CGROUP_ROOT = os.getenv("RUN_CGROUP_ROOT", "/sys/fs/cgroup")
+# Period in microseconds of the CPU quota of the runs.
+CPU_QUOTA_PERIOD = 100000
+# Maximum number of seconds to wait for the processes left in the cgroup of a completed run to be killed.
+CGROUP_DRAIN_TIMEOUT = 5
+# Maximum number of runs executing concurrently in the container. Further runs wait in a FIFO queue.
+# 0 for no limit.
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", "4"))
+# How the agent processes are started:
+# - direct: the entry point of the agent is spawned with the interpreter of the agent environment synced
+#   when the image was built, without resolving the environments on each start (default)
+# - fork: forked from a fork server (zygote.py) which already imported the agent and CrewAI. Runs are
+#   spawned directly while the fork server is starting or unavailable. The envs of a run are only set
+#   after the imports: the values read at import time are those of the fork server.
+# - uv: through launcher.py and `uv run crewai run`
+AGENT_LAUNCH_MODE = os.getenv("AGENT_LAUNCH_MODE", "direct")
+# Script of the agent environment started in direct mode. By default, the one `crewai run` would start:
+# `kickoff` for the flows, `run_crew` otherwise.
+AGENT_ENTRY_POINT = os.getenv("AGENT_ENTRY_POINT")
+# Interval in seconds at which the agent processes left by a fork server that died are checked for exit.
+ORPHAN_POLL_INTERVAL = 1
+
 app = Flask(__name__)
 
 logger = logging.getLogger(__name__)
@@ -14,31 +56,397 @@ logger = logging.getLogger(__name__)
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 runs_root_dir = os.path.join(parent_dir, "runs")
+# The agent project, and its environment synced when the image was built.
+agent_dir = os.path.join(parent_dir, "agent")
+agent_venv_dir = os.path.join(agent_dir, ".venv")
+
+# Agent processes started by this supervisor and still running, keyed by run id.
+runs = {}
+# Runs waiting for a slot, as (run_id, start request), in arrival order.
+run_queue = deque()
+runs_lock = threading.Lock()
+
+# Whether the per-run cgroups can be created, None until checked.
+run_cgroups_enabled = None
+run_cgroups_lock = threading.Lock()
+
+
+def write_cgroup_file(cgroup_dir, name, value):
+  with open(os.path.join(cgroup_dir, name), 'w') as f:
+    f.write(str(value))
+
+
+def enable_run_cgroups():
+  """
+  Prepare RUN_CGROUP_ROOT for the per-run cgroups, once. Returns False if they are not available.
+  """
+  global run_cgroups_enabled
+  with run_cgroups_lock:
+    if run_cgroups_enabled is not None:
+      return run_cgroups_enabled
+
+    run_cgroups_enabled = False
+    controllers_path = os.path.join(RUN_CGROUP_ROOT, "cgroup.controllers")
+    if not os.path.exists(controllers_path) or not os.access(RUN_CGROUP_ROOT, os.W_OK):
+      logger.warning(f"{RUN_CGROUP_ROOT} is not a writable cgroup v2 directory, the run limits are not applied")
+      return False
+
+    try:
+      # A cgroup with processes can't delegate controllers to its children (no internal processes rule):
+      # move the processes of the container to a leaf cgroup first.
+      supervisor_cgroup = os.path.join(RUN_CGROUP_ROOT, "supervisor")
+      os.makedirs(supervisor_cgroup, exist_ok=True)
+      with open(os.path.join(RUN_CGROUP_ROOT, "cgroup.procs")) as f:
+        pids = f.read().split()
+      for pid in pids:
+        try:
+          write_cgroup_file(supervisor_cgroup, "cgroup.procs", pid)
+        except OSError:
+          # The process exited in between.
+          pass
+
+      with open(controllers_path) as f:
+        available = f.read().split()
+      controllers = [controller for controller in ("cpu", "memory", "pids") if controller in available]
+      write_cgroup_file(RUN_CGROUP_ROOT, "cgroup.subtree_control", " ".join(f"+{c}" for c in controllers))
+    except OSError as e:
+      logger.warning(f"Failed to set up the run cgroups, the run limits are not applied: {e}")
+      return False
+
+    run_cgroups_enabled = True
+    return True
+
+
+def create_run_cgroup(run_id, limits):
+  """
+  Create the cgroup of a run with the given limits: cpus (CPU quota), memory (bytes, without swap) and pids.
+  Returns its path, or None if the limits can't be applied.
+  """
+  if not limits or not enable_run_cgroups():
+    return None
+
+  cgroup_dir = os.path.join(RUN_CGROUP_ROOT, f"run_{run_id}")
+  try:
+    os.makedirs(cgroup_dir, exist_ok=True)
+    if limits.get("cpus"):
+      write_cgroup_file(cgroup_dir, "cpu.max", f"{int(limits['cpus'] * CPU_QUOTA_PERIOD)} {CPU_QUOTA_PERIOD}")
+    if limits.get("memory"):
+      write_cgroup_file(cgroup_dir, "memory.max", int(limits["memory"]))
+      if os.path.exists(os.path.join(cgroup_dir, "memory.swap.max")):
+        write_cgroup_file(cgroup_dir, "memory.swap.max", 0)
+    if limits.get("pids"):
+      write_cgroup_file(cgroup_dir, "pids.max", int(limits["pids"]))
+  except OSError as e:
+    logger.warning(f"Failed to apply the limits {limits} to run {run_id}: {e}")
+    remove_run_cgroup(cgroup_dir)
+    return None
+  logger.info(f"Run {run_id} limited to {limits}")
+  return cgroup_dir
+
+
+def in_run_cgroup(cgroup_dir, command):
+  """
+  Wrap the command so that its process joins the cgroup, then replaces itself with the command.
+  Joining in the child itself rather than in a preexec_fn keeps the fast spawn path of subprocess, and
+  runs no Python code between fork and exec in this multi-threaded process.
+  """
+  if not cgroup_dir:
+    return command
+  # 0 stands for the writing process. Without the cgroup, the run is only bound by the container limits.
+  return ["sh", "-c", '{ echo 0 > "$1/cgroup.procs"; } 2>/dev/null; shift; exec "$@"', "sh", cgroup_dir] + command
+
+
+def remove_run_cgroup(cgroup_dir):
+  """
+  Remove the cgroup of a run. The processes left by the agent, e.g. background children, are killed first:
+  a cgroup can only be removed once empty.
+  """
+  try:
+    if os.path.exists(os.path.join(cgroup_dir, "cgroup.kill")):
+      write_cgroup_file(cgroup_dir, "cgroup.kill", 1)
+    else:
+      # Kernels before 5.14.
+      with open(os.path.join(cgroup_dir, "cgroup.procs")) as f:
+        for pid in f.read().split():
+          try:
+            os.kill(int(pid), signal.SIGKILL)
+          except ProcessLookupError:
+            pass
+    # The killed processes leave the cgroup asynchronously.
+    deadline = time.monotonic() + CGROUP_DRAIN_TIMEOUT
+    while True:
+      with open(os.path.join(cgroup_dir, "cgroup.procs")) as f:
+        if not f.read().strip() or time.monotonic() >= deadline:
+          break
+      time.sleep(0.01)
+    os.rmdir(cgroup_dir)
+  except OSError as e:
+    logger.warning(f"Failed to remove cgroup {cgroup_dir}: {e}")
 
 @app.route('/api/run/<run_id>/start', methods=['POST'])
 def start_agent(run_id):
   """
   Start a new agent run with the given run ID.
+  The run is queued if MAX_CONCURRENT_RUNS runs are already running, and started in order as runs complete.
   """
   logger.info(f"Starting run id {run_id} of agent")
+  run_id = str(run_id)
 
   # Parse the incoming JSON request
   logger.info(f"Request: {request}")
   data = request.get_json()
-  
-  # Extract the required fields
-  envs = data.get('envs', {})
-  inputs = data.get('inputs', {})
 
-  # Log or use the extracted data
-  logger.info(f"Environment variables: {envs}")
-  logger.info(f"Inputs: {inputs}")
-  
-  # Prepare the command
+  # Create the run directory before starting the agent, so that the status of the run is known right away.
+  run_dir = os.path.join(runs_root_dir, run_id)
+  os.makedirs(run_dir, exist_ok=True)
+
+  with runs_lock:
+    if run_id in runs or any(queued_id == run_id for queued_id, _ in run_queue):
+      return jsonify({"status": "ERROR", "message": f"Run {run_id} was already started"}), 409
+    run_queue.append((run_id, data))
+  dispatch_runs()
+
+  status, _ = get_run_status(run_id)
+  if status["status"] == "QUEUED":
+    logger.info(f"Run {run_id} queued at position {status['position']}")
+    return jsonify(dict(status, message="Agent queued"))
+  pid_file_path = os.path.join(run_dir, "pid")
+  if not os.path.exists(pid_file_path):
+    with runs_lock:
+      launching = run_id in runs
+    if launching:
+      # Being launched by the thread of a completed run, which dispatched it while this request queued it.
+      return jsonify({"status": "RUNNING", "message": "Agent starting"})
+    return jsonify({"status": "ERROR", "message": status.get("message", "Failed to start the agent")}), 500
+  with open(pid_file_path, 'r') as f:
+    pid = int(f.read().strip())
+  # Return the process ID in the response
+  return jsonify({"status": "RUNNING", "message": "Agent started", "pid": pid})
+
+
+def dispatch_runs():
+  """
+  Launch the queued runs, in order, while less than MAX_CONCURRENT_RUNS runs are running.
+  """
+  while True:
+    with runs_lock:
+      if not run_queue or (MAX_CONCURRENT_RUNS and len(runs) >= MAX_CONCURRENT_RUNS):
+        return
+      run_id, data = run_queue.popleft()
+      # Hold the slot of the run while it is launched.
+      runs[run_id] = None
+
+    try:
+      launch_run(run_id, data)
+    except Exception as e:
+      logger.error(f"Failed to launch run {run_id}: {e}")
+      with runs_lock:
+        runs.pop(run_id, None)
+      now = time.time()
+      write_run_result(run_id, {
+        "status": "ERROR",
+        "exit_code": None,
+        "started_at": now,
+        "ended_at": now,
+        "duration": 0,
+        "rusage": {},
+        "message": f"Failed to launch the agent: {e}",
+      })
+      if data.get('callbackUrl'):
+        threading.Thread(target=post_to_manager, name=f"run_{run_id}",
+                         args=(data['callbackUrl'], {"status": "ERROR"}, f"the failure of run {run_id}"),
+                         daemon=True).start()
+
+
+def get_agent_entry_point():
+  """
+  Name of the script of the agent environment running the agent.
+  """
+  if AGENT_ENTRY_POINT:
+    return AGENT_ENTRY_POINT
+  try:
+    import tomllib
+    with open(os.path.join(agent_dir, "pyproject.toml"), 'rb') as f:
+      crew_type = tomllib.load(f).get("tool", {}).get("crewai", {}).get("type")
+  except (ImportError, OSError, ValueError):
+    crew_type = None
+  return "kickoff" if crew_type == "flow" else "run_crew"
+
+
+def get_agent_command():
+  """
+  Command starting the agent directly from its environment, or None if the environment was not synced.
+  """
+  entry_point = os.path.join(agent_venv_dir, "bin", get_agent_entry_point())
+  if not os.access(entry_point, os.X_OK):
+    return None
+  return [entry_point]
+
+
+def get_agent_base_env():
+  """
+  Environment of the processes of the agent environment, as `uv run` would set it in the agent directory.
+  """
+  env = os.environ.copy()
+  # Not the environment of the supervisor.
+  env['VIRTUAL_ENV'] = agent_venv_dir
+  env['PATH'] = os.path.join(agent_venv_dir, "bin") + os.pathsep + env.get('PATH', '')
+  env.pop('PYTHONHOME', None)
+  return env
+
+
+def get_agent_env(run_dir, envs, inputs):
+  """
+  Environment of the agent process of a run, with the environment variables of the run and the path of
+  its inputs in CREW_INPUT_JSON.
+  """
+  # Dump the inputs in a JSON file for the agent to read at startup
+  inputs_file = os.path.join(run_dir, "inputs.json")
+  with open(inputs_file, 'w') as f:
+    json.dump(inputs, f, indent=2)
+
+  env = get_agent_base_env()
+  env.update({key: str(value) for key, value in envs.items()})
+  env['CREW_INPUT_JSON'] = inputs_file
+  return env
+
+
+def is_process_running(pid):
+  """
+  Whether the process is running. A zombie, exited but not reaped by its parent, is not.
+  """
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  try:
+    with open(f"/proc/{pid}/stat") as f:
+      # The state follows the command name, which is in parentheses and may contain spaces.
+      return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+  except (OSError, IndexError):
+    return True
+
+
+class ForkedRun:
+  """
+  Agent process of a run forked by the fork server. It is a child of the fork server, which reports its exit.
+  """
+
+  def __init__(self, pid, conn, reader):
+    self.pid = pid
+    self.returncode = None
+    self._conn = conn
+    self._reader = reader
+
+  def wait(self):
+    """
+    Wait for the agent process to exit. Returns its exit code, None if unknown because the fork server died,
+    and its resource usage.
+    """
+    with self._conn, self._reader:
+      line = self._reader.readline()
+    if not line:
+      logger.error(f"Fork server exited while running process {self.pid}, waiting for the process to exit")
+      return self._wait_orphan()
+    result = json.loads(line)
+    self.returncode = result["exit_code"]
+    return self.returncode, result["rusage"]
+
+  def _wait_orphan(self):
+    """
+    Wait for the agent process to exit after the fork server died. Its exit code is only known if it was
+    adopted by this process, e.g. when the supervisor is the init process of the container.
+    """
+    while True:
+      try:
+        pid, wait_status, rusage = os.wait4(self.pid, os.WNOHANG)
+        if pid == self.pid:
+          self.returncode = os.waitstatus_to_exitcode(wait_status)
+          return self.returncode, rusage_to_dict(rusage)
+      except ChildProcessError:
+        # Not a child of this process, it can only be polled.
+        if not is_process_running(self.pid):
+          return None, {}
+      time.sleep(ORPHAN_POLL_INTERVAL)
+
+
+class ForkServer:
+  """
+  Fork server of the agent runs (zygote.py), running with the interpreter of the agent environment.
+  """
+
+  def __init__(self):
+    self.socket_path = os.path.join(runs_root_dir, "zygote.sock")
+    self.process = None
+    self._lock = threading.Lock()
+
+  def start(self):
+    """
+    Start the fork server, unless running. It accepts runs once it imported the agent.
+    """
+    with self._lock:
+      if self.process is not None and self.process.poll() is None:
+        return
+      if get_agent_command() is None:
+        logger.warning(f"No agent environment in {agent_venv_dir}, not starting the fork server")
+        return
+      os.makedirs(runs_root_dir, exist_ok=True)
+      if os.path.exists(self.socket_path):
+        os.remove(self.socket_path)
+      command = [
+        os.path.join(agent_venv_dir, "bin", "python"), os.path.join(current_dir, "zygote.py"),
+        "--socket", self.socket_path,
+        "--agent_dir", agent_dir,
+        "--entry_point", get_agent_entry_point()
+      ]
+      logger.info(f"Starting the fork server: {command}")
+      with open(os.path.join(runs_root_dir, "zygote.log"), 'ab') as log:
+        self.process = subprocess.Popen(command, env=get_agent_base_env(), stdin=subprocess.DEVNULL,
+                                        stdout=log, stderr=subprocess.STDOUT)
+
+  def fork(self, request):
+    """
+    Fork the agent process of a run. Returns a ForkedRun, or None if the fork server is not available.
+    """
+    if self.process is None or self.process.poll() is not None:
+      # Not started, or died: (re)start it for the next runs.
+      self.start()
+      return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      conn.connect(self.socket_path)
+      conn.sendall((json.dumps(request) + "\n").encode())
+      # Only the fork is waited for, not the run.
+      conn.settimeout(10)
+      # The same reader gets the exit of the run, which may already be buffered.
+      reader = conn.makefile('r')
+      response = json.loads(reader.readline())
+      conn.settimeout(None)
+    except (OSError, ValueError) as e:
+      # Still importing the agent.
+      logger.info(f"Fork server not available: {e}")
+      conn.close()
+      return None
+    if "pid" not in response:
+      logger.error(f"Fork server failed to fork: {response.get('error')}")
+      conn.close()
+      return None
+    return ForkedRun(response["pid"], conn, reader)
+
+
+fork_server = ForkServer()
+
+
+def get_launcher_command(run_id, envs, inputs):
+  """
+  Command starting the agent through launcher.py, which replaces itself with `uv run crewai run`.
+  """
   command = [
     "uv", "run", "launcher.py",
     "--command", "run",
-    "--run_id", str(run_id),
+    "--run_id", run_id,
     "--runs_root_dir", str(runs_root_dir)
   ]
 
@@ -51,24 +459,159 @@ def start_agent(run_id):
   for key, value in inputs.items():
     command.append("--input")
     command.append(f"{key}={value}")
+  return command
+
+
+def launch_run(run_id, data):
+  """
+  Start the agent process of the run.
+  """
+  # Extract the required fields
+  envs = data.get('envs', {})
+  inputs = data.get('inputs', {})
+  run_dir = os.path.join(runs_root_dir, run_id)
+
+  # Log or use the extracted data
+  logger.info(f"Environment variables: {list(envs)}")
+  logger.info(f"Inputs: {inputs}")
+
+  # The agent joins the cgroup of the run before exec, so that the agent and all its children are limited.
+  cgroup_dir = create_run_cgroup(run_id, data.get('limits'))
+
+  process = None
+  command = get_agent_command() if AGENT_LAUNCH_MODE in ("direct", "fork") else None
+  if command and AGENT_LAUNCH_MODE == "fork":
+    env = get_agent_env(run_dir, envs, inputs)
+    started_at = time.time()
+    process = fork_server.fork({
+      "run_id": run_id,
+      "env": env,
+      "stdout": os.path.join(run_dir, "stdout.log"),
+      "stderr": os.path.join(run_dir, "stderr.log"),
+      "cgroup_dir": cgroup_dir,
+    })
+    if process is not None:
+      logger.info(f"Forked the agent of run {run_id} from the fork server")
+
+  if process is None and command:
+    logger.info(f"Command to execute: {command}")
+    env = get_agent_env(run_dir, envs, inputs)
+    # Start the agent process (non-blocking), with its output written to the log files of the run.
+    with open(os.path.join(run_dir, "stdout.log"), 'wb') as stdout, \
+         open(os.path.join(run_dir, "stderr.log"), 'wb') as stderr:
+      started_at = time.time()
+      process = subprocess.Popen(in_run_cgroup(cgroup_dir, command), cwd=agent_dir, env=env,
+                                 stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr)
+  elif process is None:
+    if AGENT_LAUNCH_MODE != "uv":
+      logger.warning(f"No agent environment in {agent_venv_dir}, starting the agent with uv")
+    command = get_launcher_command(run_id, envs, inputs)
+    # FIXME: do not log sensitive information
+    logger.info(f"Command to execute: {command}")
+    # Start the subprocess (non-blocking).
+    # The launcher replaces itself with the agent, so this process is the agent process.
+    started_at = time.time()
+    process = subprocess.Popen(in_run_cgroup(cgroup_dir, command))
 
-  # FIXME: do not log sensitive information
-  logger.info(f"Command to execute: {command}")
-
-  # Start the subprocess
-  # Start the subprocess (non-blocking)
-  process = subprocess.Popen(
-    command,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
-    text=True
-  )
-  
   # Get the process ID
   pid = process.pid
-  
-  # Return the process ID in the response
-  return jsonify({"status": "RUNNING", "message": "Agent started", "pid": pid})
+  with open(os.path.join(run_dir, "pid"), 'w') as f:
+    f.write(str(pid))
+
+  with runs_lock:
+    runs[run_id] = process
+  threading.Thread(
+    target=watch_run,
+    args=(run_id, process, started_at, data.get('callbackUrl'), cgroup_dir),
+    name=f"run_{run_id}",
+    daemon=True
+  ).start()
+
+
+def write_run_result(run_id, result):
+  """
+  Record the result of a run in its directory. Written atomically, readers never see a partial file.
+  """
+  exit_file_path = os.path.join(runs_root_dir, run_id, "exit.json")
+  with open(exit_file_path + ".tmp", 'w') as f:
+    json.dump(result, f)
+  os.replace(exit_file_path + ".tmp", exit_file_path)
+
+
+def watch_run(run_id, process, started_at, callback_url, cgroup_dir=None):
+  """
+  Wait for the agent process of a run to exit, record its exit code, duration and resource usage
+  in the run directory, and notify the manager through the callback URL, if any.
+  The cgroup of the run, if any, is removed, and the next queued run is started.
+  """
+  if isinstance(process, ForkedRun):
+    _, rusage = process.wait()
+  else:
+    _, wait_status, rusage = os.wait4(process.pid, 0)
+    # Let the Popen object know the process was reaped.
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    rusage = rusage_to_dict(rusage)
+  ended_at = time.time()
+
+  result = {
+    "status": "DONE" if process.returncode == 0 else "ERROR",
+    "exit_code": process.returncode,
+    "started_at": started_at,
+    "ended_at": ended_at,
+    "duration": ended_at - started_at,
+    "rusage": rusage,
+  }
+  logger.info(f"Run {run_id} exited with code {process.returncode} after {result['duration']:.1f}s")
+  write_run_result(run_id, result)
+
+  with runs_lock:
+    runs.pop(run_id, None)
+  dispatch_runs()
+
+  if cgroup_dir:
+    remove_run_cgroup(cgroup_dir)
+
+  if callback_url:
+    post_to_manager(callback_url, result, f"the completion of run {run_id}")
+
+
+def post_to_manager(url, payload, description):
+  """
+  Push a notification to the manager. Retries with exponential backoff.
+  The manager still gets the information by polling the supervisor if all the attempts fail.
+  """
+  body = json.dumps(payload).encode()
+  delay = 0.5
+  for attempt in range(CALLBACK_ATTEMPTS):
+    try:
+      callback_request = urllib.request.Request(
+        url, data=body, method='POST', headers={'Content-Type': 'application/json'})
+      with urllib.request.urlopen(callback_request, timeout=10):
+        pass
+      logger.info(f"Notified manager of {description}")
+      return
+    except (urllib.error.URLError, OSError) as e:
+      logger.warning(f"Failed to notify manager of {description}: {e}")
+    time.sleep(delay)
+    delay *= 2
+  logger.error(f"Giving up notifying manager of {description}")
+
+
+def notify_ready(ready_url):
+  """
+  Tell the manager that the supervisor is ready, as soon as the API accepts connections.
+  """
+  delay = 0.005
+  while True:
+    try:
+      with socket.create_connection(("127.0.0.1", SUPERVISOR_PORT), timeout=1):
+        break
+    except OSError:
+      time.sleep(delay)
+      delay = min(delay * 2, 0.5)
+
+  # Docker sets the hostname of the container to its (short) id.
+  post_to_manager(ready_url, {"containerId": socket.gethostname()}, "the supervisor readiness")
 
 
 @app.route('/api/run/<run_id>/stop', methods=['POST'])
@@ -81,82 +624,265 @@ def stop_agent(run_id):
   return jsonify({"status": "STOPPED", "message": "Agent stopped"})
 
 
-@app.route('/api/run/<run_id>/status', methods=['GET'])
-def agent_status(run_id):
+def get_run_status(run_id):
   """
-  Check the status of the agent run with the given run ID.
+  Returns the status of the agent run with the given run ID, as a tuple (response, http status code).
   """
-  logger.info(f"Checking status for run id {run_id}")
-
   run_dir = os.path.join(runs_root_dir, run_id)
 
   # Check if run directory exists
   if not os.path.exists(run_dir):
-    return jsonify({"status": "ERROR", "message": f"Run directory not found for run_id {run_id}"}), 404
+    return {"status": "ERROR", "message": f"Run directory not found for run_id {run_id}"}, 404
+
+  # The result is recorded once the agent process exited
+  exit_file_path = os.path.join(run_dir, "exit.json")
+  if os.path.exists(exit_file_path):
+    try:
+      with open(exit_file_path, 'r') as f:
+        result = json.load(f)
+      return {
+        "status": result["status"],
+        "exit_code": result["exit_code"],
+        "duration": result["duration"],
+        "rusage": result["rusage"],
+      }, 200
+    except (ValueError, KeyError, IOError) as e:
+      return {"status": "ERROR", "message": f"Error reading exit file: {str(e)}"}, 500
+
+  with runs_lock:
+    if run_id in runs:
+      return {"status": "RUNNING"}, 200
+    for position, (queued_id, _) in enumerate(run_queue, start=1):
+      if queued_id == run_id:
+        return {"status": "QUEUED", "position": position}, 200
+
+  # The run was not started by this supervisor process (e.g. the supervisor restarted).
+  # Fall back to checking its PID.
 
   # Check if PID file exists
   pid_file_path = os.path.join(run_dir, "pid")
   if not os.path.exists(pid_file_path):
-    return jsonify({"status": "ERROR", "message": "PID file not found"}), 404
+    return {"status": "ERROR", "message": "PID file not found"}, 404
 
   # Read PID from file
   try:
     with open(pid_file_path, 'r') as f:
       pid = int(f.read().strip())
   except (ValueError, IOError) as e:
-    return jsonify({"status": "ERROR", "message": f"Error reading PID file: {str(e)}"}), 500
+    return {"status": "ERROR", "message": f"Error reading PID file: {str(e)}"}, 500
 
   # Check if process is still running
   try:
     # Send signal 0 to process to check if it exists
     os.kill(pid, 0)
-    return jsonify({"status": "RUNNING"})
+    return {"status": "RUNNING"}, 200
   except OSError:
     # Process is not running
-    return jsonify({"status": "DONE"})
+    return {"status": "DONE"}, 200
+
+
+@app.route('/api/run/<run_id>/status', methods=['GET'])
+def agent_status(run_id):
+  """
+  Check the status of the agent run with the given run ID.
+  """
+  logger.info(f"Checking status for run id {run_id}")
+  status, code = get_run_status(run_id)
+  return jsonify(status), code
+
+
+@app.route('/api/runs/status', methods=['POST'])
+def runs_status():
+  """
+  Check the status of several agent runs at once.
+  Expects {"runIds": [...]}, returns {"runs": {run_id: status}} where each status has the HTTP status
+  code the single run endpoint would have returned in "code".
+  With "offsets": {run_id: {"stdout": offset, "stderr": offset}}, the status of these runs also has in
+  "output" what the output endpoint would have returned for these offsets.
+  """
+  data = request.get_json(silent=True) or {}
+  try:
+    run_ids = [str(int(run_id)) for run_id in data.get("runIds") or []]
+    offsets = {str(int(run_id)): {stream: int(offset.get(stream) or 0) for stream in ("stdout", "stderr")}
+               for run_id, offset in (data.get("offsets") or {}).items()}
+  except (AttributeError, TypeError, ValueError):
+    return jsonify({"message": "runIds must be a list of run ids, offsets a map of run ids to offsets"}), 400
+
+  logger.info(f"Checking status for run ids {run_ids}")
+  statuses = {}
+  for run_id in run_ids:
+    status, code = get_run_status(run_id)
+    statuses[run_id] = dict(status, code=code)
+    if code == 200 and run_id in offsets:
+      # Read after the status, so that the output of a completed run is complete.
+      stdout, stdout_offset = read_log(os.path.join(runs_root_dir, run_id, "stdout.log"), offsets[run_id]["stdout"])
+      stderr, stderr_offset = read_log(os.path.join(runs_root_dir, run_id, "stderr.log"), offsets[run_id]["stderr"])
+      statuses[run_id]["output"] = {
+        "stdout": stdout,
+        "stderr": stderr,
+        "stdout_offset": stdout_offset,
+        "stderr_offset": stderr_offset
+      }
+  return jsonify({"runs": statuses})
+
+
+def complete_utf8_length(data):
+  """
+  Returns the length of the longest prefix of data that does not end with a truncated UTF-8 sequence.
+  Used to avoid splitting a multi-byte character between two reads of a log file.
+  """
+  for i in range(1, min(4, len(data)) + 1):
+    byte = data[-i]
+    if byte & 0xC0 == 0x80:
+      # Continuation byte, keep looking for the leading byte.
+      continue
+    if byte & 0x80 == 0:
+      sequence_length = 1
+    elif byte & 0xE0 == 0xC0:
+      sequence_length = 2
+    elif byte & 0xF0 == 0xE0:
+      sequence_length = 3
+    else:
+      sequence_length = 4
+    return len(data) if i >= sequence_length else len(data) - i
+  return len(data)
+
+
+def read_log(log_path, offset=0):
+  """
+  Read a log file from the given byte offset.
+  Returns the content read and the offset to use for the next read.
+  """
+  if not os.path.exists(log_path):
+    return "", offset
+
+  try:
+    with open(log_path, 'rb') as f:
+      f.seek(offset)
+      data = f.read()
+  except Exception as e:
+    logger.error(f"Error reading log {log_path}: {e}")
+    return "", offset
+
+  length = complete_utf8_length(data)
+  return data[:length].decode('utf-8', errors='replace'), offset + length
 
 
 @app.route('/api/run/<run_id>/output', methods=['GET'])
 def agent_logs(run_id):
   """
   Retrieve the output logs of the agent run with the given run ID.
+  Only the content written after the stdout_offset and stderr_offset query parameters (bytes) is returned,
+  along with the offsets to use for the next call.
   """
   logger.info(f"Retrieving output for run id {run_id}")
 
+  stdout_offset = request.args.get('stdout_offset', 0, type=int)
+  stderr_offset = request.args.get('stderr_offset', 0, type=int)
+
   # Construct the paths to log files
   stdout_log_path = os.path.join(runs_root_dir, run_id, "stdout.log")
   stderr_log_path = os.path.join(runs_root_dir, run_id, "stderr.log")
 
-  # Initialize log content
-  stdout_content = ""
-  stderr_content = ""
+  stdout_content, stdout_offset = read_log(stdout_log_path, stdout_offset)
+  stderr_content, stderr_offset = read_log(stderr_log_path, stderr_offset)
 
-  # Read stdout.log if it exists
-  if os.path.exists(stdout_log_path):
-    try:
-      with open(stdout_log_path, 'r') as f:
-        stdout_content = f.read()
-    except Exception as e:
-      logger.error(f"Error reading stdout log: {e}")
+  # Return the log contents
+  return jsonify({
+    "stdout": stdout_content,
+    "stderr": stderr_content,
+    "stdout_offset": stdout_offset,
+    "stderr_offset": stderr_offset
+  })
+
+
+def format_sse(event, data, event_id=None):
+  """
+  Format a Server-Sent Event. Multi-line data is sent as multiple data fields.
+  """
+  message = f"event: {event}\n"
+  if event_id is not None:
+    message += f"id: {event_id}\n"
+  for line in data.split("\n"):
+    message += f"data: {line}\n"
+  return message + "\n"
+
+
+@app.route('/api/run/<run_id>/stream', methods=['GET'])
+def stream_logs(run_id):
+  """
+  Stream the output logs of the agent run as Server-Sent Events, until the run completes.
+  The logs are tailed from the stdout_offset and stderr_offset query parameters (bytes), or from the
+  Last-Event-ID header when the client reconnects. Each event id holds the offsets 'stdout:stderr'.
+  A final 'status' event is sent once the run is no longer running.
+  """
+  logger.info(f"Streaming output for run id {run_id}")
 
-  # Read stderr.log if it exists
-  if os.path.exists(stderr_log_path):
+  offsets = {
+    "stdout": request.args.get('stdout_offset', 0, type=int),
+    "stderr": request.args.get('stderr_offset', 0, type=int),
+  }
+  last_event_id = request.headers.get('Last-Event-ID')
+  if last_event_id:
     try:
-      with open(stderr_log_path, 'r') as f:
-        stderr_content = f.read()
-    except Exception as e:
-      logger.error(f"Error reading stderr log: {e}")
+      offsets["stdout"], offsets["stderr"] = (int(offset) for offset in last_event_id.split(":"))
+    except ValueError:
+      logger.warning(f"Ignoring malformed Last-Event-ID: {last_event_id}")
 
-  # Return the log contents
-  return jsonify({"stdout": stdout_content, "stderr": stderr_content})
+  log_paths = {stream: os.path.join(runs_root_dir, run_id, f"{stream}.log") for stream in offsets}
+
+  def generate():
+    last_sent = time.monotonic()
+    while True:
+      # Check the status before reading the logs, so that all the output
+      # written before the run completed is sent before the status event.
+      status, _ = get_run_status(run_id)
+
+      for stream, log_path in log_paths.items():
+        content, offsets[stream] = read_log(log_path, offsets[stream])
+        if content:
+          yield format_sse(stream, content, event_id=f"{offsets['stdout']}:{offsets['stderr']}")
+          last_sent = time.monotonic()
+
+      if status["status"] not in ("RUNNING", "QUEUED"):
+        yield format_sse("status", json.dumps(status))
+        return
+
+      # Keep the connection alive through proxies and client read timeouts.
+      if time.monotonic() - last_sent > STREAM_KEEPALIVE_INTERVAL:
+        yield ": keepalive\n\n"
+        last_sent = time.monotonic()
+
+      time.sleep(STREAM_POLL_INTERVAL)
+
+  return Response(generate(), mimetype='text/event-stream', headers={
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+  })
 
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
   """
-  Health check endpoint.
+  Health check endpoint. Reports the load of the container, used by the manager to spread the runs
+  over the containers of the image.
   """
-  return jsonify({"status": "HEALTHY"})
+  with runs_lock:
+    load = {"running": len(runs), "queued": len(run_queue), "maxConcurrent": MAX_CONCURRENT_RUNS}
+  return jsonify({"status": "HEALTHY", "runs": load})
 
 if __name__ == '__main__':
+  # Serve HTTP/1.1 so that the manager can keep its connections alive,
+  # and so that output streams are sent with chunked encoding.
+  WSGIRequestHandler.protocol_version = "HTTP/1.1"
+
+  ready_url = os.getenv("LAUNCHPAD_READY_URL")
+  if ready_url:
+    threading.Thread(target=notify_ready, args=(ready_url,), name="notify_ready", daemon=True).start()
+
+  # Import the agent in the fork server while the supervisor starts. With the reloader, the app is served
+  # by a child process: only start it there.
+  if AGENT_LAUNCH_MODE == "fork" and is_running_from_reloader():
+    fork_server.start()
+
   app.run(host='0.0.0.0', port=SUPERVISOR_PORT, debug=True)
\ No newline at end of file
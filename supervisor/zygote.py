@@ -0,0 +1,182 @@
+# Fork server of the agent runs.
+# Started by the supervisor with the interpreter of the agent environment, it imports the entry point of the
+# agent once (the agent package, its crew definition and CrewAI), then forks a child for each run, which only
+# has to run the entry point. The env of a run is set in its child after the imports: the values read at import
+# time are those of the fork server.
+# python zygote.py --socket /app/runs/zygote.sock --agent_dir /app/agent --entry_point run_crew
+#
+# Protocol, one JSON object per line over a unix socket, one connection per run:
+# -> {"run_id": ..., "env": {...}, "stdout": path, "stderr": path, "cgroup_dir": path or null}
+# <- {"pid": pid} once the child is forked, or {"error": message}
+# <- {"exit_code": code, "rusage": {...}} once the child exited
+#
+# Only depends on the standard library: it runs in the agent environment.
+
+import argparse
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import traceback
+from importlib.metadata import entry_points
+
+
+def load_entry_point(name):
+  """
+  Import the console script of the agent environment with the given name, and return its function.
+  """
+  matches = entry_points(group="console_scripts", name=name)
+  if not matches:
+    raise LookupError(f"No {name} script in the agent environment")
+  return next(iter(matches)).load()
+
+
+def rusage_to_dict(rusage):
+  return {
+    "user_time": rusage.ru_utime,
+    "system_time": rusage.ru_stime,
+    "max_rss_kb": rusage.ru_maxrss,
+    "minor_page_faults": rusage.ru_minflt,
+    "major_page_faults": rusage.ru_majflt,
+    "voluntary_context_switches": rusage.ru_nvcsw,
+    "involuntary_context_switches": rusage.ru_nivcsw,
+  }
+
+
+def run_child(request, agent_dir, entry_point, main):
+  """
+  Body of the forked child: set up the run, like the supervisor does for a spawned agent, and run the agent.
+  Never returns.
+  """
+  exit_code = 1
+  try:
+    # Join the cgroup of the run, so that the agent and all its children are limited.
+    if request.get("cgroup_dir"):
+      try:
+        with open(os.path.join(request["cgroup_dir"], "cgroup.procs"), 'w') as f:
+          f.write("0")
+      except OSError:
+        pass
+
+    stdin_fd = os.open(os.devnull, os.O_RDONLY)
+    stdout_fd = os.open(request["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    stderr_fd = os.open(request["stderr"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    for fd, target in ((stdin_fd, 0), (stdout_fd, 1), (stderr_fd, 2)):
+      os.dup2(fd, target)
+      os.close(fd)
+
+    os.chdir(agent_dir)
+    os.environ.clear()
+    os.environ.update(request["env"])
+    sys.argv = [entry_point]
+
+    # Like the console script: the return value of the entry point is the exit code.
+    try:
+      result = main()
+      exit_code = result if isinstance(result, int) else (0 if result is None else 1)
+    except SystemExit as e:
+      exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+      traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(exit_code)
+
+
+def send(conn, message):
+  try:
+    conn.sendall((json.dumps(message) + "\n").encode())
+  except OSError:
+    # The supervisor went away. The run goes on.
+    pass
+
+
+def serve(socket_path, agent_dir, entry_point):
+  main = load_entry_point(entry_point)
+
+  # SIGCHLD wakes up the loop through the wakeup socket, to report the exits right away.
+  wakeup_r, wakeup_w = socket.socketpair()
+  wakeup_r.setblocking(False)
+  wakeup_w.setblocking(False)
+  signal.set_wakeup_fd(wakeup_w.fileno())
+  signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+  if os.path.exists(socket_path):
+    os.remove(socket_path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(socket_path + ".tmp")
+  server.listen(64)
+  # Ready once the socket exists.
+  os.replace(socket_path + ".tmp", socket_path)
+  print(f"Fork server of {entry_point} listening on {socket_path}", flush=True)
+
+  selector = selectors.DefaultSelector()
+  selector.register(server, selectors.EVENT_READ)
+  selector.register(wakeup_r, selectors.EVENT_READ)
+  # pid -> connection of the run
+  children = {}
+
+  while True:
+    for key, _ in selector.select():
+      if key.fileobj is wakeup_r:
+        try:
+          while wakeup_r.recv(512):
+            pass
+        except BlockingIOError:
+          pass
+        continue
+
+      conn, _ = server.accept()
+      try:
+        conn.settimeout(10)
+        with conn.makefile('r') as f:
+          request = json.loads(f.readline())
+      except (OSError, ValueError) as e:
+        send(conn, {"error": f"Invalid request: {e}"})
+        conn.close()
+        continue
+
+      sys.stdout.flush()
+      sys.stderr.flush()
+      pid = os.fork()
+      if pid == 0:
+        # Child: drop the state of the server.
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        selector.close()
+        for fd in [server, wakeup_r, wakeup_w, conn] + list(children.values()):
+          fd.close()
+        run_child(request, agent_dir, entry_point, main)
+      children[pid] = conn
+      send(conn, {"pid": pid})
+
+    # Report the exits of the children
+    while children:
+      try:
+        pid, wait_status, rusage = os.wait4(-1, os.WNOHANG)
+      except ChildProcessError:
+        break
+      if pid == 0:
+        break
+      conn = children.pop(pid, None)
+      if conn is not None:
+        send(conn, {"exit_code": os.waitstatus_to_exitcode(wait_status), "rusage": rusage_to_dict(rusage)})
+        conn.close()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Fork server of the agent runs')
+  parser.add_argument('--socket', required=True, help='Path of the unix socket to listen on.')
+  parser.add_argument('--agent_dir', required=True, help='Directory of the agent project.')
+  parser.add_argument('--entry_point', required=True, help='Console script of the agent environment to run.')
+  args = parser.parse_args()
+
+  # Import the agent from its directory, like the children will run it.
+  os.chdir(args.agent_dir)
+  sys.path = [path for path in sys.path if os.path.abspath(path or ".") != os.path.dirname(os.path.abspath(__file__))]
+  serve(args.socket, args.agent_dir, args.entry_point)
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# The api package configures the app from the environment when imported: point it at throwaway resources.
+_root = tempfile.mkdtemp(prefix="launchpad-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_root}/db.sqlite")
+os.environ.setdefault("STAGING_ROOT_DIR", os.path.join(_root, "staging"))
+os.environ.setdefault("IMAGES_ROOT_DIR", os.path.join(_root, "images"))
+os.environ.setdefault("DOCKER_HOST", f"unix://{_root}/docker.sock")
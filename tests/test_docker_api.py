@@ -0,0 +1,188 @@
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from api.container import docker_api
+from api.container.docker_api import DockerAPIError, DockerClient
+
+
+class FakeDaemon:
+    """
+    Minimal Docker daemon on a unix socket. routes maps (method, path) to a handler called with the
+    request handler, which writes the response.
+    """
+
+    def __init__(self, socket_path, routes):
+        self.routes = routes
+        # Client connections accepted by the server.
+        self.connections = 0
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                daemon.connections += 1
+
+            def address_string(self):
+                return "unix"
+
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.body = self.rfile.read(length)
+                path = self.path.partition("?")[0].removeprefix("/v1.41")
+                route = daemon.routes.get((self.command, path))
+                if route is None:
+                    return send_json(self, 404, {"message": f"page not found: {path}"})
+                route(self)
+
+            do_GET = do_POST = do_DELETE = handle_request
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(socket_path, Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def send_json(handler, status, content):
+    body = json.dumps(content).encode()
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def send_chunk(handler, data):
+    handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+    handler.wfile.flush()
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    socket_path = str(tmp_path / "docker.sock")
+    daemon = FakeDaemon(socket_path, {})
+    daemon.client = DockerClient(f"unix://{socket_path}", api_version="v1.41", timeout=5)
+    yield daemon
+    daemon.close()
+
+
+def test_connection_reused_across_calls(daemon):
+    daemon.routes[("GET", "/info")] = lambda handler: send_json(handler, 200, {"NCPU": 4})
+    daemon.routes[("POST", "/containers/abc/start")] = lambda handler: (
+        handler.send_response(204), handler.send_header("Content-Length", "0"), handler.end_headers())
+
+    for _ in range(3):
+        assert daemon.client.info() == {"NCPU": 4}
+    daemon.client.start_container("abc")
+
+    assert daemon.connections == 1
+
+
+def test_connection_closed_by_daemon_is_replaced(daemon):
+    def info(handler):
+        send_json(handler, 200, {"NCPU": 4})
+        handler.close_connection = True
+
+    daemon.routes[("GET", "/info")] = info
+
+    assert daemon.client.info() == {"NCPU": 4}
+    assert daemon.client.info() == {"NCPU": 4}
+    assert daemon.connections == 2
+
+
+@pytest.mark.parametrize("status", [404, 409, 500])
+def test_error_responses_raise_docker_api_error(daemon, status):
+    daemon.routes[("GET", "/containers/abc/json")] = lambda handler: send_json(
+        handler, status, {"message": "No such container: abc"})
+
+    with pytest.raises(DockerAPIError) as error:
+        daemon.client.inspect_container("abc")
+
+    assert error.value.status == status
+    assert error.value.message == "No such container: abc"
+
+
+def test_error_response_without_json_body(daemon):
+    def info(handler):
+        handler.send_response(502)
+        handler.send_header("Content-Length", "11")
+        handler.end_headers()
+        handler.wfile.write(b"bad gateway")
+
+    daemon.routes[("GET", "/info")] = info
+
+    with pytest.raises(DockerAPIError) as error:
+        daemon.client.info()
+
+    assert (error.value.status, error.value.message) == (502, "bad gateway")
+    # The connection remains usable after an error.
+    daemon.routes[("GET", "/info")] = lambda handler: send_json(handler, 200, {"NCPU": 4})
+    assert daemon.client.info() == {"NCPU": 4}
+
+
+def test_build_output_parsed_as_it_is_streamed(daemon, tmp_path, monkeypatch):
+    monkeypatch.setattr(docker_api, "DOCKER_BUILDKIT", False)
+    first_line_received = threading.Event()
+
+    def build(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        # A message split across chunks, then a chunk holding two messages.
+        send_chunk(handler, b'{"stream": "Step 1/2 : FROM py')
+        send_chunk(handler, b'thon\\n"}\r\n')
+        # The rest of the output is only sent once the client handled the first message.
+        assert first_line_received.wait(5)
+        send_chunk(handler, b'{"stream": "Step 2/2 : RUN true\\n"}\r\n{"status": "done"}\r\n')
+        send_chunk(handler, b"")
+
+    daemon.routes[("POST", "/build")] = build
+    context_dir = tmp_path / "context"
+    context_dir.mkdir()
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text("FROM python\nRUN --mount=type=cache,target=/root/.cache true\n")
+
+    lines = []
+
+    def on_output(line):
+        lines.append(line)
+        first_line_received.set()
+
+    daemon.client.build_image(context_dir, dockerfile, "agent:latest", on_output=on_output)
+
+    assert lines == ["Step 1/2 : FROM python", "Step 2/2 : RUN true", "done"]
+
+
+def test_build_error_message_raises_docker_api_error(daemon, tmp_path, monkeypatch):
+    monkeypatch.setattr(docker_api, "DOCKER_BUILDKIT", False)
+
+    def build(handler):
+        handler.send_response(200)
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        send_chunk(handler, b'{"stream": "Step 1/1 : RUN false\\n"}\r\n')
+        send_chunk(handler, b'{"error": "The command returned a non-zero code: 1\\n"}\r\n')
+        send_chunk(handler, b"")
+
+    daemon.routes[("POST", "/build")] = build
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text("FROM python\nRUN false\n")
+
+    with pytest.raises(DockerAPIError) as error:
+        daemon.client.build_image(tmp_path, dockerfile, "agent:latest")
+
+    assert error.value.message == "The command returned a non-zero code: 1"
@@ -0,0 +1,167 @@
+import itertools
+
+import pytest
+
+from api.container.fleet import (CONTAINER_LABEL, CPU_RESERVATION_LABEL, MEMORY_RESERVATION_LABEL, DockerFleet,
+                                 DockerHost, NoCapacityError)
+
+GB = 1024 ** 3
+
+_ids = itertools.count(1)
+
+
+class FakeDockerClient:
+    """
+    Docker client of a fake daemon with the given capacity, running the containers started through it.
+    """
+
+    def __init__(self, cpus=4, memory=8 * GB, images=(), fail_with=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.images = set(images)
+        # Exception raised when starting a container, to simulate a failing host.
+        self.fail_with = fail_with
+        # container_id -> labels
+        self.containers = {}
+
+    def info(self):
+        return {"NCPU": self.cpus, "MemTotal": self.memory}
+
+    def list_containers(self, filters=None):
+        return [{"Id": container_id, "Labels": labels} for container_id, labels in self.containers.items()]
+
+    def list_images(self, filters=None):
+        return [{"Id": name} for name in filters["reference"] if name in self.images]
+
+    def export_image(self, image_name):
+        yield image_name.encode()
+
+    def load_image(self, chunks):
+        self.images.add(b"".join(chunks).decode())
+
+    def run_container(self, image_name, exposed_port, env=None, labels=None, host_config=None, name=None):
+        if self.fail_with:
+            raise self.fail_with
+        assert image_name in self.images
+        container_id = f"{next(_ids):064x}"
+        self.containers[container_id] = labels
+        return container_id
+
+
+def make_fleet(placement, *hosts):
+    """
+    Fleet of hosts given as (url, client), the images being built by a separate host.
+    """
+    build_client = FakeDockerClient(images={"agent"})
+    return DockerFleet([DockerHost(url, client) for url, client in hosts], build_client=build_client,
+                       placement=placement)
+
+
+def place(fleet, count, cpus=1, memory=GB):
+    return [fleet.start_container("agent", 4000, cpus=cpus, memory=memory)[0].url for _ in range(count)]
+
+
+def test_host_options_from_config():
+    fleet = DockerFleet.from_config("unix:///var/run/docker.sock,tcp://10.0.0.5:2375?cpus=8&memory=1024"
+                                    "&max_containers=20, tcp://10.0.0.6:2375?address=agents.internal")
+
+    local, configured, addressed = fleet.hosts
+    assert (local.url, local.address, local.cpus, local.memory) == ("unix:///var/run/docker.sock", "localhost",
+                                                                    None, None)
+    assert (configured.url, configured.address) == ("tcp://10.0.0.5:2375", "10.0.0.5")
+    assert (configured.cpus, configured.memory, configured.max_containers) == (8, 1024, 20)
+    assert (addressed.url, addressed.address) == ("tcp://10.0.0.6:2375", "agents.internal")
+
+
+def test_capacity_read_from_daemon_unless_configured():
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", FakeDockerClient(cpus=4, memory=8 * GB)),
+                       ("tcp://b:2375?cpus=2", FakeDockerClient(cpus=4, memory=8 * GB)))
+    fleet.refresh()
+
+    assert [(host.cpus, host.memory) for host in fleet.hosts] == [(4, 8 * GB), (2, 8 * GB)]
+
+
+def test_least_loaded_spreads_the_containers():
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", FakeDockerClient(cpus=4)),
+                       ("tcp://b:2375", FakeDockerClient(cpus=8)))
+
+    # The load is the fraction of the capacity in use: b takes two containers for each container of a.
+    assert place(fleet, 6) == ["tcp://b:2375", "tcp://a:2375", "tcp://b:2375", "tcp://b:2375", "tcp://a:2375",
+                               "tcp://b:2375"]
+
+
+def test_bin_pack_fills_the_most_loaded_host_first():
+    fleet = make_fleet("bin_pack", ("tcp://a:2375", FakeDockerClient(cpus=2)),
+                       ("tcp://b:2375", FakeDockerClient(cpus=4)))
+
+    assert place(fleet, 5) == ["tcp://a:2375", "tcp://a:2375", "tcp://b:2375", "tcp://b:2375", "tcp://b:2375"]
+
+
+def test_containers_of_other_managers_are_accounted_for():
+    busy = FakeDockerClient(cpus=4)
+    busy.containers["other"] = {CONTAINER_LABEL: "1", CPU_RESERVATION_LABEL: "3", MEMORY_RESERVATION_LABEL: "0"}
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", busy), ("tcp://b:2375", FakeDockerClient(cpus=4)))
+
+    # a only has room for one more container.
+    assert place(fleet, 5) == ["tcp://b:2375", "tcp://b:2375", "tcp://b:2375", "tcp://a:2375", "tcp://b:2375"]
+
+
+def test_cpu_and_memory_reservations_are_respected():
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", FakeDockerClient(cpus=4, memory=2 * GB)),
+                       ("tcp://b:2375", FakeDockerClient(cpus=1, memory=16 * GB)))
+
+    # a is limited by its memory, b by its CPUs.
+    assert sorted(place(fleet, 3, cpus=1, memory=GB)) == ["tcp://a:2375", "tcp://a:2375", "tcp://b:2375"]
+    with pytest.raises(NoCapacityError):
+        fleet.start_container("agent", 4000, cpus=1, memory=GB)
+    # A container without reservations still fits.
+    assert fleet.start_container("agent", 4000)[0].url in ("tcp://a:2375", "tcp://b:2375")
+
+
+def test_max_containers_is_respected():
+    fleet = make_fleet("bin_pack", ("tcp://a:2375?max_containers=2", FakeDockerClient(cpus=16)),
+                       ("tcp://b:2375?max_containers=1", FakeDockerClient(cpus=16)))
+
+    assert sorted(place(fleet, 3, cpus=0, memory=0)) == ["tcp://a:2375", "tcp://a:2375", "tcp://b:2375"]
+    with pytest.raises(NoCapacityError):
+        fleet.start_container("agent", 4000)
+
+
+def test_released_container_frees_its_reservation():
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", FakeDockerClient(cpus=1)))
+    host, container_id = fleet.start_container("agent", 4000, cpus=1, memory=GB)
+    with pytest.raises(NoCapacityError):
+        fleet.start_container("agent", 4000, cpus=1, memory=GB)
+
+    fleet.release(container_id[:12])
+
+    assert fleet.start_container("agent", 4000, cpus=1, memory=GB)[0] is host
+
+
+def test_no_capacity_when_every_host_is_full():
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", FakeDockerClient(cpus=2)),
+                       ("tcp://b:2375", FakeDockerClient(cpus=2)))
+    place(fleet, 4)
+
+    with pytest.raises(NoCapacityError):
+        fleet.start_container("agent", 4000, cpus=1, memory=GB)
+    assert [host.stats()["containers"] for host in fleet.hosts] == [2, 2]
+
+
+def test_unreachable_host_is_skipped():
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", FakeDockerClient(fail_with=ConnectionRefusedError())),
+                       ("tcp://b:2375", FakeDockerClient()))
+
+    assert place(fleet, 2) == ["tcp://b:2375", "tcp://b:2375"]
+    assert not fleet.hosts[0].reachable
+    assert fleet.hosts[0].pending == {}
+
+
+def test_image_copied_to_the_host_once():
+    client = FakeDockerClient()
+    fleet = make_fleet("least_loaded", ("tcp://a:2375", client))
+
+    place(fleet, 2)
+
+    assert client.images == {"agent"}
+    assert fleet.hosts[0].images == {"agent"}